@@ -1,10 +1,32 @@
+import asyncio
 import datetime
+import functools
+import heapq
+import html
+import itertools
+import json
 import sqlite3
 import re
 import logging
+import math
+import multiprocessing
+import os
 import random
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
+import queue
+import secrets
+import signal
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaVideo
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler, BaseRateLimiter
+from telegram.ext import BasePersistence, PersistenceInput, TypeHandler
+from telegram.error import RetryAfter, NetworkError, TimedOut
+
+STARTED_AT = time.perf_counter()
 
 # Настройка логирования
 logging.basicConfig(
@@ -13,267 +35,1367 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Настройка базы данных
-conn = sqlite3.connect('111.db', check_same_thread=False)
-cursor = conn.cursor()
-
-# Создание таблиц
-cursor.executescript('''
--- Основные таблицы
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY,
-    nickname TEXT UNIQUE,
-    reg_date TEXT,
-    last_seen TEXT,
-    is_private BOOLEAN DEFAULT 0,
-    bio TEXT DEFAULT ''
-);
-
-CREATE TABLE IF NOT EXISTS friends (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    friend_id INTEGER,
-    status TEXT CHECK(status IN ('pending', 'accepted', 'rejected')) DEFAULT 'pending',
-    created_at TEXT DEFAULT (datetime('now')),
-    FOREIGN KEY (user_id) REFERENCES users(user_id),
-    FOREIGN KEY (friend_id) REFERENCES users(user_id),
-    UNIQUE(user_id, friend_id)
-);
-
-CREATE TABLE IF NOT EXISTS posts (
-    post_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    content TEXT,
-    post_date TEXT,
-    group_id INTEGER,
-    media_type TEXT,  -- 'photo', 'video', 'document', 'sticker'
-    media_id TEXT,
-    FOREIGN KEY (user_id) REFERENCES users(user_id),
-    FOREIGN KEY (group_id) REFERENCES groups(group_id)
-);
-
-CREATE TABLE IF NOT EXISTS hashtags (
-    hashtag_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    name TEXT UNIQUE
-);
-
-CREATE TABLE IF NOT EXISTS post_hashtags (
-    post_id INTEGER,
-    hashtag_id INTEGER,
-    PRIMARY KEY (post_id, hashtag_id),
-    FOREIGN KEY (post_id) REFERENCES posts(post_id),
-    FOREIGN KEY (hashtag_id) REFERENCES hashtags(hashtag_id)
-);
-
-CREATE TABLE IF NOT EXISTS likes (
-    like_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    post_id INTEGER,
-    user_id INTEGER,
-    like_date TEXT,
-    reaction TEXT DEFAULT 'like',
-    FOREIGN KEY (post_id) REFERENCES posts(post_id),
-    FOREIGN KEY (user_id) REFERENCES users(user_id),
-    UNIQUE(post_id, user_id)
-);
-
-CREATE TABLE IF NOT EXISTS comments (
-    comment_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    post_id INTEGER,
-    user_id INTEGER,
-    content TEXT,
-    comment_date TEXT,
-    FOREIGN KEY (post_id) REFERENCES posts(post_id),
-    FOREIGN KEY (user_id) REFERENCES users(user_id)
-);
-
-CREATE TABLE IF NOT EXISTS notifications (
-    notification_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    type TEXT,
-    content TEXT,
-    related_id INTEGER,
-    notification_date TEXT,
-    is_read INTEGER DEFAULT 0,
-    FOREIGN KEY (user_id) REFERENCES users(user_id)
-);
-
-CREATE TABLE IF NOT EXISTS messages (
-    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    sender_id INTEGER,
-    receiver_id INTEGER,
-    content TEXT,
-    timestamp TEXT,
-    is_read BOOLEAN DEFAULT 0,
-    FOREIGN KEY (sender_id) REFERENCES users(user_id),
-    FOREIGN KEY (receiver_id) REFERENCES users(user_id)
-);
-
-CREATE TABLE IF NOT EXISTS groups (
-    group_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    name TEXT,
-    creator_id INTEGER,
-    description TEXT,
-    is_public BOOLEAN DEFAULT 1,
-    FOREIGN KEY (creator_id) REFERENCES users(user_id)
-);
-
-CREATE TABLE IF NOT EXISTS group_members (
-    group_id INTEGER,
-    user_id INTEGER,
-    role TEXT CHECK(role IN ('admin', 'moderator', 'member')) DEFAULT 'member',
-    joined_at TEXT DEFAULT (datetime('now')),
-    PRIMARY KEY (group_id, user_id),
-    FOREIGN KEY (group_id) REFERENCES groups(group_id),
-    FOREIGN KEY (user_id) REFERENCES users(user_id)
-);
-
-CREATE TABLE IF NOT EXISTS blocks (
-    blocker_id INTEGER,
-    blocked_id INTEGER,
-    created_at TEXT DEFAULT (datetime('now')),
-    PRIMARY KEY (blocker_id, blocked_id),
-    FOREIGN KEY (blocker_id) REFERENCES users(user_id),
-    FOREIGN KEY (blocked_id) REFERENCES users(user_id)
-);
-
-CREATE TABLE IF NOT EXISTS currencies (
-    user_id INTEGER PRIMARY KEY,
-    balance INTEGER DEFAULT 0,
-    last_claim TEXT,
-    FOREIGN KEY (user_id) REFERENCES users(user_id)
-);
-
-CREATE TABLE IF NOT EXISTS reports (
-    report_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    reporter_id INTEGER,
-    target_id INTEGER,
-    target_type TEXT CHECK(target_type IN ('post', 'user', 'item', 'ad')),
-    reason TEXT,
-    report_date TEXT DEFAULT (datetime('now')),
-    FOREIGN KEY (reporter_id) REFERENCES users(user_id)
-);
-
-CREATE TABLE IF NOT EXISTS bookmarks (
-    bookmark_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    post_id INTEGER,
-    created_at TEXT DEFAULT (datetime('now')),
-    FOREIGN KEY (user_id) REFERENCES users(user_id),
-    FOREIGN KEY (post_id) REFERENCES posts(post_id),
-    UNIQUE(user_id, post_id)
-);
-
-CREATE TABLE IF NOT EXISTS marketplace (
-    item_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    seller_id INTEGER,
-    title TEXT,
-    description TEXT,
-    price INTEGER,
-    created_at TEXT DEFAULT (datetime('now')),
-    status TEXT CHECK(status IN ('active', 'sold', 'cancelled')) DEFAULT 'active',
-    media_id TEXT,
-    media_type TEXT,
-    FOREIGN KEY (seller_id) REFERENCES users(user_id)
-);
-
-CREATE TABLE IF NOT EXISTS ads (
-    ad_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    creator_id INTEGER,
-    content TEXT,
-    price INTEGER,
-    created_at TEXT DEFAULT (datetime('now')),
-    status TEXT CHECK(status IN ('pending', 'approved', 'rejected', 'active', 'expired')) DEFAULT 'pending',
-    media_id TEXT,
-    media_type TEXT,
-    FOREIGN KEY (creator_id) REFERENCES users(user_id)
-);
-
-CREATE TABLE IF NOT EXISTS admins (
-    user_id INTEGER PRIMARY KEY,
-    role TEXT CHECK(role IN ('admin', 'moderator', 'superadmin')) DEFAULT 'admin',
-    appointed_at TEXT DEFAULT (datetime('now')),
-    FOREIGN KEY (user_id) REFERENCES users(user_id)
-);
-
--- Новые таблицы для историй
-CREATE TABLE IF NOT EXISTS stories (
-    story_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    media_id TEXT,
-    media_type TEXT CHECK(media_type IN ('photo', 'video', 'text')),
-    content TEXT,
-    created_at TEXT DEFAULT (datetime('now')),
-    expires_at TEXT DEFAULT (datetime('now', '+24 hours')),
-    FOREIGN KEY (user_id) REFERENCES users(user_id)
-);
-
--- Новые таблицы для трансляций
-CREATE TABLE IF NOT EXISTS live_streams (
-    stream_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    group_id INTEGER,
-    title TEXT,
-    started_at TEXT DEFAULT (datetime('now')),
-    status TEXT CHECK(status IN ('active', 'ended')) DEFAULT 'active',
-    FOREIGN KEY (user_id) REFERENCES users(user_id),
-    FOREIGN KEY (group_id) REFERENCES groups(group_id)
-);
-
--- Новые таблицы для достижений
-CREATE TABLE IF NOT EXISTS achievements (
-    achievement_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    type TEXT,
-    description TEXT,
-    earned_at TEXT DEFAULT (datetime('now')),
-    FOREIGN KEY (user_id) REFERENCES users(user_id)
-);
-
--- Новые таблицы для настроек уведомлений
-CREATE TABLE IF NOT EXISTS notification_settings (
-    user_id INTEGER PRIMARY KEY,
-    notify_likes BOOLEAN DEFAULT 1,
-    notify_comments BOOLEAN DEFAULT 1,
-    notify_mentions BOOLEAN DEFAULT 1,
-    notify_friend_requests BOOLEAN DEFAULT 1,
-    FOREIGN KEY (user_id) REFERENCES users(user_id)
-);
-
--- Индексы
-CREATE INDEX IF NOT EXISTS idx_friends_user ON friends(user_id);
-CREATE INDEX IF NOT EXISTS idx_friends_friend ON friends(friend_id);
-CREATE INDEX IF NOT EXISTS idx_posts_user ON posts(user_id);
-CREATE INDEX IF NOT EXISTS idx_notifications_user ON notifications(user_id);
-CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages(receiver_id);
-CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members(user_id);
-CREATE INDEX IF NOT EXISTS idx_bookmarks_user ON bookmarks(user_id);
-CREATE INDEX IF NOT EXISTS idx_marketplace_seller ON marketplace(seller_id);
-CREATE INDEX IF NOT EXISTS idx_ads_creator ON ads(creator_id);
-''')
-conn.commit()
+# Настройка базы данных (значения по умолчанию переопределяются переменными окружения SOCIAL_DB_*)
+DB_PATH = os.environ.get('SOCIAL_DB_PATH', '111.db')
+DB_READERS = int(os.environ.get('SOCIAL_DB_READERS', 4))  # Соединений только для чтения; запись идет через одно соединение-писатель
+DB_PRAGMAS = {
+    'journal_mode': 'WAL',     # Читатели не блокируют писателя
+    'synchronous': 'NORMAL',   # В режиме WAL fsync только при контрольной точке
+    'busy_timeout': 5000,      # мс ожидания блокировки вместо немедленной ошибки
+    'cache_size': -65536,      # Отрицательное значение - в КиБ (64 МиБ на соединение)
+    'mmap_size': 268435456,    # 256 МиБ
+    'temp_store': 'MEMORY',
+}
+DB_PRAGMAS = {name: os.environ.get(f'SOCIAL_DB_{name.upper()}', value) for name, value in DB_PRAGMAS.items()}
+# Групповая фиксация: записи параллельных обновлений копятся столько мс и фиксируются одним COMMIT (0 - выключено)
+DB_GROUP_COMMIT_MS = float(os.environ.get('SOCIAL_DB_GROUP_COMMIT_MS', 0))
+# Проверка планов: каждый новый по форме запрос проходит EXPLAIN QUERY PLAN, полный просмотр большой таблицы - в лог
+DB_CHECK_PLANS = os.environ.get('SOCIAL_CHECK_PLANS') == '1'
+PLAN_LARGE_TABLES = {
+    'users', 'posts', 'likes', 'comments', 'notifications', 'messages', 'marketplace', 'ads', 'stories', 'friends',
+    'group_members', 'bookmarks', 'post_hashtags', 'feed_timeline', 'achievements', 'user_hashtag_affinity',
+}
+
+class QueryPlanChecker:
+    # Подключается к соединениям пула через set_trace_callback и получает запросы с подставленными значениями.
+    # Форма запроса (литералы заменены на ?) проверяется один раз; нарушения копятся в warnings
+    STATEMENT = re.compile(r'\s*(SELECT|WITH|INSERT|UPDATE|DELETE|REPLACE)\b', re.IGNORECASE)
+    LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+    TABLE_REF = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(?!WHERE|JOIN|ON|ORDER|GROUP|LIMIT|LEFT|INNER|USING)(\w+))?',
+                           re.IGNORECASE)
+
+    def __init__(self, path):
+        self.path = path
+        self.warnings = {}  # форма запроса -> просматриваемые целиком таблицы
+        self.enabled = False  # включается после разовых миграций схемы, которые читают таблицы целиком намеренно
+        self._seen = set()
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def trace(self, sql):
+        if not self.enabled or not self.STATEMENT.match(sql):
+            return
+        shape = ' '.join(self.LITERAL.sub('?', sql).split())
+        with self._lock:
+            if shape in self._seen:
+                return
+            self._seen.add(shape)
+            if self._conn is None:
+                self._conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+            try:
+                # EXPLAIN не сверяет версию схемы: обычный запрос перечитывает ее, если индексы с тех пор менялись
+                self._conn.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchall()
+                plan = self._conn.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall()
+            except sqlite3.Error:
+                # Таблица еще не зафиксирована в схеме - проверим при следующем выполнении
+                self._seen.discard(shape)
+                return
+        aliases = {alias or table: table for table, alias in self.TABLE_REF.findall(sql)}
+        scans = set()
+        for row in plan:
+            # Полный просмотр покрывающего индекса - тоже полный просмотр, только строки короче
+            match = re.fullmatch(r'SCAN (\w+)(?: USING (?:COVERING )?INDEX \w+)?', row[3])
+            if match:
+                scans.add(aliases.get(match.group(1), match.group(1)))
+        scans &= PLAN_LARGE_TABLES
+        if scans:
+            self.warnings[shape] = sorted(scans)
+            logger.warning(f"Полный просмотр {', '.join(sorted(scans))}: {shape}")
+
+class ConnectionPool:
+    # Читатели берутся из очереди, писатель один и защищен блокировкой.
+    # Вложенные read()/write() в том же потоке переиспользуют уже взятое соединение,
+    # а вложенный write() входит в транзакцию внешнего (commit - на выходе из внешнего).
+    # Каждый write() - точка сохранения: ошибка откатывает только изменения этой области.
+    # Соединения открываются при первом обращении (или в open()), а не при создании пула.
+    def __init__(self, path, readers=DB_READERS, pragmas=None, group_commit_ms=DB_GROUP_COMMIT_MS):
+        self.path = path
+        self.readers = readers
+        self.pragmas = DB_PRAGMAS if pragmas is None else pragmas
+        self.group_commit = group_commit_ms / 1000
+        self.on_open = None  # подготовка базы (миграции) сразу после подключения, до первого запроса
+        self._batch = None
+        self.plans = QueryPlanChecker(path) if DB_CHECK_PLANS else None
+        self._writer = None
+        self._writer_lock = threading.RLock()
+        self._open_lock = threading.RLock()
+        self._ready = False
+        self._readers = queue.Queue()
+        self._local = threading.local()
+        self.stats = {'reads': 0, 'writes': 0, 'commits': 0, 'rollbacks': 0, 'read_wait': 0.0, 'write_wait': 0.0}
+
+    def _connect(self, read_only=False):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        if read_only:
+            conn.execute('PRAGMA query_only = 1')
+        if self.plans:
+            conn.set_trace_callback(self.plans.trace)
+        return conn
+
+    def open(self):
+        if self._ready:
+            return
+        with self._open_lock:
+            # Повторный вход из on_open в том же потоке: соединения уже есть, другие потоки ждут на блокировке
+            if self._writer is not None:
+                return
+            self._writer = self._connect()
+            for _ in range(self.readers):
+                self._readers.put(self._connect(read_only=True))
+            try:
+                if self.on_open:
+                    self.on_open()
+            except BaseException:
+                self._close_connections()
+                raise
+            self._ready = True
+
+    @contextmanager
+    def read(self):
+        self.open()
+        if getattr(self._local, 'write_depth', 0):
+            # Внутри транзакции читаем через писателя, чтобы видеть свои изменения
+            cur = self._writer.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+            return
+        reader = getattr(self._local, 'reader', None)
+        owner = reader is None
+        if owner:
+            started = time.perf_counter()
+            reader = self._readers.get()
+            self.stats['read_wait'] += time.perf_counter() - started
+            self.stats['reads'] += 1
+            self._local.reader = reader
+        cur = reader.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+            if owner:
+                self._local.reader = None
+                self._readers.put(reader)
+
+    @contextmanager
+    def write(self):
+        self.open()
+        started = time.perf_counter()
+        batch = None
+        hooks = None
+        with self._writer_lock:
+            depth = getattr(self._local, 'write_depth', 0)
+            if depth == 0:
+                self.stats['write_wait'] += time.perf_counter() - started
+                self.stats['writes'] += 1
+                hooks = self._local.after_write = []
+                if not self._writer.in_transaction:
+                    self._writer.execute('BEGIN')
+            savepoint = f'unit_{depth}'
+            self._writer.execute(f'SAVEPOINT {savepoint}')
+            self._local.write_depth = depth + 1
+            cur = self._writer.cursor()
+            try:
+                yield cur
+            except BaseException:
+                if self._writer.in_transaction:
+                    self._writer.execute(f'ROLLBACK TO {savepoint}')
+                    self._writer.execute(f'RELEASE {savepoint}')
+                    # Пустую транзакцию закрываем, если в ней нет чужих записей, ждущих групповой фиксации
+                    if depth == 0 and self._batch is None:
+                        self._writer.rollback()
+                if depth == 0:
+                    self.stats['rollbacks'] += 1
+                raise
+            else:
+                self._writer.execute(f'RELEASE {savepoint}')
+                if depth == 0:
+                    if self.group_commit:
+                        batch = self._join_batch()
+                    else:
+                        self._writer.commit()
+                        self.stats['commits'] += 1
+            finally:
+                cur.close()
+                self._local.write_depth = depth
+        if batch is not None:
+            # Возвращаемся только после фиксации, чтобы вызывающий видел свои записи в читателях
+            batch['done'].wait()
+            if batch['error']:
+                raise batch['error']
+        for hook in hooks or ():
+            hook()
+
+    def in_write(self):
+        return getattr(self._local, 'write_depth', 0) > 0
+
+    def after_write(self, func):
+        # func выполнится после фиксации текущей транзакции (сразу, если записи нет)
+        if self.in_write():
+            self._local.after_write.append(func)
+        else:
+            func()
+
+    def _join_batch(self):
+        # Первая единица работы в пакете запускает таймер фиксации, остальные присоединяются
+        if self._batch is None:
+            self._batch = {'done': threading.Event(), 'error': None}
+            timer = threading.Timer(self.group_commit, self._commit_batch)
+            timer.daemon = True
+            timer.start()
+        return self._batch
+
+    def _commit_batch(self):
+        with self._writer_lock:
+            batch, self._batch = self._batch, None
+            if batch is None:
+                return
+            try:
+                self._writer.commit()
+                self.stats['commits'] += 1
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка групповой фиксации: {e}")
+                self._writer.rollback()
+                self.stats['rollbacks'] += 1
+                batch['error'] = e
+        batch['done'].set()
+
+    @contextmanager
+    def schema(self):
+        # Для DDL и executescript (он сам фиксирует открытую транзакцию), без точек сохранения
+        self.open()
+        with self._writer_lock:
+            cur = self._writer.cursor()
+            try:
+                yield cur
+            except BaseException:
+                self._writer.rollback()
+                raise
+            else:
+                self._writer.commit()
+            finally:
+                cur.close()
+
+    def close(self):
+        if not self._ready:
+            return
+        # Обновляем статистику планировщика по накопленной нагрузке перед остановкой
+        self._commit_batch()
+        with self._writer_lock:
+            try:
+                self._writer.execute('PRAGMA optimize')
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка PRAGMA optimize: {e}")
+        self._close_connections()
+
+    def _close_connections(self):
+        with self._writer_lock:
+            self._writer.close()
+            self._writer = None
+            self._ready = False
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+
+db = ConnectionPool(DB_PATH)
+
+# Запросы выполняются в пуле потоков, чтобы не блокировать цикл событий бота
+db_executor = ThreadPoolExecutor(max_workers=DB_READERS + 1, thread_name_prefix='db')
+
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+
+# Кэш горячих объектов: пользователи, роли администраторов, настройки уведомлений
+CACHE_SIZE = int(os.environ.get('SOCIAL_CACHE_SIZE', 10000))
+CACHE_TTL = float(os.environ.get('SOCIAL_CACHE_TTL', 300))  # секунд
+
+class LRUCache:
+    # Устаревшие по TTL записи считаются промахом, при переполнении вытесняется давно не использованная.
+    # Значение, прочитанное до инвалидации, в кэш не попадает (сверяем поколение).
+    def __init__(self, name, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key, loader):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._data.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[0]
+            self.stats['misses'] += 1
+            generation = self._generation
+        value = loader()
+        # Незафиксированные данные из транзакции писателя не кэшируем
+        if value is not None and not db.in_write():
+            with self._lock:
+                if generation == self._generation:
+                    self._data[key] = (value, time.monotonic() + self.ttl)
+                    self._data.move_to_end(key)
+                    if len(self._data) > self.maxsize:
+                        self._data.popitem(last=False)
+                        self.stats['evictions'] += 1
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._generation += 1
+            self.stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generation += 1
+
+user_cache = LRUCache('users')
+nickname_cache = LRUCache('nicknames')
+admin_cache = LRUCache('admins')
+notification_settings_cache = LRUCache('notification_settings')
+affinity_cache = LRUCache('affinity')
+hashtag_cache = LRUCache('hashtags', ttl=float('inf'))  # имя -> hashtag_id; хештеги не удаляются и не переименовываются
+CACHES = {cache.name: cache for cache in (user_cache, nickname_cache, admin_cache, notification_settings_cache,
+                                          affinity_cache, hashtag_cache)}
+
+# Многопроцессный режим (SOCIAL_WORKERS > 1): изменения данных в памяти (кэши, блокировки, тренды)
+# применяются в своем процессе и через процесс-маршрутизатор доходят до остальных. Обработчики - в SHARED_EVENTS
+shared_events = None  # очередь событий к маршрутизатору; None в однопроцессном режиме
+shard_index = None    # номер воркера; у маршрутизатора -1
+
+def publish(event, *args):
+    SHARED_EVENTS[event](*args)
+    if shared_events is not None:
+        shared_events.put((shard_index, event, args))
+
+def invalidate_cached(cache, key):
+    # Сбрасываем сразу (чтобы транзакция видела свои изменения) и еще раз после фиксации,
+    # иначе параллельный читатель успеет закэшировать старую строку
+    cache.invalidate(key)
+    db.after_write(lambda: publish('invalidate', cache.name, key))
+
+def cache_stats():
+    return {name: dict(cache.stats, size=len(cache._data)) for name, cache in CACHES.items()}
+
+# Индекс блокировок в памяти: симметричные связи для фильтрации выдачи без запросов к blocks
+class BlockIndex:
+    def __init__(self):
+        self._pairs = set()  # (blocker_id, blocked_id)
+        self._related = {}   # user_id -> пользователи, связанные с ним блокировкой в любую сторону
+        self._lock = threading.Lock()
+
+    def load(self):
+        with db.read() as cursor:
+            rows = cursor.execute('SELECT blocker_id, blocked_id FROM blocks').fetchall()
+        with self._lock:
+            self._pairs.clear()
+            self._related.clear()
+            for blocker_id, blocked_id in rows:
+                self._add(blocker_id, blocked_id)
+
+    def _add(self, blocker_id, blocked_id):
+        self._pairs.add((blocker_id, blocked_id))
+        self._related.setdefault(blocker_id, set()).add(blocked_id)
+        self._related.setdefault(blocked_id, set()).add(blocker_id)
+
+    def add(self, blocker_id, blocked_id):
+        with self._lock:
+            self._add(blocker_id, blocked_id)
+
+    def remove(self, blocker_id, blocked_id):
+        with self._lock:
+            self._pairs.discard((blocker_id, blocked_id))
+            # Связь остается, если есть встречная блокировка
+            if (blocked_id, blocker_id) not in self._pairs:
+                self._related.get(blocker_id, set()).discard(blocked_id)
+                self._related.get(blocked_id, set()).discard(blocker_id)
+
+    def is_blocked(self, blocker_id, blocked_id):
+        return (blocker_id, blocked_id) in self._pairs
+
+    def either(self, user_a, user_b):
+        return user_b in self._related.get(user_a, ())
+
+    def hidden_for(self, user_id):
+        with self._lock:
+            return sorted(self._related.get(user_id, ()))
+
+block_index = BlockIndex()
+
+def block_filter(column, user_id):
+    # Условие "автор не связан блокировкой с user_id" и его параметры для подстановки в запрос
+    hidden = block_index.hidden_for(user_id)
+    if not hidden:
+        return '1', ()
+    return f'{column} NOT IN (SELECT value FROM json_each(?))', (json.dumps(hidden),)
+
+# Тренды хештегов: счетчики в памяти по корзинам времени, суммы окон обновляются при публикации и устаревании корзин
+TREND_BUCKET = 300  # секунд в корзине
+TREND_WINDOWS = {'1h': 3600, '24h': 86400, '7d': 7 * 86400}
+TREND_TOP = 50      # сколько лидеров окна держать готовыми
+
+def trend_bucket(post_date):
+    created = datetime.datetime.fromisoformat(post_date).replace(tzinfo=datetime.timezone.utc).timestamp()
+    return int(created // TREND_BUCKET)
+
+class TrendCounter:
+    def __init__(self):
+        self._buckets = {}  # scope -> {корзина: Counter}; scope None - вся сеть, иначе group_id
+        self._windows = {}  # (scope, окно) -> [первая корзина окна, Counter за окно, готовый топ или None]
+        self._swept = None  # корзина, в которой устаревшие корзины всех групп уже вычищены
+        self._lock = threading.Lock()
+
+    def load(self, upto):
+        # Восстанавливает счетчики за самое длинное окно по постам до upto включительно.
+        # Идет в фоне после запуска: более новые посты уже учтены через add, поэтому загруженное складывается с ними
+        with db.read() as cursor:
+            cursor.execute('''
+            SELECT h.name, p.group_id, p.post_date
+            FROM posts p
+            CROSS JOIN post_hashtags ph ON ph.post_id = p.post_id
+            JOIN hashtags h ON h.hashtag_id = ph.hashtag_id
+            WHERE p.post_date > datetime('now', ?) AND p.post_id <= ?
+            ''', (f'-{max(TREND_WINDOWS.values())} seconds', upto))
+            rows = cursor.fetchall()
+        loaded = {}
+        for name, group_id, post_date in rows:
+            bucket = trend_bucket(post_date)
+            for scope in ((None,) if group_id is None else (None, group_id)):
+                loaded.setdefault(scope, {}).setdefault(bucket, Counter())[name] += 1
+        with self._lock:
+            for scope, buckets in loaded.items():
+                for bucket, counts in self._buckets.get(scope, {}).items():
+                    buckets.setdefault(bucket, Counter()).update(counts)
+                # Корзины держим по возрастанию: _advance забывает устаревшие с начала словаря
+                self._buckets[scope] = dict(sorted(buckets.items()))
+                for window in TREND_WINDOWS:
+                    self._windows.pop((scope, window), None)
+
+    def add(self, tags, group_id, post_date, delta=1):
+        with self._lock:
+            self._add(tags, group_id, trend_bucket(post_date), delta)
+
+    def _add(self, tags, group_id, bucket, delta):
+        self._sweep()
+        scopes = (None,) if group_id is None else (None, group_id)
+        for scope in scopes:
+            self._advance(scope)
+            buckets = self._buckets.get(scope, {})
+            if bucket < self._horizon() or (delta < 0 and bucket not in buckets):
+                continue
+            states = [self._window(scope, window) for window in TREND_WINDOWS]
+            counts = self._buckets.setdefault(scope, {}).setdefault(bucket, Counter())
+            for tag in tags:
+                self._bump(counts, tag, delta)
+            for state in states:
+                if bucket >= state[0]:
+                    for tag in tags:
+                        self._bump(state[1], tag, delta)
+                    state[2] = None
+
+    def _bump(self, counts, tag, delta):
+        count = counts[tag] + delta
+        if count > 0:
+            counts[tag] = count
+        else:
+            del counts[tag]
+
+    def _horizon(self):
+        return int(time.time() // TREND_BUCKET) - max(TREND_WINDOWS.values()) // TREND_BUCKET + 1
+
+    def _window(self, scope, window):
+        state = self._windows.get((scope, window))
+        if state is None:
+            start = int(time.time() // TREND_BUCKET) - TREND_WINDOWS[window] // TREND_BUCKET + 1
+            total = Counter()
+            for bucket, counts in self._buckets.get(scope, {}).items():
+                if bucket >= start:
+                    total.update(counts)
+            state = self._windows[(scope, window)] = [start, total, None]
+        return state
+
+    def _advance(self, scope):
+        # Вычитает из сумм окон корзины, вышедшие за их границу, и забывает корзины старше самого длинного окна
+        now = int(time.time() // TREND_BUCKET)
+        buckets = self._buckets.get(scope, {})
+        for window, length in TREND_WINDOWS.items():
+            state = self._windows.get((scope, window))
+            start = now - length // TREND_BUCKET + 1
+            if state is None or state[0] >= start:
+                continue
+            if start - state[0] >= length // TREND_BUCKET:
+                state[1].clear()
+            else:
+                for bucket in range(state[0], start):
+                    for tag, count in buckets.get(bucket, {}).items():
+                        self._bump(state[1], tag, -count)
+            state[0] = start
+            state[2] = None
+        horizon = self._horizon()
+        while buckets and next(iter(buckets)) < horizon:
+            del buckets[next(iter(buckets))]
+        if scope is not None and not buckets:
+            self._buckets.pop(scope, None)
+            for window in TREND_WINDOWS:
+                self._windows.pop((scope, window), None)
+
+    def _sweep(self):
+        # Раз в корзину вычищает группы, в которых давно не было постов
+        now = int(time.time() // TREND_BUCKET)
+        if self._swept != now:
+            self._swept = now
+            for scope in list(self._buckets):
+                self._advance(scope)
+
+    def top(self, window='24h', group_id=None, limit=10):
+        # [(хештег, число постов)] за окно; топ пересчитывается только после изменений
+        if window not in TREND_WINDOWS:
+            raise ValueError(f"Неизвестное окно трендов: {window}")
+        with self._lock:
+            self._advance(group_id)
+            if group_id is not None and group_id not in self._buckets:
+                return []
+            state = self._window(group_id, window)
+            if state[2] is None or (len(state[2]) < limit < len(state[1])):
+                state[2] = heapq.nlargest(max(TREND_TOP, limit), state[1].items(), key=lambda item: (item[1], item[0]))
+            return state[2][:limit]
+
+    def metrics(self):
+        with self._lock:
+            self._sweep()
+            return {'scopes': len(self._buckets), 'buckets': sum(len(buckets) for buckets in self._buckets.values())}
+
+trends = TrendCounter()
+
+# Добавление колонок в таблицы, созданные прошлыми версиями
+def add_column_if_missing(cursor, table, column, definition):
+    columns = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})')]
+    if column in columns:
+        return False
+    cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
+# Настройки материализованной ленты
+FEED_FANOUT_LIMIT = 5000  # Больше получателей - посты автора/группы читаются при показе ленты
+FEED_BACKFILL_LIMIT = 50  # Сколько последних постов добавлять при новой дружбе или вступлении в группу
+FEED_TIMELINE_LIMIT = 1000  # Лента каждого пользователя обрезается в фоне до стольких записей; старше - pull
+FEED_PRUNE_BATCH = 500  # пользователей за одну транзакцию обрезки
+FEED_PRUNE_PAUSE = 0.01  # секунд между порциями
+FEED_PRUNE_INTERVAL = 3600  # секунд между проходами
+
+# Ранжирование умной ленты. Вес поста затухает экспоненциально: score(t) = engagement * 2^(-(t - created) / half_life).
+# Хранится его логарифм без текущего времени: ln(engagement) + created * ln2 / half_life.
+# Порядок постов от времени не зависит, поэтому ранг лежит в колонке posts.rank под индексом
+RANKING_WEIGHTS = {
+    'base': 10.0,       # вес нового поста без реакций
+    'like': 2.0,
+    'comment': 3.0,
+    'repost': 4.0,
+    'bookmark': 1.0,
+    'affinity': 1.0,    # усиление постов с хештегами из интересов пользователя (1.0 - как пост на half_life моложе)
+}
+RANKING_WEIGHTS.update(json.loads(os.environ.get('SOCIAL_RANKING_WEIGHTS', '{}')))
+RANKING_HALF_LIFE = float(os.environ.get('SOCIAL_RANKING_HALF_LIFE', 86400))  # секунд
+RANK_SCALE = 10000  # ранг в ключе страницы хранится целым числом
+AFFINITY_SIGNALS = {'post': 1.0, 'comment': 0.75, 'like': 0.5}
+AFFINITY_TOP = 20       # хештегов в векторе интересов (для усиления)
+AFFINITY_FEED_TAGS = 5  # по скольким самым весомым из них искать посты вне друзей и групп
+SMART_FEED_CANDIDATES = 10  # кандидатов из каждого источника на один показываемый пост
+
+def post_rank(like_count, comment_count, repost_count, bookmark_count, post_date):
+    weights = RANKING_WEIGHTS
+    engagement = (weights['base'] + weights['like'] * (like_count or 0) + weights['comment'] * (comment_count or 0)
+                  + weights['repost'] * (repost_count or 0) + weights['bookmark'] * (bookmark_count or 0))
+    created = datetime.datetime.fromisoformat(post_date).replace(tzinfo=datetime.timezone.utc).timestamp()
+    return math.log(max(engagement, 1e-9)) + created * math.log(2) / RANKING_HALF_LIFE
+
+def rerank_range(cursor, last_id, upto):
+    cursor.execute('''
+    SELECT post_id, like_count, comment_count, repost_count, bookmark_count, post_date
+    FROM posts WHERE post_id > ? AND post_id <= ?
+    ''', (last_id, upto))
+    cursor.executemany('UPDATE posts SET rank = ? WHERE post_id = ?',
+                       [(post_rank(*row[1:]), row[0]) for row in cursor.fetchall()])
+
+def rerank_posts(cursor, batch=5000):
+    # Полный пересчет рангов при смене весов
+    last_id = 0
+    while True:
+        upto = cursor.execute('''
+        SELECT MAX(post_id) FROM (SELECT post_id FROM posts WHERE post_id > ? ORDER BY post_id LIMIT ?)
+        ''', (last_id, batch)).fetchone()[0]
+        if upto is None:
+            return
+        rerank_range(cursor, last_id, upto)
+        last_id = upto
+
+# Достижения: событие -> (счетчик в user_stats, [(порог, тип, описание)]).
+# Событие увеличивает счетчик, значок выдается при достижении порога ровно один раз
+ACHIEVEMENT_RULES = {
+    'post_created': ('post_count', [(10, 'active_poster', 'Опубликовал 10 постов'),
+                                    (100, 'prolific_poster', 'Опубликовал 100 постов')]),
+    'friend_accepted': ('friend_count', [(5, 'social_butterfly', 'Завел 5 друзей')]),
+    'group_created': ('groups_created', [(3, 'group_leader', 'Создал 3 группы')]),
+    'purchase_made': ('purchases', [(1, 'first_purchase', 'Совершил первую покупку')]),
+}
+# Как заполнить новый счетчик по существующим данным
+ACHIEVEMENT_COUNTER_BACKFILL = {
+    'friend_count': "SELECT user_id, COUNT(*) FROM friends WHERE status = 'accepted' GROUP BY user_id",
+    'groups_created': 'SELECT creator_id, COUNT(*) FROM groups GROUP BY creator_id',
+}
+
+# Составные индексы под горячие запросы (порядок колонок - как в WHERE и ORDER BY). Набор сверяется при каждом
+# запуске (sync_indexes): недостающие строятся, индексы из RETIRED_INDEXES удаляются, но только когда
+# заменивший их более широкий индекс уже построен - иначе до конца фоновой сборки запросы шли бы полным просмотром
+SCHEMA_INDEXES = {
+    'idx_posts_date': 'posts(post_date, post_id)',
+    'idx_posts_user_date': 'posts(user_id, post_date, post_id)',
+    'idx_posts_group_date': 'posts(group_id, post_date, post_id)',
+    'idx_comments_post': 'comments(post_id, comment_date)',
+    'idx_bookmarks_post': 'bookmarks(post_id)',
+    'idx_notifications_user_read': 'notifications(user_id, is_read, notification_date)',
+    'idx_messages_receiver_time': 'messages(receiver_id, timestamp, message_id)',
+    'idx_messages_sender_time': 'messages(sender_id, timestamp, message_id)',
+    'idx_marketplace_status_date': 'marketplace(status, created_at, item_id)',
+    'idx_marketplace_seller_status': 'marketplace(seller_id, status, created_at, item_id)',
+    'idx_ads_status_date': 'ads(status, created_at)',
+    'idx_stories_user_expires': 'stories(user_id, expires_at)',
+}
+RETIRED_INDEXES = {  # устаревший индекс -> индекс, который его заменяет
+    'idx_posts_user': 'idx_posts_user_date',
+    'idx_notifications_user': 'idx_notifications_user_read',
+    'idx_messages_receiver': 'idx_messages_receiver_time',
+    'idx_marketplace_seller': 'idx_marketplace_seller_status',
+}
+
+# Полнотекстовый поиск: FTS-таблица -> (исходная таблица, ключ, индексируемые колонки)
+SEARCH_INDEXES = {
+    'posts_fts': ('posts', 'post_id', ('content',)),
+    'users_fts': ('users', 'user_id', ('nickname', 'bio')),
+    'groups_fts': ('groups', 'group_id', ('name', 'description')),
+    'market_fts': ('marketplace', 'item_id', ('title', 'description')),
+}
+SEARCH_TOKENIZER = "unicode61 remove_diacritics 2 tokenchars '_'"
+
+def fold_yo(expr):
+    # unicode61 не приравнивает ё к е, поэтому нормализуем текст до индексации
+    return f"replace(replace({expr}, 'ё', 'е'), 'Ё', 'Е')"
+
+def create_search_index(cursor, fts_table, source, id_column, columns):
+    column_list = ', '.join(columns)
+    new_values = ', '.join(fold_yo(f'new.{column}') for column in columns)
+    cursor.execute(f'''
+    CREATE VIRTUAL TABLE {fts_table} USING fts5({column_list}, tokenize="{SEARCH_TOKENIZER}", prefix='2 3')
+    ''')
+    execute_script(cursor, f'''
+    CREATE TRIGGER {fts_table}_insert AFTER INSERT ON {source} BEGIN
+        INSERT INTO {fts_table} (rowid, {column_list}) VALUES (new.{id_column}, {new_values});
+    END;
+    CREATE TRIGGER {fts_table}_delete AFTER DELETE ON {source} BEGIN
+        DELETE FROM {fts_table} WHERE rowid = old.{id_column};
+    END;
+    CREATE TRIGGER {fts_table}_update AFTER UPDATE OF {column_list} ON {source} BEGIN
+        DELETE FROM {fts_table} WHERE rowid = old.{id_column};
+        INSERT INTO {fts_table} (rowid, {column_list}) VALUES (new.{id_column}, {new_values});
+    END;
+    ''')
+    # Строки, существовавшие до создания индекса, проиндексирует фоновый шаг миграции
+    schedule_backfill(cursor, fts_table)
+
+# Миграции схемы. Номер последней примененной хранится в PRAGMA user_version, каждая миграция - одна транзакция.
+# Сами миграции делают только быстрые шаги (таблицы, ALTER TABLE ADD COLUMN, индексы на пустых таблицах),
+# поэтому запуск не зависит от размера базы. Заполнение по существующим строкам и индексы на непустых таблицах
+# ставятся в schema_backfill и выполняются в фоне порциями (run_backfills).
+# База без user_version (созданная до миграций) проходит их все: шаги идемпотентны.
+# Новое изменение схемы - новая функция в конце MIGRATIONS
+BACKFILL_BATCH = int(os.environ.get('SOCIAL_BACKFILL_BATCH', 2000))
+
+def execute_script(cursor, script):
+    # Как executescript, но внутри текущей транзакции (executescript сначала фиксирует ее)
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            cursor.execute(statement)
+            statement = ''
+
+def schedule_backfill(cursor, name, sql=None):
+    # Строки, созданные после этого момента, обрабатывает сам код, поэтому граница - текущий максимум ключа
+    if sql is not None:
+        cursor.execute('INSERT OR IGNORE INTO schema_backfill (name, sql) VALUES (?, ?)', (name, sql))
+        return
+    source, id_column, _ = BACKFILLS[name]
+    # Отдельный MAX читает одну строку индекса (с HAVING SQLite просматривал бы таблицу целиком)
+    max_id = cursor.execute(f'SELECT MAX({id_column}) FROM {source}').fetchone()[0]
+    if max_id is not None:
+        cursor.execute('INSERT OR IGNORE INTO schema_backfill (name, last_id, max_id) VALUES (?, 0, ?)', (name, max_id))
+
+def index_exists(cursor, name):
+    return cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)).fetchone() is not None
+
+def create_index(cursor, name, definition, unique=False):
+    if index_exists(cursor, name):
+        return
+    sql = f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {definition}"
+    table = definition.split('(', 1)[0]
+    if cursor.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone() is None:
+        cursor.execute(sql)
+    else:
+        schedule_backfill(cursor, name, sql)
+
+def drop_retired_indexes(cursor):
+    for name, replacement in RETIRED_INDEXES.items():
+        if index_exists(cursor, replacement):
+            cursor.execute(f'DROP INDEX IF EXISTS {name}')
+
+def sync_indexes(cursor):
+    for name, definition in SCHEMA_INDEXES.items():
+        create_index(cursor, name, definition)
+    # Замененные индексы, чьи преемники отложены в фон, удалит run_backfills сразу после их построения
+    drop_retired_indexes(cursor)
+
+# Порционные шаги: имя -> (таблица, ключ, функция(cursor, last_id, upto) для строк с last_id < ключ <= upto)
+def fill_post_counters(cursor, last_id, upto):
+    # Связь репостов раньше не хранилась, поэтому repost_count не восстанавливается
+    cursor.execute('''
+    UPDATE posts SET
+        like_count = (SELECT COUNT(*) FROM likes WHERE likes.post_id = posts.post_id),
+        comment_count = (SELECT COUNT(*) FROM comments WHERE comments.post_id = posts.post_id),
+        bookmark_count = (SELECT COUNT(*) FROM bookmarks WHERE bookmarks.post_id = posts.post_id)
+    WHERE post_id > ? AND post_id <= ?
+    ''', (last_id, upto))
+
+def fill_user_stats(cursor, last_id, upto):
+    cursor.execute('''
+    INSERT INTO user_stats (user_id, post_count, likes_received, comments_received, reposts_received,
+                            bookmarks_received, friend_count, groups_created)
+    SELECT u.user_id, COUNT(p.post_id), TOTAL(p.like_count), TOTAL(p.comment_count), TOTAL(p.repost_count),
+           TOTAL(p.bookmark_count),
+           (SELECT COUNT(*) FROM friends f WHERE f.user_id = u.user_id AND f.status = 'accepted'),
+           (SELECT COUNT(*) FROM groups g WHERE g.creator_id = u.user_id)
+    FROM users u
+    LEFT JOIN posts p ON p.user_id = u.user_id
+    WHERE u.user_id > ? AND u.user_id <= ?
+    GROUP BY u.user_id
+    ON CONFLICT (user_id) DO UPDATE SET
+        post_count = excluded.post_count, likes_received = excluded.likes_received,
+        comments_received = excluded.comments_received, reposts_received = excluded.reposts_received,
+        bookmarks_received = excluded.bookmarks_received, friend_count = excluded.friend_count,
+        groups_created = excluded.groups_created
+    ''', (last_id, upto))
+
+def fill_achievements(cursor, last_id, upto):
+    # Значки, заработанные по счетчикам до появления событий
+    for column, thresholds in ACHIEVEMENT_RULES.values():
+        for threshold, type, description in thresholds:
+            cursor.execute(f'''
+            INSERT OR IGNORE INTO achievements (user_id, type, description)
+            SELECT user_id, ?, ? FROM user_stats WHERE user_id > ? AND user_id <= ? AND {column} >= ?
+            ''', (type, description, last_id, upto, threshold))
+
+def dedupe_achievements(cursor, last_id, upto):
+    # Раньше значки выдавались повторно: из каждой пары (пользователь, тип) остается первый
+    cursor.execute('''
+    DELETE FROM achievements
+    WHERE achievement_id > ? AND achievement_id <= ?
+    AND EXISTS (SELECT 1 FROM achievements a
+                WHERE a.user_id = achievements.user_id AND a.type = achievements.type
+                AND a.achievement_id < achievements.achievement_id)
+    ''', (last_id, upto))
+
+def finish_achievement_dedupe(cursor, max_id):
+    # Дубли, выданные после постановки шага в очередь, убираем в той же транзакции, что строит уникальный индекс,
+    # иначе обработчики успеют выдать новые. Значки по счетчикам выдаются уже с индексом (INSERT OR IGNORE)
+    upto = cursor.execute('SELECT MAX(achievement_id) FROM achievements').fetchone()[0]
+    if upto is not None and upto > max_id:
+        dedupe_achievements(cursor, max_id, upto)
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_achievements_unique ON achievements(user_id, type)')
+    cursor.execute('DROP INDEX IF EXISTS idx_achievements_user_type')
+    schedule_backfill(cursor, 'achievements')
+
+def fill_hashtag_affinity(cursor, last_id, upto):
+    cursor.execute('''
+    INSERT INTO user_hashtag_affinity (user_id, hashtag_id, weight)
+    SELECT p.user_id, ph.hashtag_id, COUNT(*) * ?
+    FROM posts p
+    JOIN post_hashtags ph ON ph.post_id = p.post_id
+    WHERE p.post_id > ? AND p.post_id <= ?
+    GROUP BY p.user_id, ph.hashtag_id
+    ON CONFLICT (user_id, hashtag_id) DO UPDATE SET weight = weight + excluded.weight
+    ''', (AFFINITY_SIGNALS['post'], last_id, upto))
+    db.after_write(lambda: publish('clear', affinity_cache.name))
+
+def fill_timeline_friends(cursor, last_id, upto):
+    cursor.execute('''
+    INSERT OR IGNORE INTO feed_timeline (user_id, post_id, author_id, post_date)
+    SELECT f.user_id, p.post_id, p.user_id, p.post_date
+    FROM friends f
+    JOIN posts p ON p.user_id = f.friend_id
+    WHERE f.status = 'accepted' AND f.id > ? AND f.id <= ?
+    ''', (last_id, upto))
+
+def fill_timeline_groups(cursor, last_id, upto):
+    cursor.execute('''
+    INSERT OR IGNORE INTO feed_timeline (user_id, post_id, author_id, post_date)
+    SELECT gm.user_id, p.post_id, p.user_id, p.post_date
+    FROM group_members gm
+    JOIN posts p ON p.group_id = gm.group_id
+    WHERE gm.rowid > ? AND gm.rowid <= ?
+    AND NOT EXISTS (SELECT 1 FROM blocks
+                    WHERE (blocker_id = gm.user_id AND blocked_id = p.user_id)
+                    OR (blocker_id = p.user_id AND blocked_id = gm.user_id))
+    ''', (last_id, upto))
+
+def fill_search_index(fts_table, cursor, last_id, upto):
+    source, id_column, columns = SEARCH_INDEXES[fts_table]
+    column_list = ', '.join(columns)
+    folded = ', '.join(fold_yo(column) for column in columns)
+    cursor.execute(f'''
+    INSERT INTO {fts_table} (rowid, {column_list})
+    SELECT {id_column}, {folded} FROM {source}
+    WHERE {id_column} > ? AND {id_column} <= ?
+    AND {id_column} NOT IN (SELECT rowid FROM {fts_table} WHERE rowid > ? AND rowid <= ?)
+    ''', (last_id, upto, last_id, upto))
+
+BACKFILLS = {
+    'post_counters': ('posts', 'post_id', fill_post_counters),
+    'user_stats': ('users', 'user_id', fill_user_stats),
+    'achievement_duplicates': ('achievements', 'achievement_id', dedupe_achievements),
+    'achievements': ('users', 'user_id', fill_achievements),
+    'post_ranks': ('posts', 'post_id', rerank_range),
+    'hashtag_affinity': ('posts', 'post_id', fill_hashtag_affinity),
+    'timeline_friends': ('friends', 'id', fill_timeline_friends),
+    'timeline_groups': ('group_members', 'rowid', fill_timeline_groups),
+}
+for fts_table, (source, id_column, _) in SEARCH_INDEXES.items():
+    BACKFILLS[fts_table] = (source, id_column, functools.partial(fill_search_index, fts_table))
+# Что сделать в транзакции последней порции шага: имя -> функция(cursor, max_id)
+BACKFILL_FINISH = {
+    'achievement_duplicates': finish_achievement_dedupe,
+}
+
+def migrate_base_tables(cursor):
+    execute_script(cursor, '''
+    -- Основные таблицы
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        nickname TEXT UNIQUE,
+        reg_date TEXT,
+        last_seen TEXT,
+        is_private BOOLEAN DEFAULT 0,
+        bio TEXT DEFAULT ''
+    );
+
+    CREATE TABLE IF NOT EXISTS friends (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        friend_id INTEGER,
+        status TEXT CHECK(status IN ('pending', 'accepted', 'rejected')) DEFAULT 'pending',
+        created_at TEXT DEFAULT (datetime('now')),
+        FOREIGN KEY (user_id) REFERENCES users(user_id),
+        FOREIGN KEY (friend_id) REFERENCES users(user_id),
+        UNIQUE(user_id, friend_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS posts (
+        post_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        content TEXT,
+        post_date TEXT,
+        group_id INTEGER,
+        media_type TEXT,  -- 'photo', 'video', 'document', 'sticker'
+        media_id TEXT,
+        repost_of INTEGER,
+        like_count INTEGER DEFAULT 0,
+        comment_count INTEGER DEFAULT 0,
+        repost_count INTEGER DEFAULT 0,
+        bookmark_count INTEGER DEFAULT 0,
+        FOREIGN KEY (user_id) REFERENCES users(user_id),
+        FOREIGN KEY (group_id) REFERENCES groups(group_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS hashtags (
+        hashtag_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE
+    );
+
+    CREATE TABLE IF NOT EXISTS post_hashtags (
+        post_id INTEGER,
+        hashtag_id INTEGER,
+        PRIMARY KEY (post_id, hashtag_id),
+        FOREIGN KEY (post_id) REFERENCES posts(post_id),
+        FOREIGN KEY (hashtag_id) REFERENCES hashtags(hashtag_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS likes (
+        like_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        post_id INTEGER,
+        user_id INTEGER,
+        like_date TEXT,
+        reaction TEXT DEFAULT 'like',
+        FOREIGN KEY (post_id) REFERENCES posts(post_id),
+        FOREIGN KEY (user_id) REFERENCES users(user_id),
+        UNIQUE(post_id, user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS comments (
+        comment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        post_id INTEGER,
+        user_id INTEGER,
+        content TEXT,
+        comment_date TEXT,
+        FOREIGN KEY (post_id) REFERENCES posts(post_id),
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS notifications (
+        notification_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        type TEXT,
+        content TEXT,
+        related_id INTEGER,
+        notification_date TEXT,
+        is_read INTEGER DEFAULT 0,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS messages (
+        message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender_id INTEGER,
+        receiver_id INTEGER,
+        content TEXT,
+        timestamp TEXT,
+        is_read BOOLEAN DEFAULT 0,
+        FOREIGN KEY (sender_id) REFERENCES users(user_id),
+        FOREIGN KEY (receiver_id) REFERENCES users(user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS groups (
+        group_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        creator_id INTEGER,
+        description TEXT,
+        is_public BOOLEAN DEFAULT 1,
+        FOREIGN KEY (creator_id) REFERENCES users(user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS group_members (
+        group_id INTEGER,
+        user_id INTEGER,
+        role TEXT CHECK(role IN ('admin', 'moderator', 'member')) DEFAULT 'member',
+        joined_at TEXT DEFAULT (datetime('now')),
+        PRIMARY KEY (group_id, user_id),
+        FOREIGN KEY (group_id) REFERENCES groups(group_id),
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS blocks (
+        blocker_id INTEGER,
+        blocked_id INTEGER,
+        created_at TEXT DEFAULT (datetime('now')),
+        PRIMARY KEY (blocker_id, blocked_id),
+        FOREIGN KEY (blocker_id) REFERENCES users(user_id),
+        FOREIGN KEY (blocked_id) REFERENCES users(user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS currencies (
+        user_id INTEGER PRIMARY KEY,
+        balance INTEGER DEFAULT 0,
+        last_claim TEXT,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS reports (
+        report_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        reporter_id INTEGER,
+        target_id INTEGER,
+        target_type TEXT CHECK(target_type IN ('post', 'user', 'item', 'ad')),
+        reason TEXT,
+        report_date TEXT DEFAULT (datetime('now')),
+        FOREIGN KEY (reporter_id) REFERENCES users(user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS bookmarks (
+        bookmark_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        post_id INTEGER,
+        created_at TEXT DEFAULT (datetime('now')),
+        FOREIGN KEY (user_id) REFERENCES users(user_id),
+        FOREIGN KEY (post_id) REFERENCES posts(post_id),
+        UNIQUE(user_id, post_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS marketplace (
+        item_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        seller_id INTEGER,
+        title TEXT,
+        description TEXT,
+        price INTEGER,
+        created_at TEXT DEFAULT (datetime('now')),
+        status TEXT CHECK(status IN ('active', 'sold', 'cancelled')) DEFAULT 'active',
+        media_id TEXT,
+        media_type TEXT,
+        FOREIGN KEY (seller_id) REFERENCES users(user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS ads (
+        ad_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        creator_id INTEGER,
+        content TEXT,
+        price INTEGER,
+        created_at TEXT DEFAULT (datetime('now')),
+        status TEXT CHECK(status IN ('pending', 'approved', 'rejected', 'active', 'expired')) DEFAULT 'pending',
+        media_id TEXT,
+        media_type TEXT,
+        FOREIGN KEY (creator_id) REFERENCES users(user_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS admins (
+        user_id INTEGER PRIMARY KEY,
+        role TEXT CHECK(role IN ('admin', 'moderator', 'superadmin')) DEFAULT 'admin',
+        appointed_at TEXT DEFAULT (datetime('now')),
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    );
+
+    -- Новые таблицы для историй
+    CREATE TABLE IF NOT EXISTS stories (
+        story_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        media_id TEXT,
+        media_type TEXT CHECK(media_type IN ('photo', 'video', 'text')),
+        content TEXT,
+        created_at TEXT DEFAULT (datetime('now')),
+        expires_at TEXT DEFAULT (datetime('now', '+24 hours')),
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    );
+
+    -- Новые таблицы для трансляций
+    CREATE TABLE IF NOT EXISTS live_streams (
+        stream_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        group_id INTEGER,
+        title TEXT,
+        started_at TEXT DEFAULT (datetime('now')),
+        status TEXT CHECK(status IN ('active', 'ended')) DEFAULT 'active',
+        FOREIGN KEY (user_id) REFERENCES users(user_id),
+        FOREIGN KEY (group_id) REFERENCES groups(group_id)
+    );
+
+    -- Новые таблицы для достижений
+    CREATE TABLE IF NOT EXISTS achievements (
+        achievement_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        type TEXT,
+        description TEXT,
+        earned_at TEXT DEFAULT (datetime('now')),
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    );
+
+    -- Новые таблицы для настроек уведомлений
+    CREATE TABLE IF NOT EXISTS notification_settings (
+        user_id INTEGER PRIMARY KEY,
+        notify_likes BOOLEAN DEFAULT 1,
+        notify_comments BOOLEAN DEFAULT 1,
+        notify_mentions BOOLEAN DEFAULT 1,
+        notify_friend_requests BOOLEAN DEFAULT 1,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    );
+
+    -- Счетчики пользователя (поддерживаются при каждом действии)
+    CREATE TABLE IF NOT EXISTS user_stats (
+        user_id INTEGER PRIMARY KEY,
+        post_count INTEGER DEFAULT 0,
+        likes_received INTEGER DEFAULT 0,
+        comments_received INTEGER DEFAULT 0,
+        reposts_received INTEGER DEFAULT 0,
+        bookmarks_received INTEGER DEFAULT 0,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    );
+
+    -- Материализованная лента (fan-out on write)
+    CREATE TABLE IF NOT EXISTS feed_timeline (
+        user_id INTEGER,
+        post_id INTEGER,
+        author_id INTEGER,
+        post_date TEXT,
+        PRIMARY KEY (user_id, post_id)
+    ) WITHOUT ROWID;
+
+    -- Авторы и группы, посты которых читаются при показе ленты (pull)
+    CREATE TABLE IF NOT EXISTS feed_pull_sources (
+        source_type TEXT CHECK(source_type IN ('user', 'group')),
+        source_id INTEGER,
+        PRIMARY KEY (source_type, source_id)
+    ) WITHOUT ROWID;
+
+    -- Граница обрезки ленты: записи старше (post_date, post_id) удалены, такие посты читаются напрямую
+    CREATE TABLE IF NOT EXISTS feed_horizons (
+        user_id INTEGER PRIMARY KEY,
+        post_date TEXT,
+        post_id INTEGER
+    );
+
+    -- Отложенные шаги миграций: порционное заполнение и построение индексов в фоне
+    CREATE TABLE IF NOT EXISTS schema_backfill (
+        name TEXT PRIMARY KEY,
+        last_id INTEGER DEFAULT 0,
+        max_id INTEGER,
+        sql TEXT
+    );
+
+    -- Индексы
+    CREATE INDEX IF NOT EXISTS idx_feed_timeline_user_date ON feed_timeline(user_id, post_date DESC, post_id DESC);
+    CREATE INDEX IF NOT EXISTS idx_feed_timeline_user_author ON feed_timeline(user_id, author_id);
+    CREATE INDEX IF NOT EXISTS idx_feed_timeline_post ON feed_timeline(post_id);
+    CREATE INDEX IF NOT EXISTS idx_friends_user ON friends(user_id);
+    CREATE INDEX IF NOT EXISTS idx_friends_friend ON friends(friend_id);
+    CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members(user_id);
+    CREATE INDEX IF NOT EXISTS idx_bookmarks_user ON bookmarks(user_id);
+    CREATE INDEX IF NOT EXISTS idx_ads_creator ON ads(creator_id);
+    ''')
+
+def migrate_notification_coalescing(cursor):
+    add_column_if_missing(cursor, 'notifications', 'actor_ids', 'TEXT')
+    add_column_if_missing(cursor, 'notifications', 'event_count', 'INTEGER DEFAULT 1')
+    create_index(cursor, 'idx_notifications_unread', 'notifications(user_id, type, related_id) WHERE is_read = 0')
+
+def migrate_post_counters(cursor):
+    counters_added = False
+    for column, definition in (('repost_of', 'INTEGER'),
+                               ('like_count', 'INTEGER DEFAULT 0'),
+                               ('comment_count', 'INTEGER DEFAULT 0'),
+                               ('repost_count', 'INTEGER DEFAULT 0'),
+                               ('bookmark_count', 'INTEGER DEFAULT 0')):
+        counters_added = add_column_if_missing(cursor, 'posts', column, definition) or counters_added
+    # Индекс нужен пересчету user_stats (группы по создателю), поэтому ставится в очередь раньше него
+    create_index(cursor, 'idx_groups_creator', 'groups(creator_id)')
+    if counters_added:
+        schedule_backfill(cursor, 'post_counters')
+        schedule_backfill(cursor, 'user_stats')
+
+def migrate_achievement_counters(cursor):
+    counters_added = False
+    for column in ('friend_count', 'groups_created', 'purchases'):
+        counters_added = add_column_if_missing(cursor, 'user_stats', column, 'INTEGER DEFAULT 0') or counters_added
+    if counters_added:
+        schedule_backfill(cursor, 'user_stats')
+    if not index_exists(cursor, 'idx_achievements_unique'):
+        # Уникальный индекс строится после фонового удаления дублей, затем фоновый шаг выдает значки по счетчикам.
+        # Неуникальный индекс (строится в фоне первым) нужен удалению дублей и запросам до появления уникального
+        if cursor.execute('SELECT 1 FROM achievements LIMIT 1').fetchone() is None:
+            finish_achievement_dedupe(cursor, 0)
+        else:
+            create_index(cursor, 'idx_achievements_user_type', 'achievements(user_id, type)')
+            schedule_backfill(cursor, 'achievement_duplicates')
+
+def migrate_ranking(cursor):
+    if add_column_if_missing(cursor, 'posts', 'rank', 'REAL'):
+        schedule_backfill(cursor, 'post_ranks')
+    create_index(cursor, 'idx_posts_popular', 'posts((like_count + comment_count) DESC, post_date DESC, post_id DESC)')
+    create_index(cursor, 'idx_posts_repost_of', 'posts(repost_of)')
+    create_index(cursor, 'idx_posts_user_rank', 'posts(user_id, rank, post_date)')
+    create_index(cursor, 'idx_posts_group_rank', 'posts(group_id, rank, post_date, user_id)')
+    create_index(cursor, 'idx_post_hashtags_tag', 'post_hashtags(hashtag_id, post_id)')
+
+    # Интересы пользователя: накопленный вес хештегов из его постов, реакций и комментариев
+    if cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'user_hashtag_affinity'").fetchone() is None:
+        cursor.execute('''
+        CREATE TABLE user_hashtag_affinity (
+            user_id INTEGER,
+            hashtag_id INTEGER,
+            weight REAL,
+            PRIMARY KEY (user_id, hashtag_id)
+        ) WITHOUT ROWID
+        ''')
+        schedule_backfill(cursor, 'hashtag_affinity')
+
+def migrate_feed_timeline(cursor):
+    # Первичное заполнение ленты для базы, созданной до появления feed_timeline
+    if cursor.execute('SELECT 1 FROM feed_timeline LIMIT 1').fetchone() is None:
+        schedule_backfill(cursor, 'timeline_friends')
+        schedule_backfill(cursor, 'timeline_groups')
+
+def migrate_background_jobs(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        group_id INTEGER,
+        type TEXT,
+        content TEXT,
+        related_id INTEGER,
+        last_user_id INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        total INTEGER,
+        status TEXT CHECK(status IN ('pending', 'done')) DEFAULT 'pending',
+        created_at TEXT DEFAULT (datetime('now'))
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS user_state (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT,
+        updated_at REAL
+    )
+    ''')
+    create_index(cursor, 'idx_user_state_updated', 'user_state(updated_at)')
+
+def migrate_search(cursor):
+    # Незаконченное заполнение из прежней таблицы search_backfill переносится в общую очередь
+    if cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'search_backfill'").fetchone():
+        cursor.execute('''
+        INSERT OR IGNORE INTO schema_backfill (name, last_id, max_id)
+        SELECT fts_table, last_id, max_id FROM search_backfill
+        ''')
+        cursor.execute('DROP TABLE search_backfill')
+    for fts_table, (source, id_column, columns) in SEARCH_INDEXES.items():
+        if cursor.execute('SELECT 1 FROM sqlite_master WHERE name = ?', (fts_table,)).fetchone() is None:
+            create_search_index(cursor, fts_table, source, id_column, columns)
+
+MIGRATIONS = [
+    migrate_base_tables,
+    migrate_notification_coalescing,
+    migrate_post_counters,
+    migrate_achievement_counters,
+    migrate_ranking,
+    migrate_feed_timeline,
+    migrate_background_jobs,
+    migrate_search,
+]
+
+def migrate():
+    with db.schema() as cursor:
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+    if version > len(MIGRATIONS):
+        raise RuntimeError(f"Схема базы (версия {version}) новее кода (версия {len(MIGRATIONS)})")
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        with db.schema() as cursor:
+            cursor.execute('BEGIN')
+            migration(cursor)
+            cursor.execute(f'PRAGMA user_version = {number}')
+        logger.info(f"Применена миграция {number}: {migration.__name__}")
+    with db.schema() as cursor:
+        cursor.execute('BEGIN')
+        sync_indexes(cursor)
+
+def backfill_step(batch=BACKFILL_BATCH):
+    # Один отложенный шаг миграций в порядке очереди; False - очередь пуста.
+    # Индексы строятся раньше порционных шагов: те читают по этим индексам, а простой записи случается один раз и в начале
+    with db.write() as cursor:
+        row = cursor.execute(
+            'SELECT name, last_id, max_id, sql FROM schema_backfill ORDER BY sql IS NULL, rowid LIMIT 1'
+        ).fetchone()
+        if row is None:
+            return False
+        name, last_id, max_id, sql = row
+        upto = None
+        if sql is not None:
+            # SQLite строит индекс одним запросом, поэтому это единственный шаг без порций: все это время
+            # запись в базу (из всех процессов) ждет, и это видно в логе
+            table = sql.split(' ON ', 1)[1].split('(', 1)[0]
+            rows = cursor.execute(f'SELECT MAX(rowid) FROM {table}').fetchone()[0]
+            logger.warning(f"Строится индекс {name} по {table} (~{rows} строк), запись в базу приостановлена")
+            started = time.perf_counter()
+            cursor.execute(sql)
+            drop_retired_indexes(cursor)
+            logger.info(f"Индекс {name} построен за {time.perf_counter() - started:.1f} с")
+        else:
+            source, id_column, fill = BACKFILLS[name]
+            cursor.execute(f'''
+            SELECT MAX({id_column}) FROM (
+                SELECT {id_column} FROM {source}
+                WHERE {id_column} > ? AND {id_column} <= ?
+                ORDER BY {id_column}
+                LIMIT ?
+            )
+            ''', (last_id, max_id, batch))
+            upto = cursor.fetchone()[0]
+        if upto is None:
+            cursor.execute('DELETE FROM schema_backfill WHERE name = ?', (name,))
+            if name in BACKFILL_FINISH:
+                BACKFILL_FINISH[name](cursor, max_id)
+            logger.info(f"Фоновый шаг миграции {name} завершен")
+            return True
+        fill(cursor, last_id, upto)
+        cursor.execute('UPDATE schema_backfill SET last_id = ? WHERE name = ?', (upto, name))
+    return True
+
+def run_backfills(batch=BACKFILL_BATCH):
+    # Между шагами блокировка писателя отдается обработчикам
+    while backfill_step(batch):
+        time.sleep(0.01)
+
+def get_backfill_progress():
+    with db.read() as cursor:
+        cursor.execute('SELECT name, last_id, max_id FROM schema_backfill ORDER BY sql IS NULL, rowid')
+        return cursor.fetchall()
+
+def prepare_database():
+    # Вызывается пулом при первом подключении: до него ни один обработчик не видит базу.
+    # Воркеры многопроцессного режима открывают базу, которую маршрутизатор уже обновил
+    if shard_index is None:
+        migrate()
+    if db.plans:
+        db.plans.enabled = True
+    block_index.load()
+    global trends_loaded_upto
+    with db.read() as cursor:
+        trends_loaded_upto = cursor.execute('SELECT MAX(post_id) FROM posts').fetchone()[0] or 0
+
+trends_loaded_upto = 0  # посты новее этой отметки попадают в тренды через trends.add при публикации
+db.on_open = prepare_database
+
+def init():
+    # Подключение, миграции и загрузка индексов; импорт модуля базу не трогает
+    db.open()
 
 # Вспомогательные функции
 def is_member(user_id, group_id):
-    cursor.execute('SELECT * FROM group_members WHERE group_id = ? AND user_id = ?', (group_id, user_id))
-    return cursor.fetchone() is not None
+    with db.read() as cursor:
+        cursor.execute('SELECT * FROM group_members WHERE group_id = ? AND user_id = ?', (group_id, user_id))
+        return cursor.fetchone() is not None
+
+def can_view_group(user_id, group_id):
+    with db.read() as cursor:
+        cursor.execute('''
+        SELECT g.is_public OR EXISTS (SELECT 1 FROM group_members m WHERE m.group_id = g.group_id AND m.user_id = ?)
+        FROM groups g WHERE g.group_id = ?
+        ''', (user_id, group_id))
+        row = cursor.fetchone()
+        return bool(row and row[0])
 
 def is_blocked(blocker_id, blocked_id):
-    cursor.execute('SELECT * FROM blocks WHERE blocker_id = ? AND blocked_id = ?', (blocker_id, blocked_id))
-    return cursor.fetchone() is not None
+    return block_index.is_blocked(blocker_id, blocked_id)
 
 def can_access_post(user_id, post_id):
-    cursor.execute('SELECT p.user_id, p.group_id FROM posts p WHERE post_id = ?', (post_id,))
-    post = cursor.fetchone()
-    if not post:
-        return False
+    with db.read() as cursor:
+        cursor.execute('SELECT p.user_id, p.group_id FROM posts p WHERE post_id = ?', (post_id,))
+        post = cursor.fetchone()
+        if not post:
+            return False
     
-    author_id, group_id = post
-    if is_blocked(author_id, user_id) or is_blocked(user_id, author_id):
-        return False
+        author_id, group_id = post
+        if block_index.either(author_id, user_id):
+            return False
     
-    if group_id:
-        return is_member(user_id, group_id)
-    return True
+        if group_id:
+            return is_member(user_id, group_id)
+        return True
 
 def extract_hashtags(text):
     return set(re.findall(r"#(\w+)", text.lower()))
@@ -287,45 +1409,104 @@ def validate_text_length(text, max_length, field_name):
     return text
 
 def is_admin(user_id):
-    cursor.execute('SELECT role FROM admins WHERE user_id = ?', (user_id,))
-    return cursor.fetchone() is not None
+    return admin_cache.get(user_id, lambda: load_is_admin(user_id))
+
+def load_is_admin(user_id):
+    with db.read() as cursor:
+        cursor.execute('SELECT role FROM admins WHERE user_id = ?', (user_id,))
+        return cursor.fetchone() is not None
+
+# Keyset-пагинация: страница задается ключом крайней строки, а не OFFSET
+def seek_clause(columns, page_key=None, backward=False):
+    if page_key is None:
+        condition = '1'
+    else:
+        placeholders = ', '.join('?' * len(columns))
+        condition = f"({', '.join(columns)}) {'>' if backward else '<'} ({placeholders})"
+    direction = 'ASC' if backward else 'DESC'
+    order = ', '.join(f'{column} {direction}' for column in columns)
+    return condition, order, tuple(page_key or ())
+
+def encode_page_key(page_key):
+    # (5, '2024-01-02 03:04:05', 17) -> '5-20240102030405-17', влезает в callback_data
+    return '-'.join(re.sub(r'\D', '', v) if isinstance(v, str) else str(v) for v in page_key)
+
+def decode_page_key(token):
+    # Последние два поля - дата и ID, перед ними необязательные числовые (счет для рейтинга)
+    *scores, date, row_id = token.split('-')
+    if len(date) == 14:
+        date = f'{date[0:4]}-{date[4:6]}-{date[6:8]} {date[8:10]}:{date[10:12]}:{date[12:14]}'
+    return tuple(int(s) for s in scores) + (date, int(row_id))
+
+def page_keys(rows, key_of):
+    # Ключи для кнопок "Назад" и "Далее" по первой и последней строке страницы
+    if not rows:
+        return None, None
+    return encode_page_key(key_of(rows[0])), encode_page_key(key_of(rows[-1]))
+
+def set_page(context, listing, token=None, backward=False):
+    # token=None - первая страница; иначе ключ из callback_data кнопки "Назад"/"Далее"
+    page = context.user_data.get(f'{listing}_page', 0)
+    context.user_data[f'{listing}_page_key'] = decode_page_key(token) if token else None
+    context.user_data[f'{listing}_backward'] = backward
+    context.user_data[f'{listing}_page'] = 0 if token is None else max(page + (-1 if backward else 1), 0)
+
+def get_page(context, listing):
+    return (context.user_data.get(f'{listing}_page_key'),
+            context.user_data.get(f'{listing}_backward', False),
+            context.user_data.get(f'{listing}_page', 0))
+
+def page_navigation(listing, page, prev_key, next_key, has_next=True):
+    buttons = []
+    if page > 0 and prev_key:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'{listing}_prev_{prev_key}'))
+    if has_next and next_key:
+        buttons.append(InlineKeyboardButton("➡️ Далее", callback_data=f'{listing}_next_{next_key}'))
+    return buttons
 
 # Функции для работы с пользователями
 def register_user(user_id, nickname, is_private=False, bio=''):
     try:
-        nickname = validate_text_length(nickname.strip(), 30, "Никнейм")
-        cursor.execute('''
-        INSERT INTO users (user_id, nickname, reg_date, last_seen, is_private, bio)
-        VALUES (?, ?, datetime('now'), datetime('now'), ?, ?)
-        ''', (user_id, nickname, int(is_private), bio))
-        cursor.execute('INSERT OR IGNORE INTO currencies (user_id) VALUES (?)', (user_id,))
-        cursor.execute('INSERT OR IGNORE INTO notification_settings (user_id) VALUES (?)', (user_id,))
-        conn.commit()
-        return True
+        with db.write() as cursor:
+            nickname = validate_text_length(nickname.strip(), 30, "Никнейм")
+            cursor.execute('''
+            INSERT INTO users (user_id, nickname, reg_date, last_seen, is_private, bio)
+            VALUES (?, ?, datetime('now'), datetime('now'), ?, ?)
+            ''', (user_id, nickname, int(is_private), bio))
+            cursor.execute('INSERT OR IGNORE INTO currencies (user_id) VALUES (?)', (user_id,))
+            cursor.execute('INSERT OR IGNORE INTO notification_settings (user_id) VALUES (?)', (user_id,))
+            return True
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Ошибка регистрации: {e}")
         return False
 
+def complete_registration(user_id, nickname, bonus=50):
+    # Регистрация и стартовый бонус - одна единица работы
+    with db.write():
+        if not register_user(user_id, nickname):
+            return False
+        add_currency(user_id, bonus)
+        return True
+
 def update_user_profile(user_id, **kwargs):
     try:
-        if 'nickname' in kwargs:
-            nickname = validate_text_length(kwargs['nickname'].strip(), 30, "Никнейм")
-            cursor.execute('UPDATE users SET nickname = ? WHERE user_id = ?', (nickname, user_id))
-        if 'bio' in kwargs:
-            bio = validate_text_length(kwargs['bio'], 200, "Описание")
-            cursor.execute('UPDATE users SET bio = ? WHERE user_id = ?', (bio, user_id))
-        if 'is_private' in kwargs:
-            cursor.execute('UPDATE users SET is_private = ? WHERE user_id = ?', (int(kwargs['is_private']), user_id))
-        cursor.execute('UPDATE users SET last_seen = datetime("now") WHERE user_id = ?', (user_id,))
-        conn.commit()
-        return True
+        with db.write() as cursor:
+            if 'nickname' in kwargs:
+                nickname = validate_text_length(kwargs['nickname'].strip(), 30, "Никнейм")
+                cursor.execute('UPDATE users SET nickname = ? WHERE user_id = ?', (nickname, user_id))
+            if 'bio' in kwargs:
+                bio = validate_text_length(kwargs['bio'], 200, "Описание")
+                cursor.execute('UPDATE users SET bio = ? WHERE user_id = ?', (bio, user_id))
+            if 'is_private' in kwargs:
+                cursor.execute('UPDATE users SET is_private = ? WHERE user_id = ?', (int(kwargs['is_private']), user_id))
+            cursor.execute('UPDATE users SET last_seen = datetime("now") WHERE user_id = ?', (user_id,))
+            invalidate_cached(user_cache, user_id)
+            return True
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Ошибка обновления профиля: {e}")
         return False
 
-def get_user_by_id(user_id):
-    cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    row = cursor.fetchone()
+def user_from_row(row):
     if not row:
         return None
     return {
@@ -337,23 +1518,34 @@ def get_user_by_id(user_id):
         "bio": row[5] if len(row) > 5 else ""
     }
 
+def load_user(user_id):
+    with db.read() as cursor:
+        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+        return user_from_row(cursor.fetchone())
+
+def load_user_id_by_nickname(nickname):
+    with db.read() as cursor:
+        cursor.execute('SELECT user_id FROM users WHERE nickname = ?', (nickname,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+def get_user_by_id(user_id):
+    return user_cache.get(user_id, lambda: load_user(user_id))
+
 def get_user_by_nickname(nickname):
-    cursor.execute('SELECT * FROM users WHERE nickname = ?', (nickname,))
-    row = cursor.fetchone()
-    if not row:
+    user_id = nickname_cache.get(nickname, lambda: load_user_id_by_nickname(nickname))
+    if user_id is None:
         return None
-    return {
-        "user_id": row[0],
-        "nickname": row[1],
-        "reg_date": row[2],
-        "last_seen": row[3],
-        "is_private": bool(row[4]),
-        "bio": row[5] if len(row) > 5 else ""
-    }
+    user = get_user_by_id(user_id)
+    if user is None or user['nickname'] != nickname:
+        # Никнейм сменили после кэширования - перечитываем из базы
+        nickname_cache.invalidate(nickname)
+        user_id = load_user_id_by_nickname(nickname)
+        return get_user_by_id(user_id) if user_id is not None else None
+    return user
 
 def is_registered(user_id):
-    cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    return cursor.fetchone() is not None
+    return get_user_by_id(user_id) is not None
 
 # Функции для друзей и блокировок
 def send_friend_request(user_id, friend_nickname):
@@ -364,19 +1556,24 @@ def send_friend_request(user_id, friend_nickname):
     friend_id = friend['user_id']
     is_private = friend['is_private']
     
-    cursor.execute('''
-    SELECT status FROM friends 
-    WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)
-    ''', (user_id, friend_id, friend_id, user_id))
-    existing = cursor.fetchone()
+    with db.read() as cursor:
+        cursor.execute('''
+        SELECT status FROM friends 
+        WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)
+        ''', (user_id, friend_id, friend_id, user_id))
+        existing = cursor.fetchone()
     if existing:
         return False
     
     if not is_private:
         try:
-            cursor.execute('INSERT INTO friends (user_id, friend_id, status) VALUES (?, ?, "accepted")', (user_id, friend_id))
-            cursor.execute('INSERT INTO friends (user_id, friend_id, status) VALUES (?, ?, "accepted")', (friend_id, user_id))
-            conn.commit()
+            with db.write() as cursor:
+                cursor.execute('INSERT INTO friends (user_id, friend_id, status) VALUES (?, ?, "accepted")', (user_id, friend_id))
+                cursor.execute('INSERT INTO friends (user_id, friend_id, status) VALUES (?, ?, "accepted")', (friend_id, user_id))
+                record_event(user_id, 'friend_accepted')
+                record_event(friend_id, 'friend_accepted')
+                backfill_timeline_author(user_id, friend_id)
+                backfill_timeline_author(friend_id, user_id)
             sender = get_user_by_id(user_id)
             send_notification(friend_id, 'friend_accepted', f'Вы теперь дружите с {sender["nickname"]}!', user_id)
             return True
@@ -385,8 +1582,8 @@ def send_friend_request(user_id, friend_nickname):
             return False
     
     try:
-        cursor.execute('INSERT INTO friends (user_id, friend_id, status) VALUES (?, ?, "pending")', (user_id, friend_id))
-        conn.commit()
+        with db.write() as cursor:
+            cursor.execute('INSERT INTO friends (user_id, friend_id, status) VALUES (?, ?, "pending")', (user_id, friend_id))
         sender = get_user_by_id(user_id)
         send_notification(friend_id, 'friend_request', f'Запрос на дружбу от {sender["nickname"]}', user_id)
         return True
@@ -395,187 +1592,621 @@ def send_friend_request(user_id, friend_nickname):
         return False
 
 def respond_friend_request(user_id, friend_id, accept=True):
-    status = 'accepted' if accept else 'rejected'
-    cursor.execute('''
-    UPDATE friends SET status = ?
-    WHERE user_id = ? AND friend_id = ? AND status = 'pending'
-    ''', (status, friend_id, user_id))
+    with db.write() as cursor:
+        status = 'accepted' if accept else 'rejected'
+        cursor.execute('''
+        UPDATE friends SET status = ?
+        WHERE user_id = ? AND friend_id = ? AND status = 'pending'
+        ''', (status, friend_id, user_id))
     
-    if cursor.rowcount == 0:
-        return False
+        if cursor.rowcount == 0:
+            return False
     
-    if accept:
-        cursor.execute('INSERT OR IGNORE INTO friends (user_id, friend_id, status) VALUES (?, ?, "accepted")', (user_id, friend_id))
-    conn.commit()
+        if accept:
+            cursor.execute('INSERT OR IGNORE INTO friends (user_id, friend_id, status) VALUES (?, ?, "accepted")', (user_id, friend_id))
+            if cursor.rowcount:
+                record_event(user_id, 'friend_accepted')
+            record_event(friend_id, 'friend_accepted')
+            backfill_timeline_author(user_id, friend_id)
+            backfill_timeline_author(friend_id, user_id)
     
-    responder = get_user_by_id(user_id)
-    content = f'Ваш запрос дружбы {"принят" if accept else "отклонен"} пользователем {responder["nickname"]}'
-    send_notification(friend_id, 'friend_response', content, user_id)
-    return True
+        responder = get_user_by_id(user_id)
+        content = f'Ваш запрос дружбы {"принят" if accept else "отклонен"} пользователем {responder["nickname"]}'
+        send_notification(friend_id, 'friend_response', content, user_id)
+        return True
 
 def block_user(blocker_id, blocked_nickname):
-    blocked = get_user_by_nickname(blocked_nickname)
-    if not blocked or blocked['user_id'] == blocker_id:
-        return False
+    with db.write() as cursor:
+        blocked = get_user_by_nickname(blocked_nickname)
+        if not blocked or blocked['user_id'] == blocker_id:
+            return False
     
-    blocked_id = blocked['user_id']
-    if is_blocked(blocker_id, blocked_id):
-        return False
+        blocked_id = blocked['user_id']
+        if is_blocked(blocker_id, blocked_id):
+            return False
     
-    cursor.execute('''
-    DELETE FROM friends 
-    WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)
-    ''', (blocker_id, blocked_id, blocked_id, blocker_id))
+        cursor.execute('''
+        DELETE FROM friends 
+        WHERE (user_id = ? AND friend_id = ?) OR (user_id = ? AND friend_id = ?)
+        RETURNING user_id, status
+        ''', (blocker_id, blocked_id, blocked_id, blocker_id))
+        for user_id, status in cursor.fetchall():
+            if status == 'accepted':
+                bump_user_stat(user_id, 'friend_count', -1)
     
-    cursor.execute('INSERT OR IGNORE INTO blocks (blocker_id, blocked_id) VALUES (?, ?)', (blocker_id, blocked_id))
-    conn.commit()
-    return True
+        cursor.execute('INSERT OR IGNORE INTO blocks (blocker_id, blocked_id) VALUES (?, ?)', (blocker_id, blocked_id))
+        db.after_write(lambda: publish('block', blocker_id, blocked_id))
+        purge_timeline_pair(blocker_id, blocked_id)
+        return True
 
 def unblock_user(blocker_id, blocked_nickname):
-    blocked = get_user_by_nickname(blocked_nickname)
-    if not blocked:
-        return False
+    with db.write() as cursor:
+        blocked = get_user_by_nickname(blocked_nickname)
+        if not blocked:
+            return False
+
+        blocked_id = blocked['user_id']
+        if not is_blocked(blocker_id, blocked_id):
+            return False
 
-    blocked_id = blocked['user_id']
-    if not is_blocked(blocker_id, blocked_id):
+        cursor.execute('DELETE FROM blocks WHERE blocker_id = ? AND blocked_id = ?', (blocker_id, blocked_id))
+        db.after_write(lambda: publish('unblock', blocker_id, blocked_id))
+        # Ленту возвращаем после обновления индекса блокировок, до него block_filter еще скрывает пару
+        db.after_write(lambda: restore_timeline_pair(blocker_id, blocked_id))
+        return cursor.rowcount > 0
+
+def get_friends(user_id):
+    with db.read() as cursor:
+        cursor.execute('''
+        SELECT u.user_id, u.nickname 
+        FROM friends f
+        JOIN users u ON f.friend_id = u.user_id
+        WHERE f.user_id = ? AND f.status = 'accepted'
+        ''', (user_id,))
+        return cursor.fetchall()
+
+def get_friend_requests(user_id):
+    with db.read() as cursor:
+        cursor.execute('''
+        SELECT u.user_id, u.nickname 
+        FROM friends f
+        JOIN users u ON f.user_id = u.user_id
+        WHERE f.friend_id = ? AND f.status = 'pending'
+        ''', (user_id,))
+        return cursor.fetchall()
+
+def get_blocked_users(user_id):
+    with db.read() as cursor:
+        cursor.execute('''
+        SELECT u.nickname 
+        FROM blocks b
+        JOIN users u ON b.blocked_id = u.user_id
+        WHERE blocker_id = ?
+        ''', (user_id,))
+        return cursor.fetchall()
+
+# Функции для материализованной ленты (вложенный db.write() входит в транзакцию вызывающего)
+def is_pull_source(cursor, source_type, source_id, recipients):
+    # Источник уже читается при показе ленты или у него больше FEED_FANOUT_LIMIT получателей.
+    # Всех получателей под блокировкой писателя не считаем: достаточно одной строки за пределом
+    cursor.execute('SELECT 1 FROM feed_pull_sources WHERE source_type = ? AND source_id = ?', (source_type, source_id))
+    if cursor.fetchone():
+        return True
+    cursor.execute(f'{recipients} LIMIT 1 OFFSET ?', (source_id, FEED_FANOUT_LIMIT))
+    if cursor.fetchone() is None:
         return False
+    cursor.execute('INSERT OR IGNORE INTO feed_pull_sources (source_type, source_id) VALUES (?, ?)', (source_type, source_id))
+    return True
+
+def fanout_post(post_id, author_id, group_id, post_date):
+    with db.write() as cursor:
+        if not is_pull_source(cursor, 'user', author_id,
+                              'SELECT 1 FROM friends WHERE friend_id = ? AND status = "accepted"'):
+            cursor.execute('''
+            INSERT OR IGNORE INTO feed_timeline (user_id, post_id, author_id, post_date)
+            SELECT f.user_id, ?, ?, ?
+            FROM friends f
+            WHERE f.friend_id = ? AND f.status = 'accepted'
+            ''', (post_id, author_id, post_date, author_id))
+
+        if not group_id:
+            return
+        if not is_pull_source(cursor, 'group', group_id, 'SELECT 1 FROM group_members WHERE group_id = ?'):
+            hidden, hidden_params = block_filter('gm.user_id', author_id)
+            cursor.execute(f'''
+            INSERT OR IGNORE INTO feed_timeline (user_id, post_id, author_id, post_date)
+            SELECT gm.user_id, ?, ?, ?
+            FROM group_members gm
+            WHERE gm.group_id = ?
+            AND {hidden}
+            ''', (post_id, author_id, post_date, group_id, *hidden_params))
+
+def backfill_timeline_author(user_id, author_id):
+    with db.write() as cursor:
+        cursor.execute('''
+        INSERT OR IGNORE INTO feed_timeline (user_id, post_id, author_id, post_date)
+        SELECT ?, p.post_id, p.user_id, p.post_date
+        FROM posts p
+        WHERE p.user_id = ?
+        ORDER BY p.post_date DESC, p.post_id DESC
+        LIMIT ?
+        ''', (user_id, author_id, FEED_BACKFILL_LIMIT))
+
+def backfill_timeline_group(user_id, group_id):
+    with db.write() as cursor:
+        hidden, hidden_params = block_filter('p.user_id', user_id)
+        cursor.execute(f'''
+        INSERT OR IGNORE INTO feed_timeline (user_id, post_id, author_id, post_date)
+        SELECT ?, p.post_id, p.user_id, p.post_date
+        FROM posts p
+        WHERE p.group_id = ?
+        AND {hidden}
+        ORDER BY p.post_date DESC, p.post_id DESC
+        LIMIT ?
+        ''', (user_id, group_id, *hidden_params, FEED_BACKFILL_LIMIT))
+
+def purge_timeline_pair(user_a, user_b):
+    with db.write() as cursor:
+        cursor.execute('DELETE FROM feed_timeline WHERE user_id = ? AND author_id = ?', (user_a, user_b))
+        cursor.execute('DELETE FROM feed_timeline WHERE user_id = ? AND author_id = ?', (user_b, user_a))
+
+def restore_timeline_pair(user_a, user_b):
+    # Обратно к purge_timeline_pair после снятия блокировки: посты общих групп и, если пара снова дружит, личные
+    if block_index.either(user_a, user_b):
+        return  # Осталась встречная блокировка
+    with db.write() as cursor:
+        cursor.execute('''
+        SELECT a.group_id FROM group_members a
+        JOIN group_members b ON b.group_id = a.group_id AND b.user_id = ?
+        WHERE a.user_id = ?
+        ''', (user_b, user_a))
+        for (group_id,) in cursor.fetchall():
+            backfill_timeline_group(user_a, group_id)
+            backfill_timeline_group(user_b, group_id)
+        cursor.execute('SELECT 1 FROM friends WHERE user_id = ? AND friend_id = ? AND status = "accepted"', (user_a, user_b))
+        if cursor.fetchone():
+            backfill_timeline_author(user_a, user_b)
+            backfill_timeline_author(user_b, user_a)
+
+def purge_timeline_post(post_id):
+    with db.write() as cursor:
+        cursor.execute('DELETE FROM feed_timeline WHERE post_id = ?', (post_id,))
+
+def prune_timelines(after=0, batch=FEED_PRUNE_BATCH, keep=FEED_TIMELINE_LIMIT):
+    # Одна порция прохода по пользователям с ID больше after; возвращает последний ID или None в конце прохода
+    with db.write() as cursor:
+        cursor.execute('SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?', (after, batch))
+        user_ids = [row[0] for row in cursor.fetchall()]
+        for user_id in user_ids:
+            boundary = cursor.execute('''
+            SELECT post_date, post_id FROM feed_timeline
+            WHERE user_id = ?
+            ORDER BY post_date DESC, post_id DESC
+            LIMIT 1 OFFSET ?
+            ''', (user_id, keep - 1)).fetchone()
+            if boundary is None:
+                continue
+            cursor.execute('DELETE FROM feed_timeline WHERE user_id = ? AND (post_date, post_id) < (?, ?)',
+                           (user_id, *boundary))
+            if cursor.rowcount:
+                cursor.execute('''
+                INSERT INTO feed_horizons (user_id, post_date, post_id) VALUES (?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET post_date = excluded.post_date, post_id = excluded.post_id
+                ''', (user_id, *boundary))
+    return user_ids[-1] if user_ids else None
+
+def run_timeline_pruning():
+    while True:
+        after = 0
+        try:
+            while (after := prune_timelines(after)) is not None:
+                time.sleep(FEED_PRUNE_PAUSE)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка обрезки ленты: {e}")
+        time.sleep(FEED_PRUNE_INTERVAL)
+
+# Счетчики вовлеченности (вложенный db.write() входит в транзакцию вызывающего)
+POST_COUNTER_TOTALS = {
+    'like_count': 'likes_received',
+    'comment_count': 'comments_received',
+    'repost_count': 'reposts_received',
+    'bookmark_count': 'bookmarks_received',
+}
+
+def bump_user_stat(user_id, column, delta=1):
+    # Возвращает новое значение счетчика
+    with db.write() as cursor:
+        cursor.execute('INSERT OR IGNORE INTO user_stats (user_id) VALUES (?)', (user_id,))
+        cursor.execute(f'UPDATE user_stats SET {column} = MAX({column} + ?, 0) WHERE user_id = ? RETURNING {column}',
+                       (delta, user_id))
+        return cursor.fetchone()[0]
+
+def bump_post_counter(post_id, column, delta=1):
+    with db.write() as cursor:
+        author = cursor.execute('SELECT user_id FROM posts WHERE post_id = ?', (post_id,)).fetchone()
+        if not author:
+            return
+        cursor.execute(f'UPDATE posts SET {column} = MAX({column} + ?, 0) WHERE post_id = ?', (delta, post_id))
+        bump_user_stat(author[0], POST_COUNTER_TOTALS[column], delta)
+        refresh_post_rank(cursor, post_id)
+
+def refresh_post_rank(cursor, post_id):
+    row = cursor.execute('''
+    SELECT like_count, comment_count, repost_count, bookmark_count, post_date FROM posts WHERE post_id = ?
+    ''', (post_id,)).fetchone()
+    if row:
+        cursor.execute('UPDATE posts SET rank = ? WHERE post_id = ?', (post_rank(*row), post_id))
+
+def bump_affinity(user_id, post_id, signal):
+    # Хештеги поста добавляют пользователю вес AFFINITY_SIGNALS[signal]
+    with db.write() as cursor:
+        cursor.execute('''
+        INSERT INTO user_hashtag_affinity (user_id, hashtag_id, weight)
+        SELECT ?, hashtag_id, ? FROM post_hashtags WHERE post_id = ?
+        ON CONFLICT (user_id, hashtag_id) DO UPDATE SET weight = weight + excluded.weight
+        ''', (user_id, AFFINITY_SIGNALS[signal], post_id))
+        if cursor.rowcount:
+            invalidate_cached(affinity_cache, user_id)
+
+def load_affinity(user_id):
+    # Самые весомые хештеги пользователя, нормированные к [0, 1]
+    with db.read() as cursor:
+        cursor.execute('''
+        SELECT hashtag_id, weight FROM user_hashtag_affinity
+        WHERE user_id = ?
+        ORDER BY weight DESC
+        LIMIT ?
+        ''', (user_id, AFFINITY_TOP))
+        rows = cursor.fetchall()
+    if not rows:
+        return {}
+    top = rows[0][1]
+    return {hashtag_id: weight / top for hashtag_id, weight in rows}
+
+def user_affinity(user_id):
+    return affinity_cache.get(user_id, lambda: load_affinity(user_id))
+
+def set_ranking_weights(half_life=None, **weights):
+    # Подключение других весов: пересчитывает ранги всех постов
+    global RANKING_HALF_LIFE
+    unknown = set(weights) - set(RANKING_WEIGHTS)
+    if unknown:
+        raise ValueError(f"Неизвестные веса ранжирования: {', '.join(sorted(unknown))}")
+    RANKING_WEIGHTS.update(weights)
+    if half_life:
+        RANKING_HALF_LIFE = half_life
+    with db.write() as cursor:
+        rerank_posts(cursor)
+    publish('clear', affinity_cache.name)
+
+def remove_post(post_id, user_id=None):
+    # Удаляет пост (только свой, если указан user_id) и списывает его счетчики
+    with db.write() as cursor:
+        cursor.execute('''
+        SELECT user_id, repost_of, like_count, comment_count, repost_count, bookmark_count, group_id, post_date
+        FROM posts WHERE post_id = ?
+        ''', (post_id,))
+        post = cursor.fetchone()
+        if not post or (user_id is not None and post[0] != user_id):
+            return False
+        author_id, repost_of, likes, comments, reposts, bookmarks, group_id, post_date = post
+        cursor.execute('''
+        SELECT h.name FROM post_hashtags ph JOIN hashtags h ON h.hashtag_id = ph.hashtag_id WHERE ph.post_id = ?
+        ''', (post_id,))
+        tags = [row[0] for row in cursor.fetchall()]
+        cursor.execute('DELETE FROM posts WHERE post_id = ?', (post_id,))
+        if tags:
+            db.after_write(lambda: publish('trend', tags, group_id, post_date, -1))
+        bump_user_stat(author_id, 'post_count', -1)
+        for column, delta in (('likes_received', likes), ('comments_received', comments),
+                              ('reposts_received', reposts), ('bookmarks_received', bookmarks)):
+            if delta:
+                bump_user_stat(author_id, column, -delta)
+        if repost_of:
+            bump_post_counter(repost_of, 'repost_count', -1)
+        purge_timeline_post(post_id)
+        return True
 
-    cursor.execute('DELETE FROM blocks WHERE blocker_id = ? AND blocked_id = ?', (blocker_id, blocked_id))
-    conn.commit()
-    return cursor.rowcount > 0
+def resolve_hashtags(cursor, tags):
+    # Имена -> hashtag_id: известные берутся из кэша, остальные создаются и читаются двумя запросами на весь пост
+    ids = {}
+    missing = []
+    for tag in tags:
+        hashtag_id = hashtag_cache.get(tag, lambda: None)
+        if hashtag_id is None:
+            missing.append(tag)
+        else:
+            ids[tag] = hashtag_id
+    if missing:
+        cursor.execute('INSERT OR IGNORE INTO hashtags (name) SELECT value FROM json_each(?)', (json.dumps(missing),))
+        cursor.execute('SELECT name, hashtag_id FROM hashtags WHERE name IN (SELECT value FROM json_each(?))',
+                       (json.dumps(missing),))
+        found = dict(cursor.fetchall())
+        ids.update(found)
+        # В кэш попадают только зафиксированные id: при откате новые хештеги исчезнут
+        db.after_write(lambda: [hashtag_cache.put(tag, hashtag_id) for tag, hashtag_id in found.items()])
+    return ids
+
+def link_hashtags(cursor, post_id, tags):
+    ids = resolve_hashtags(cursor, tags)
+    cursor.execute('INSERT OR IGNORE INTO post_hashtags (post_id, hashtag_id) SELECT ?, value FROM json_each(?)',
+                   (post_id, json.dumps(list(ids.values()))))
 
 # Функции для постов и ленты
-def create_post(user_id, content, group_id=None, media_type=None, media_id=None):
+def create_post(user_id, content, group_id=None, media_type=None, media_id=None, repost_of=None):
     try:
-        content = validate_text_length(content, 1000, "Текст поста")
-        cursor.execute('''
-        INSERT INTO posts (user_id, content, post_date, group_id, media_type, media_id)
-        VALUES (?, ?, datetime('now'), ?, ?, ?)
-        ''', (user_id, content, group_id, media_type, media_id))
-        post_id = cursor.lastrowid
-        
-        hashtags = extract_hashtags(content)
-        for tag in hashtags:
-            cursor.execute('INSERT OR IGNORE INTO hashtags (name) VALUES (?)', (tag,))
-            cursor.execute('SELECT hashtag_id FROM hashtags WHERE name = ?', (tag,))
-            hashtag_id = cursor.fetchone()[0]
-            cursor.execute('INSERT OR IGNORE INTO post_hashtags (post_id, hashtag_id) VALUES (?, ?)', (post_id, hashtag_id))
+        with db.write() as cursor:
+            content = validate_text_length(content, 1000, "Текст поста")
+            cursor.execute('''
+            INSERT INTO posts (user_id, content, post_date, group_id, media_type, media_id, repost_of)
+            VALUES (?, ?, datetime('now'), ?, ?, ?, ?)
+            ''', (user_id, content, group_id, media_type, media_id, repost_of))
+            post_id = cursor.lastrowid
+            record_event(user_id, 'post_created')
+            if repost_of:
+                bump_post_counter(repost_of, 'repost_count')
+            post_date = cursor.execute('SELECT post_date FROM posts WHERE post_id = ?', (post_id,)).fetchone()[0]
+            cursor.execute('UPDATE posts SET rank = ? WHERE post_id = ?', (post_rank(0, 0, 0, 0, post_date), post_id))
+            fanout_post(post_id, user_id, group_id, post_date)
         
-        # Проверка достижений
-        cursor.execute('SELECT COUNT(*) FROM posts WHERE user_id = ?', (user_id,))
-        post_count = cursor.fetchone()[0]
-        if post_count % 10 == 0:  # Награда каждые 10 постов
-            award_achievement(user_id, 'active_poster', f'Опубликовал {post_count} постов')
+            hashtags = extract_hashtags(content)
+            if hashtags:
+                link_hashtags(cursor, post_id, hashtags)
+                bump_affinity(user_id, post_id, 'post')
+                db.after_write(lambda: publish('trend', hashtags, group_id, post_date))
         
-        conn.commit()
-        return post_id
+            return post_id
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Ошибка создания поста: {e}")
-        conn.rollback()
         return None
 
-def get_feed_posts(user_id, limit=10, offset=0):
-    cursor.execute('''
+def get_feed_posts(user_id, limit=10, page_key=None, backward=False):
+    # Срез материализованной ленты + посты крупных авторов/групп, которые не раскладываются (pull).
+    # Старше границы обрезки (feed_horizons) лента неполна, там посты друзей и групп тоже читаются напрямую
+    with db.read() as cursor:
+        horizon = cursor.execute('SELECT post_date, post_id FROM feed_horizons WHERE user_id = ?', (user_id,)).fetchone()
+        # Страница целиком за границей: "Далее" от ключа не новее границы или "Назад" от более старого ключа
+        past_horizon = horizon is not None and page_key is not None and (
+            tuple(page_key) < horizon if backward else tuple(page_key) <= horizon)
+        posts = read_feed_page(cursor, user_id, limit, page_key, backward, horizon if past_horizon else None)
+        if horizon is not None and not past_horizon and not backward and len(posts) < limit:
+            # Лента закончилась до конца страницы - дочитываем из-за границы
+            posts = read_feed_page(cursor, user_id, limit, page_key, backward, horizon)
+        return posts
+
+def read_feed_page(cursor, user_id, limit, page_key, backward, horizon=None):
+    hidden, hidden_params = block_filter('p.user_id', user_id)
+    timeline_seek, timeline_order, key = seek_clause(['post_date', 'post_id'], page_key, backward)
+    pull_seek, pull_order, _ = seek_clause(['p2.post_date', 'p2.post_id'], page_key, backward)
+    seek, order, _ = seek_clause(['p.post_date', 'p.post_id'], page_key, backward)
+    older, older_params = '', ()
+    if horizon is not None:
+        older_seek, older_order, _ = seek_clause(['p3.post_date', 'p3.post_id'], page_key, backward)
+        older = f'''
+            UNION
+            SELECT post_id FROM (
+                SELECT p3.post_id FROM posts p3
+                WHERE (p3.user_id IN (SELECT friend_id FROM friends WHERE user_id = ? AND status = 'accepted')
+                       OR p3.group_id IN (SELECT group_id FROM group_members WHERE user_id = ?))
+                AND (p3.post_date, p3.post_id) < (?, ?)
+                AND {older_seek}
+                ORDER BY {older_order}
+                LIMIT ?
+            )'''
+        older_params = (user_id, user_id, *horizon, *key, limit)
+    cursor.execute(f'''
     SELECT p.post_id, p.content, p.post_date, u.nickname, p.media_id, p.media_type
-    FROM posts p
+    FROM (
+        SELECT post_id FROM (
+            SELECT post_id FROM feed_timeline
+            WHERE user_id = ? AND {timeline_seek}
+            ORDER BY {timeline_order}
+            LIMIT ?
+        )
+        UNION
+        SELECT post_id FROM (
+            SELECT p2.post_id FROM posts p2
+            WHERE (p2.user_id IN (SELECT f.friend_id FROM friends f
+                                  JOIN feed_pull_sources s ON s.source_type = 'user' AND s.source_id = f.friend_id
+                                  WHERE f.user_id = ? AND f.status = 'accepted')
+                   OR p2.group_id IN (SELECT gm.group_id FROM group_members gm
+                                      JOIN feed_pull_sources s ON s.source_type = 'group' AND s.source_id = gm.group_id
+                                      WHERE gm.user_id = ?))
+            AND {pull_seek}
+            ORDER BY {pull_order}
+            LIMIT ?
+        ){older}
+    ) t
+    JOIN posts p ON p.post_id = t.post_id
     JOIN users u ON p.user_id = u.user_id
-    WHERE (
-        p.user_id IN (SELECT friend_id FROM friends WHERE user_id = ? AND status = 'accepted')
-        OR p.group_id IN (SELECT group_id FROM group_members WHERE user_id = ?)
-    )
-    AND NOT EXISTS (SELECT 1 FROM blocks 
-                   WHERE (blocker_id = ? AND blocked_id = p.user_id)
-                   OR (blocker_id = p.user_id AND blocked_id = ?))
-    ORDER BY p.post_date DESC
-    LIMIT ? OFFSET ?
-    ''', (user_id, user_id, user_id, user_id, limit, offset))
-    return cursor.fetchall()
-
-def get_smart_feed(user_id, limit=10, offset=0):
-    cursor.execute('''
-    SELECT p.post_id, p.content, p.post_date, u.nickname, p.media_id, p.media_type,
-           COUNT(l.like_id) as like_count, COUNT(c.comment_id) as comment_count
+    WHERE {hidden}
+    AND {seek}
+    ORDER BY {order}
+    LIMIT ?
+    ''', (user_id, *key, limit, user_id, user_id, *key, limit, *older_params, *hidden_params, *key, limit))
+    posts = cursor.fetchall()
+    return posts[::-1] if backward else posts
+
+def smart_feed_candidates(cursor, source, params, rank_bound, backward, limit, user_id):
+    # Только ключи: (post_id, rank, post_date) читаются из покрывающих индексов, полные строки - для итоговой страницы
+    hidden, hidden_params = block_filter('p.user_id', user_id)
+    if rank_bound is None:
+        # Посты старой базы без ранга (до фонового шага post_ranks) в умную ленту не попадают, как и на следующих страницах
+        bound, bound_params = 'p.rank IS NOT NULL', ()
+    else:
+        bound, bound_params = f"p.rank {'>=' if backward else '<='} ?", (rank_bound,)
+    cursor.execute(f'''
+    SELECT p.post_id, p.rank, p.post_date
     FROM posts p
-    JOIN users u ON p.user_id = u.user_id
-    LEFT JOIN likes l ON p.post_id = l.post_id
-    LEFT JOIN comments c ON p.post_id = c.post_id
-    WHERE (
-        p.user_id IN (SELECT friend_id FROM friends WHERE user_id = ? AND status = 'accepted')
-        OR p.group_id IN (SELECT group_id FROM group_members WHERE user_id = ?)
-        OR p.post_id IN (SELECT ph.post_id FROM post_hashtags ph 
-                        JOIN hashtags h ON ph.hashtag_id = h.hashtag_id
-                        WHERE h.name IN (SELECT h2.name FROM post_hashtags ph2 
-                                        JOIN hashtags h2 ON ph2.hashtag_id = h2.hashtag_id
-                                        JOIN posts p2 ON ph2.post_id = p2.post_id
-                                        WHERE p2.user_id = ?))
-    )
-    AND NOT EXISTS (SELECT 1 FROM blocks 
-                   WHERE (blocker_id = ? AND blocked_id = p.user_id)
-                   OR (blocker_id = p.user_id AND blocked_id = ?))
-    GROUP BY p.post_id
-    ORDER BY (like_count * 2 + comment_count * 3 + 
-              CASE WHEN p.post_date > datetime('now', '-1 day') THEN 10 ELSE 0 END) DESC
-    LIMIT ? OFFSET ?
-    ''', (user_id, user_id, user_id, user_id, user_id, limit, offset))
+    WHERE {source}
+    AND {hidden}
+    AND {bound}
+    ORDER BY p.rank {'ASC' if backward else 'DESC'}
+    LIMIT ?
+    ''', (*params, *hidden_params, *bound_params, limit))
     return cursor.fetchall()
 
-def get_popular_posts(user_id, limit=5, offset=0):
-    cursor.execute('''
-    SELECT p.post_id, p.content, p.post_date, u.nickname, p.media_id, p.media_type,
-           COUNT(l.like_id) as like_count,
-           COUNT(c.comment_id) as comment_count
-    FROM posts p
-    JOIN users u ON p.user_id = u.user_id
-    LEFT JOIN likes l ON p.post_id = l.post_id
-    LEFT JOIN comments c ON p.post_id = c.post_id
-    WHERE (
-        p.user_id IN (SELECT friend_id FROM friends WHERE user_id = ? AND status = 'accepted')
-        OR p.group_id IN (SELECT group_id FROM group_members WHERE user_id = ?)
-    )
-    AND NOT EXISTS (SELECT 1 FROM blocks 
-                   WHERE (blocker_id = ? AND blocked_id = p.user_id)
-                   OR (blocker_id = p.user_id AND blocked_id = ?))
-    GROUP BY p.post_id
-    ORDER BY (like_count + comment_count) DESC, p.post_date DESC
-    LIMIT ? OFFSET ?
-    ''', (user_id, user_id, user_id, user_id, limit, offset))
-    return cursor.fetchall()
+def get_smart_feed(user_id, limit=10, page_key=None, backward=False):
+    # Кандидаты из друзей, групп и постов с интересными хештегами уже упорядочены по posts.rank;
+    # личное усиление по хештегам добавляется в Python, лучшие limit выбираются кучей
+    affinity = user_affinity(user_id)
+    max_boost = math.log1p(RANKING_WEIGHTS['affinity'])
+    rank_bound = None
+    if page_key is not None:
+        # Усиление только повышает счет: для "Далее" хватает постов с rank <= ключа, для "Назад" - rank >= ключ - max_boost
+        slack = 1 / RANK_SCALE  # счет в ключе округлен
+        rank_bound = page_key[0] / RANK_SCALE - max_boost - slack if backward else page_key[0] / RANK_SCALE + slack
+    sources = [
+        ("p.user_id IN (SELECT friend_id FROM friends WHERE user_id = ? AND status = 'accepted')", (user_id,)),
+        ('p.group_id IN (SELECT group_id FROM group_members WHERE user_id = ?)', (user_id,)),
+    ]
+    if affinity:
+        sources.append(('p.post_id IN (SELECT post_id FROM post_hashtags WHERE hashtag_id IN (SELECT value FROM json_each(?)))',
+                        (json.dumps(list(affinity)[:AFFINITY_FEED_TAGS]),)))
+    
+    with db.read() as cursor:
+        candidates = {}
+        for source, params in sources:
+            for post_id, rank, post_date in smart_feed_candidates(cursor, source, params, rank_bound, backward,
+                                                                  limit * SMART_FEED_CANDIDATES, user_id):
+                candidates[post_id] = (rank, post_date)
+        tags = {}
+        if affinity and candidates:
+            cursor.execute('''
+            SELECT post_id, hashtag_id FROM post_hashtags WHERE post_id IN (SELECT value FROM json_each(?))
+            ''', (json.dumps(list(candidates)),))
+            for post_id, hashtag_id in cursor.fetchall():
+                tags.setdefault(post_id, []).append(hashtag_id)
+        
+        ranked = []
+        for post_id, (rank, post_date) in candidates.items():
+            interest = min(sum(affinity.get(tag, 0) for tag in tags.get(post_id, ())), 1.0)
+            key = (round((rank + math.log1p(RANKING_WEIGHTS['affinity'] * interest)) * RANK_SCALE), post_date, post_id)
+            if page_key is None or (key > tuple(page_key) if backward else key < tuple(page_key)):
+                ranked.append(key)
+        page = heapq.nsmallest(limit, ranked)[::-1] if backward else heapq.nlargest(limit, ranked)
+        if not page:
+            return []
+        
+        cursor.execute('''
+        SELECT p.post_id, p.content, p.post_date, u.nickname, p.media_id, p.media_type,
+               p.like_count, p.comment_count
+        FROM posts p
+        JOIN users u ON p.user_id = u.user_id
+        WHERE p.post_id IN (SELECT value FROM json_each(?))
+        ''', (json.dumps([post_id for _, _, post_id in page]),))
+        rows = {row[0]: row for row in cursor.fetchall()}
+    return [rows[post_id] + (score,) for score, _, post_id in page if post_id in rows]
+
+def get_popular_posts(user_id, limit=5, page_key=None, backward=False):
+    with db.read() as cursor:
+        hidden, hidden_params = block_filter('p.user_id', user_id)
+        # Порядок совпадает с индексом idx_posts_popular
+        seek, order, key = seek_clause(['(p.like_count + p.comment_count)', 'p.post_date', 'p.post_id'],
+                                       page_key, backward)
+        cursor.execute(f'''
+        SELECT p.post_id, p.content, p.post_date, u.nickname, p.media_id, p.media_type,
+               p.like_count, p.comment_count, p.like_count + p.comment_count as score
+        FROM posts p
+        JOIN users u ON p.user_id = u.user_id
+        WHERE (
+            p.user_id IN (SELECT friend_id FROM friends WHERE user_id = ? AND status = 'accepted')
+            OR p.group_id IN (SELECT group_id FROM group_members WHERE user_id = ?)
+        )
+        AND {hidden}
+        AND {seek}
+        ORDER BY {order}
+        LIMIT ?
+        ''', (user_id, user_id, *hidden_params, *key, limit))
+        posts = cursor.fetchall()
+        return posts[::-1] if backward else posts
+
+def get_user_posts(user_id, limit=5, page_key=None, backward=False):
+    with db.read() as cursor:
+        seek, order, key = seek_clause(['p.post_date', 'p.post_id'], page_key, backward)
+        cursor.execute(f'''
+        SELECT p.post_id, p.content, p.post_date, p.media_id, p.media_type
+        FROM posts p
+        WHERE p.user_id = ? AND {seek}
+        ORDER BY {order}
+        LIMIT ?
+        ''', (user_id, *key, limit))
+        posts = cursor.fetchall()
+        return posts[::-1] if backward else posts
+
+def get_friend_posts(user_id, limit=5, page_key=None, backward=False):
+    with db.read() as cursor:
+        hidden, hidden_params = block_filter('p.user_id', user_id)
+        seek, order, key = seek_clause(['p.post_date', 'p.post_id'], page_key, backward)
+        cursor.execute(f'''
+        SELECT p.post_id, p.content, p.post_date, u.nickname, p.media_id, p.media_type
+        FROM posts p
+        JOIN users u ON p.user_id = u.user_id
+        WHERE p.user_id IN (
+            SELECT friend_id 
+            FROM friends 
+            WHERE user_id = ? AND status = 'accepted'
+        )
+        AND {hidden}
+        AND {seek}
+        ORDER BY {order}
+        LIMIT ?
+        ''', (user_id, *hidden_params, *key, limit))
+        posts = cursor.fetchall()
+        return posts[::-1] if backward else posts
+
+def get_group_posts(user_id, limit=5, page_key=None, backward=False):
+    with db.read() as cursor:
+        hidden, hidden_params = block_filter('p.user_id', user_id)
+        seek, order, key = seek_clause(['p.post_date', 'p.post_id'], page_key, backward)
+        cursor.execute(f'''
+        SELECT p.post_id, p.content, p.post_date, u.nickname, p.media_id, p.media_type
+        FROM posts p
+        JOIN users u ON p.user_id = u.user_id
+        WHERE p.group_id IN (
+            SELECT group_id 
+            FROM group_members 
+            WHERE user_id = ?
+        )
+        AND {hidden}
+        AND {seek}
+        ORDER BY {order}
+        LIMIT ?
+        ''', (user_id, *hidden_params, *key, limit))
+        posts = cursor.fetchall()
+        return posts[::-1] if backward else posts
 
-def get_trending_hashtags(limit=10):
-    cursor.execute('''
-    SELECT h.name, COUNT(ph.post_id) as post_count
-    FROM hashtags h
-    JOIN post_hashtags ph ON h.hashtag_id = ph.hashtag_id
-    JOIN posts p ON ph.post_id = p.post_id
-    WHERE p.post_date > datetime('now', '-1 day')
-    GROUP BY h.hashtag_id
-    ORDER BY post_count DESC
-    LIMIT ?
-    ''', (limit,))
-    return cursor.fetchall()
+def get_trending_hashtags(limit=10, window='24h', group_id=None):
+    return trends.top(window, group_id, limit)
 
 def like_post(user_id, post_id, reaction='like'):
     if not can_access_post(user_id, post_id):
         return False
     
     try:
-        cursor.execute('''
-        INSERT INTO likes (post_id, user_id, like_date, reaction) 
-        VALUES (?, ?, datetime("now"), ?)
-        ON CONFLICT(post_id, user_id) DO UPDATE SET reaction = ?
-        ''', (post_id, user_id, reaction, reaction))
+        with db.write() as cursor:
+            cursor.execute('SELECT 1 FROM likes WHERE post_id = ? AND user_id = ?', (post_id, user_id))
+            is_new = cursor.fetchone() is None
+            cursor.execute('''
+            INSERT INTO likes (post_id, user_id, like_date, reaction) 
+            VALUES (?, ?, datetime("now"), ?)
+            ON CONFLICT(post_id, user_id) DO UPDATE SET reaction = ?
+            ''', (post_id, user_id, reaction, reaction))
+            if is_new:
+                bump_post_counter(post_id, 'like_count')
         
-        post_author = cursor.execute('SELECT user_id FROM posts WHERE post_id = ?', (post_id,)).fetchone()[0]
-        liker = get_user_by_id(user_id)
+            post_author = cursor.execute('SELECT user_id FROM posts WHERE post_id = ?', (post_id,)).fetchone()[0]
+            liker = get_user_by_id(user_id)
         
-        # Проверяем настройки уведомлений
-        cursor.execute('SELECT notify_likes FROM notification_settings WHERE user_id = ?', (post_author,))
-        setting = cursor.fetchone()
-        if setting and setting[0]:
-            send_notification(post_author, 'like', f'@{liker["nickname"]} поставил реакцию {reaction} на ваш пост', post_id)
+            if is_new:
+                bump_affinity(user_id, post_id, 'like')
         
-        conn.commit()
-        return True
+            # Смена реакции не создает нового уведомления
+            if is_new and notification_enabled(post_author, 'notify_likes'):
+                send_notification(post_author, 'like', f'@{liker["nickname"]} поставил реакцию {reaction} на ваш пост', post_id,
+                                  actor=liker)
+        
+            return True
     except sqlite3.Error as e:
         logger.error(f"Ошибка реакции на пост: {e}")
         return False
@@ -585,46 +2216,47 @@ def comment_post(user_id, post_id, content):
         return False
     
     try:
-        content = validate_text_length(content, 500, "Комментарий")
-        cursor.execute('''
-        INSERT INTO comments (post_id, user_id, content, comment_date)
-        VALUES (?, ?, ?, datetime("now"))
-        ''', (post_id, user_id, content))
+        with db.write() as cursor:
+            content = validate_text_length(content, 500, "Комментарий")
+            cursor.execute('''
+            INSERT INTO comments (post_id, user_id, content, comment_date)
+            VALUES (?, ?, ?, datetime("now"))
+            ''', (post_id, user_id, content))
+            bump_post_counter(post_id, 'comment_count')
+            bump_affinity(user_id, post_id, 'comment')
         
-        post_author = cursor.execute('SELECT user_id FROM posts WHERE post_id = ?', (post_id,)).fetchone()[0]
-        commenter = get_user_by_id(user_id)
+            post_author = cursor.execute('SELECT user_id FROM posts WHERE post_id = ?', (post_id,)).fetchone()[0]
+            commenter = get_user_by_id(user_id)
         
-        # Проверяем настройки уведомлений
-        cursor.execute('SELECT notify_comments FROM notification_settings WHERE user_id = ?', (post_author,))
-        setting = cursor.fetchone()
-        if setting and setting[0]:
-            send_notification(post_author, 'comment', f'Новый комментарий от {commenter["nickname"]}: {content[:50]}...', post_id)
+            # Проверяем настройки уведомлений
+            if notification_enabled(post_author, 'notify_comments'):
+                send_notification(post_author, 'comment', f'Новый комментарий от {commenter["nickname"]}: {content[:50]}...', post_id,
+                                  actor=commenter)
         
-        # Отправляем уведомления об упоминаниях
-        mentions = extract_mentions(content)
-        for mention in mentions:
-            target = get_user_by_nickname(mention)
-            if target:
-                target_id = target['user_id']
-                cursor.execute('SELECT notify_mentions FROM notification_settings WHERE user_id = ?', (target_id,))
-                mention_setting = cursor.fetchone()
-                if mention_setting and mention_setting[0]:
-                    send_notification(target_id, 'mention', 
-                                    f'@{commenter["nickname"]} упомянул вас в комментарии', post_id)
+            # Отправляем уведомления об упоминаниях
+            mentions = extract_mentions(content)
+            for mention in mentions:
+                target = get_user_by_nickname(mention)
+                if target:
+                    target_id = target['user_id']
+                    if notification_enabled(target_id, 'notify_mentions'):
+                        send_notification(target_id, 'mention', 
+                                        f'@{commenter["nickname"]} упомянул вас в комментарии', post_id, actor=commenter)
         
-        conn.commit()
-        return True
+            return True
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Ошибка комментария: {e}")
         return False
 
 def repost(user_id, post_id):
-    original = cursor.execute('SELECT * FROM posts WHERE post_id = ?', (post_id,)).fetchone()
+    with db.read() as cursor:
+        original = cursor.execute('SELECT content, group_id, media_type, media_id FROM posts WHERE post_id = ?',
+                                  (post_id,)).fetchone()
     if not original or not can_access_post(user_id, post_id):
         return None
     
-    _, orig_user_id, content, post_date, group_id, media_type, media_id = original
-    new_post_id = create_post(user_id, f"🔁 Репост: {content}", group_id, media_type, media_id)
+    content, group_id, media_type, media_id = original
+    new_post_id = create_post(user_id, f"🔁 Репост: {content}", group_id, media_type, media_id, repost_of=post_id)
     return new_post_id
 
 # Функции для закладок
@@ -632,120 +2264,135 @@ def add_bookmark(user_id, post_id):
     if not can_access_post(user_id, post_id):
         return False
     try:
-        cursor.execute('INSERT INTO bookmarks (user_id, post_id) VALUES (?, ?)', (user_id, post_id))
-        conn.commit()
-        return True
+        with db.write() as cursor:
+            cursor.execute('INSERT INTO bookmarks (user_id, post_id) VALUES (?, ?)', (user_id, post_id))
+            bump_post_counter(post_id, 'bookmark_count')
+            return True
     except sqlite3.Error:
         return False
 
 def remove_bookmark(user_id, post_id):
-    cursor.execute('DELETE FROM bookmarks WHERE user_id = ? AND post_id = ?', (user_id, post_id))
-    conn.commit()
-    return cursor.rowcount > 0
-
-def get_bookmarks(user_id, limit=10, offset=0):
-    cursor.execute('''
-    SELECT p.post_id, p.content, p.post_date, u.nickname, p.media_id, p.media_type
-    FROM bookmarks b
-    JOIN posts p ON b.post_id = p.post_id
-    JOIN users u ON p.user_id = u.user_id
-    WHERE b.user_id = ?
-    ORDER BY b.created_at DESC
-    LIMIT ? OFFSET ?
-    ''', (user_id, limit, offset))
-    return cursor.fetchall()
+    with db.write() as cursor:
+        cursor.execute('DELETE FROM bookmarks WHERE user_id = ? AND post_id = ?', (user_id, post_id))
+        removed = cursor.rowcount > 0
+        if removed:
+            bump_post_counter(post_id, 'bookmark_count', -1)
+        return removed
+
+def get_bookmarks(user_id, limit=10, page_key=None, backward=False):
+    with db.read() as cursor:
+        seek, order, key = seek_clause(['b.created_at', 'b.bookmark_id'], page_key, backward)
+        cursor.execute(f'''
+        SELECT p.post_id, p.content, p.post_date, u.nickname, p.media_id, p.media_type,
+               b.created_at, b.bookmark_id
+        FROM bookmarks b
+        JOIN posts p ON b.post_id = p.post_id
+        JOIN users u ON p.user_id = u.user_id
+        WHERE b.user_id = ? AND {seek}
+        ORDER BY {order}
+        LIMIT ?
+        ''', (user_id, *key, limit))
+        bookmarks = cursor.fetchall()
+        return bookmarks[::-1] if backward else bookmarks
 
 # Функции для маркета
 def create_market_item(seller_id, title, description, price, media_id=None, media_type=None):
     try:
-        title = validate_text_length(title, 100, "Название товара")
-        description = validate_text_length(description, 500, "Описание товара")
-        if price <= 0:
-            raise ValueError("Цена должна быть положительной")
-        cursor.execute('''
-        INSERT INTO marketplace (seller_id, title, description, price, media_id, media_type)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ''', (seller_id, title, description, price, media_id, media_type))
-        conn.commit()
-        return cursor.lastrowid
+        with db.write() as cursor:
+            title = validate_text_length(title, 100, "Название товара")
+            description = validate_text_length(description, 500, "Описание товара")
+            if price <= 0:
+                raise ValueError("Цена должна быть положительной")
+            cursor.execute('''
+            INSERT INTO marketplace (seller_id, title, description, price, media_id, media_type)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', (seller_id, title, description, price, media_id, media_type))
+            return cursor.lastrowid
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Ошибка создания товара: {e}")
         return None
 
-def get_market_items(limit=10, offset=0):
-    cursor.execute('''
-    SELECT m.item_id, m.title, m.description, m.price, m.created_at, u.nickname, m.media_id, m.media_type
-    FROM marketplace m
-    JOIN users u ON m.seller_id = u.user_id
-    WHERE m.status = 'active'
-    ORDER BY m.created_at DESC
-    LIMIT ? OFFSET ?
-    ''', (limit, offset))
-    return cursor.fetchall()
+def get_market_items(limit=10, page_key=None, backward=False):
+    with db.read() as cursor:
+        seek, order, key = seek_clause(['m.created_at', 'm.item_id'], page_key, backward)
+        cursor.execute(f'''
+        SELECT m.item_id, m.title, m.description, m.price, m.created_at, u.nickname, m.media_id, m.media_type
+        FROM marketplace m
+        JOIN users u ON m.seller_id = u.user_id
+        WHERE m.status = 'active' AND {seek}
+        ORDER BY {order}
+        LIMIT ?
+        ''', (*key, limit))
+        items = cursor.fetchall()
+        return items[::-1] if backward else items
 
 def buy_item(buyer_id, item_id):
-    cursor.execute('SELECT seller_id, price FROM marketplace WHERE item_id = ? AND status = "active"', (item_id,))
-    item = cursor.fetchone()
-    if not item:
-        return "❌ Товар не найден или уже продан"
-    seller_id, price = item
-    balance = get_currency(buyer_id)
-    if balance < price:
-        return "❌ Недостаточно монет"
     try:
-        cursor.execute('UPDATE currencies SET balance = balance - ? WHERE user_id = ?', (price, buyer_id))
-        cursor.execute('UPDATE currencies SET balance = balance + ? WHERE user_id = ?', (price, seller_id))
-        cursor.execute('UPDATE marketplace SET status = "sold" WHERE item_id = ?', (item_id,))
-        conn.commit()
+        # Проверка и списание в одной транзакции писателя - товар не продастся дважды
+        with db.write() as cursor:
+            cursor.execute('SELECT seller_id, price FROM marketplace WHERE item_id = ? AND status = "active"', (item_id,))
+            item = cursor.fetchone()
+            if not item:
+                return "❌ Товар не найден или уже продан"
+            seller_id, price = item
+            balance = get_currency(buyer_id)
+            if balance < price:
+                return "❌ Недостаточно монет"
+            cursor.execute('UPDATE currencies SET balance = balance - ? WHERE user_id = ?', (price, buyer_id))
+            cursor.execute('UPDATE currencies SET balance = balance + ? WHERE user_id = ?', (price, seller_id))
+            cursor.execute('UPDATE marketplace SET status = "sold" WHERE item_id = ?', (item_id,))
+            record_event(buyer_id, 'purchase_made')
         buyer = get_user_by_id(buyer_id)
         send_notification(seller_id, 'item_sold', f'Ваш товар "{item_id}" купил @{buyer["nickname"]}!', item_id)
         return "✅ Покупка успешна!"
     except sqlite3.Error as e:
         logger.error(f"Ошибка покупки: {e}")
-        conn.rollback()
         return "❌ Ошибка покупки"
 
 # Функции для рекламы
 def create_ad(creator_id, content, price, media_id=None, media_type=None):
     try:
-        content = validate_text_length(content, 500, "Текст рекламы")
-        if price < 0:
-            raise ValueError("Цена не может быть отрицательной")
-        cursor.execute('''
-        INSERT INTO ads (creator_id, content, price, media_id, media_type)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (creator_id, content, price, media_id, media_type))
-        conn.commit()
-        return cursor.lastrowid
+        with db.write() as cursor:
+            content = validate_text_length(content, 500, "Текст рекламы")
+            if price < 0:
+                raise ValueError("Цена не может быть отрицательной")
+            cursor.execute('''
+            INSERT INTO ads (creator_id, content, price, media_id, media_type)
+            VALUES (?, ?, ?, ?, ?)
+            ''', (creator_id, content, price, media_id, media_type))
+            return cursor.lastrowid
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Ошибка создания рекламы: {e}")
         return None
 
 def get_ads(limit=5, offset=0):
-    cursor.execute('''
-    SELECT a.ad_id, a.content, a.created_at, u.nickname, a.media_id, a.media_type
-    FROM ads a
-    JOIN users u ON a.creator_id = u.user_id
-    WHERE a.status = 'active'
-    ORDER BY a.created_at DESC
-    LIMIT ? OFFSET ?
-    ''', (limit, offset))
-    return cursor.fetchall()
+    with db.read() as cursor:
+        cursor.execute('''
+        SELECT a.ad_id, a.content, a.created_at, u.nickname, a.media_id, a.media_type
+        FROM ads a
+        JOIN users u ON a.creator_id = u.user_id
+        WHERE a.status = 'active'
+        ORDER BY a.created_at DESC
+        LIMIT ? OFFSET ?
+        ''', (limit, offset))
+        return cursor.fetchall()
 
 # Функции для администрирования
 def appoint_admin(user_id, appointed_by, role='admin'):
     try:
-        cursor.execute('INSERT INTO admins (user_id, role, appointed_at) VALUES (?, ?, datetime("now"))', 
-                      (user_id, role))
-        conn.commit()
-        return True
+        with db.write() as cursor:
+            cursor.execute('INSERT INTO admins (user_id, role, appointed_at) VALUES (?, ?, datetime("now"))', 
+                          (user_id, role))
+            invalidate_cached(admin_cache, user_id)
+            return True
     except sqlite3.Error:
         return False
 
 def remove_admin(user_id):
-    cursor.execute('DELETE FROM admins WHERE user_id = ?', (user_id,))
-    conn.commit()
-    return cursor.rowcount > 0
+    with db.write() as cursor:
+        cursor.execute('DELETE FROM admins WHERE user_id = ?', (user_id,))
+        invalidate_cached(admin_cache, user_id)
+        return cursor.rowcount > 0
 
 def ban_user(admin_id, target_nickname, reason):
     if not is_admin(admin_id):
@@ -755,53 +2402,273 @@ def ban_user(admin_id, target_nickname, reason):
         return "❌ Пользователь не найден"
     target_id = target['user_id']
     try:
-        cursor.execute('INSERT INTO blocks (blocker_id, blocked_id) VALUES (?, ?)', (0, target_id))  # 0 - системный блок
-        cursor.execute('UPDATE users SET is_private = 1 WHERE user_id = ?', (target_id,))
-        conn.commit()
-        send_notification(target_id, 'ban', f'Вы были забанены. Причина: {reason}', admin_id)
-        return f"✅ Пользователь @{target_nickname} забанен"
+        with db.write() as cursor:
+            cursor.execute('INSERT INTO blocks (blocker_id, blocked_id) VALUES (?, ?)', (0, target_id))  # 0 - системный блок
+            db.after_write(lambda: publish('block', 0, target_id))
+            cursor.execute('UPDATE users SET is_private = 1 WHERE user_id = ?', (target_id,))
+            invalidate_cached(user_cache, target_id)
+            send_notification(target_id, 'ban', f'Вы были забанены. Причина: {reason}', admin_id)
+            return f"✅ Пользователь @{target_nickname} забанен"
     except sqlite3.Error:
         return "❌ Ошибка бана"
 
 def review_ad(admin_id, ad_id, approve=True):
-    if not is_admin(admin_id):
-        return "❌ Вы не администратор"
-    status = 'active' if approve else 'rejected'
-    cursor.execute('UPDATE ads SET status = ? WHERE ad_id = ?', (status, ad_id))
-    conn.commit()
-    if cursor.rowcount > 0:
-        ad = cursor.execute('SELECT creator_id, content FROM ads WHERE ad_id = ?', (ad_id,)).fetchone()
-        if ad:
-            creator_id, content = ad
-            send_notification(creator_id, 'ad_review', 
-                            f'Ваша реклама {"одобрена" if approve else "отклонена"}', ad_id)
-        return f"✅ Реклама ID {ad_id} {'одобрена' if approve else 'отклонена'}"
-    return "❌ Реклама не найдена"
+    with db.write() as cursor:
+        if not is_admin(admin_id):
+            return "❌ Вы не администратор"
+        status = 'active' if approve else 'rejected'
+        cursor.execute('UPDATE ads SET status = ? WHERE ad_id = ?', (status, ad_id))
+        if cursor.rowcount > 0:
+            ad = cursor.execute('SELECT creator_id, content FROM ads WHERE ad_id = ?', (ad_id,)).fetchone()
+            if ad:
+                creator_id, content = ad
+                send_notification(creator_id, 'ad_review', 
+                                f'Ваша реклама {"одобрена" if approve else "отклонена"}', ad_id)
+            return f"✅ Реклама ID {ad_id} {'одобрена' if approve else 'отклонена'}"
+        return "❌ Реклама не найдена"
 
 def delete_post(admin_id, post_id):
-    if not is_admin(admin_id):
-        return "❌ Вы не администратор"
-    cursor.execute('DELETE FROM posts WHERE post_id = ?', (post_id,))
-    conn.commit()
-    return "✅ Пост удален" if cursor.rowcount > 0 else "❌ Пост не найден"
+    with db.write() as cursor:
+        if not is_admin(admin_id):
+            return "❌ Вы не администратор"
+        deleted = remove_post(post_id)
+        return "✅ Пост удален" if deleted else "❌ Пост не найден"
 
 # Функции для уведомлений
-def send_notification(user_id, type, content, related_id=None):
+# Уведомления копятся в памяти и пишутся пачками; однотипные события по одному объекту склеиваются
+NOTIFY_FLUSH_INTERVAL = float(os.environ.get('SOCIAL_NOTIFY_FLUSH_SEC', 1.0))
+NOTIFY_BATCH_SIZE = 500
+NOTIFY_PUSH = os.environ.get('SOCIAL_NOTIFY_PUSH', '0') == '1'  # присылать дайджест уведомлений в чат
+NOTIFY_DIGEST_INTERVAL = float(os.environ.get('SOCIAL_NOTIFY_DIGEST_SEC', 60))
+NOTIFY_DIGEST_LINES = 10
+
+# Типы, которые склеиваются в одну непрочитанную запись на (получатель, тип, related_id)
+COALESCED_NOTIFICATIONS = {
+    'like': '@{actor} и еще {others} поставили реакцию на ваш пост',
+    'comment': '@{actor} и еще {others} прокомментировали ваш пост',
+    'mention': '@{actor} и еще {others} упомянули вас в комментариях',
+    'message': 'Новые сообщения от {actor}: {count}',
+}
+
+def coalesced_content(type, content, actor, others, count):
+    template = COALESCED_NOTIFICATIONS[type]
+    if actor and (others > 0 or (count > 1 and '{count}' in template)):
+        content = template.format(actor=actor, others=others, count=count)
+    return content[:200]
+
+class NotificationQueue:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()
+        self.digests = {}
+        self.wakeup = threading.Event()
+        self.sequence = itertools.count()
+        self.bot = None
+        self.loop = None
+        self.last_digest = time.monotonic()
+        self.stats = {'queued': 0, 'coalesced': 0, 'written': 0, 'batches': 0, 'pushed': 0}
+
+    def push(self, user_id, type, content, related_id=None, actor=None):
+        if type in COALESCED_NOTIFICATIONS:
+            key = (user_id, type, related_id)
+        else:
+            key = (user_id, type, next(self.sequence))
+        with self.lock:
+            self.stats['queued'] += 1
+            event = self.pending.get(key)
+            if event is None:
+                event = self.pending[key] = {
+                    'user_id': user_id, 'type': type, 'related_id': related_id,
+                    'content': content, 'actors': {}, 'count': 0,
+                }
+            else:
+                self.stats['coalesced'] += 1
+            event['content'] = content
+            event['count'] += 1
+            if actor:
+                event['actors'].pop(actor['user_id'], None)
+                event['actors'][actor['user_id']] = actor['nickname']
+            full = len(self.pending) >= NOTIFY_BATCH_SIZE
+        if full:
+            self.wakeup.set()
+
+    def _requeue(self, pending):
+        with self.lock:
+            for key, event in pending.items():
+                newer = self.pending.pop(key, None)
+                self.pending[key] = event
+                if newer:
+                    event['content'] = newer['content']
+                    event['count'] += newer['count']
+                    for actor_id, nickname in newer['actors'].items():
+                        event['actors'].pop(actor_id, None)
+                        event['actors'][actor_id] = nickname
+
+    def flush(self, user_id=None):
+        # С user_id пишутся только события этого получателя, остальные ждут общей пачки
+        with self.lock:
+            if user_id is None:
+                pending, self.pending = self.pending, OrderedDict()
+            else:
+                keys = [key for key in self.pending if key[0] == user_id]
+                pending = OrderedDict((key, self.pending.pop(key)) for key in keys)
+        if not pending:
+            return 0
+        written = []
+        try:
+            with db.write() as cursor:
+                for event in pending.values():
+                    written.append((event['user_id'], self._write(cursor, event)))
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка записи уведомлений: {e}")
+            self._requeue(pending)
+            return 0
+        self.stats['written'] += len(written)
+        self.stats['batches'] += 1
+        if NOTIFY_PUSH and self.bot:
+            with self.lock:
+                for user_id, (notification_id, content) in written:
+                    self.digests.setdefault(user_id, {})[notification_id] = content
+        return len(written)
+
+    def _write(self, cursor, event):
+        actor_ids = list(event['actors'])
+        actor = event['actors'][actor_ids[-1]] if actor_ids else None
+        if event['type'] in COALESCED_NOTIFICATIONS:
+            cursor.execute('''
+            SELECT notification_id, actor_ids, event_count FROM notifications
+            WHERE user_id = ? AND type = ? AND related_id IS ? AND is_read = 0
+            ORDER BY notification_id DESC
+            LIMIT 1
+            ''', (event['user_id'], event['type'], event['related_id']))
+            row = cursor.fetchone()
+            if row:
+                notification_id, stored_ids, stored_count = row
+                merged = [i for i in json.loads(stored_ids or '[]') if i not in event['actors']] + actor_ids
+                count = (stored_count or 1) + event['count']
+                content = coalesced_content(event['type'], event['content'], actor, max(len(merged) - 1, 0), count)
+                cursor.execute('''
+                UPDATE notifications SET content = ?, actor_ids = ?, event_count = ?, notification_date = datetime("now")
+                WHERE notification_id = ?
+                ''', (content, json.dumps(merged), count, notification_id))
+                return notification_id, content
+            content = coalesced_content(event['type'], event['content'], actor, max(len(actor_ids) - 1, 0), event['count'])
+        else:
+            content = event['content'][:200]
+        cursor.execute('''
+        INSERT INTO notifications (user_id, type, content, related_id, notification_date, actor_ids, event_count)
+        VALUES (?, ?, ?, ?, datetime("now"), ?, ?)
+        ''', (event['user_id'], event['type'], content, event['related_id'], json.dumps(actor_ids), event['count']))
+        return cursor.lastrowid, content
+
+    def start(self, bot=None, loop=None):
+        self.bot = bot
+        self.loop = loop
+        threading.Thread(target=self._run, name='notifications', daemon=True).start()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(NOTIFY_FLUSH_INTERVAL)
+            self.wakeup.clear()
+            self.flush()
+            if self.digests and time.monotonic() - self.last_digest >= NOTIFY_DIGEST_INTERVAL:
+                self.push_digests()
+
+    def push_digests(self):
+        with self.lock:
+            digests, self.digests = self.digests, {}
+        self.last_digest = time.monotonic()
+        bot, loop = self.bot, self.loop
+        if bot is None or loop is None or loop.is_closed():
+            return
+        for user_id, contents in digests.items():
+            lines = list(contents.values())
+            text = "🔔 Новые уведомления:\n" + "\n".join(f"• {line}" for line in lines[-NOTIFY_DIGEST_LINES:])
+            if len(lines) > NOTIFY_DIGEST_LINES:
+                text += f"\n…и еще {len(lines) - NOTIFY_DIGEST_LINES}"
+            future = asyncio.run_coroutine_threadsafe(
+                bot.send_message(chat_id=user_id, text=text, rate_limit_args={'priority': PRIORITY_BULK}),
+                loop
+            )
+            future.add_done_callback(self._digest_sent)
+
+    def _digest_sent(self, future):
+        if future.exception():
+            logger.error(f"Ошибка отправки дайджеста: {future.exception()}")
+        else:
+            self.stats['pushed'] += 1
+
+    def close(self):
+        self.bot = None
+        self.flush()
+
+notifier = NotificationQueue()
+
+def send_notification(user_id, type, content, related_id=None, actor=None):
     try:
         content = validate_text_length(content, 200, "Уведомление")
-        cursor.execute('''
-        INSERT INTO notifications (user_id, type, content, related_id, notification_date)
-        VALUES (?, ?, ?, ?, datetime("now"))
-        ''', (user_id, type, content, related_id))
-        conn.commit()
-        return True
-    except (ValueError, sqlite3.Error) as e:
+    except ValueError as e:
         logger.error(f"Ошибка уведомления: {e}")
         return False
+    # Событие попадает в очередь только после фиксации транзакции, которая его вызвала
+    db.after_write(lambda: notifier.push(user_id, type, content, related_id, actor))
+    return True
 
 def mark_notification_read(notification_id):
-    cursor.execute('UPDATE notifications SET is_read = 1 WHERE notification_id = ?', (notification_id,))
-    conn.commit()
+    with db.write() as cursor:
+        cursor.execute('UPDATE notifications SET is_read = 1 WHERE notification_id = ?', (notification_id,))
+
+def delete_notification(notification_id):
+    with db.write() as cursor:
+        cursor.execute('DELETE FROM notifications WHERE notification_id = ?', (notification_id,))
+
+def get_unread_notifications(user_id, limit=10):
+    # Дописываем накопленные события этого пользователя, чтобы список был полным
+    notifier.flush(user_id)
+    with db.read() as cursor:
+        cursor.execute('''
+        SELECT notification_id, content, notification_date 
+        FROM notifications 
+        WHERE user_id = ? AND is_read = 0
+        ORDER BY notification_date DESC
+        LIMIT ?
+        ''', (user_id, limit))
+        return cursor.fetchall()
+
+NOTIFICATION_SETTINGS = ('notify_likes', 'notify_comments', 'notify_mentions', 'notify_friend_requests')
+
+def load_notification_settings(user_id):
+    with db.read() as cursor:
+        cursor.execute('SELECT * FROM notification_settings WHERE user_id = ?', (user_id,))
+        return cursor.fetchone()
+
+def notification_enabled(user_id, setting):
+    settings = notification_settings_cache.get(user_id, lambda: load_notification_settings(user_id))
+    return bool(settings and settings[NOTIFICATION_SETTINGS.index(setting) + 1])
+
+def get_notification_settings(user_id):
+    settings = notification_settings_cache.get(user_id, lambda: load_notification_settings(user_id))
+    if settings:
+        return settings
+    with db.write() as cursor:
+        # Создаем настройки по умолчанию
+        cursor.execute('INSERT OR IGNORE INTO notification_settings (user_id) VALUES (?)', (user_id,))
+        invalidate_cached(notification_settings_cache, user_id)
+    return (user_id, 1, 1, 1, 1)
+
+def toggle_notification_setting(user_id, setting):
+    column = f'notify_{setting}'
+    if column not in NOTIFICATION_SETTINGS:
+        return None
+    with db.write() as cursor:
+        cursor.execute(f'''
+        UPDATE notification_settings SET {column} = 1 - COALESCE({column}, 1)
+        WHERE user_id = ?
+        RETURNING {column}
+        ''', (user_id,))
+        row = cursor.fetchone()
+        invalidate_cached(notification_settings_cache, user_id)
+        return row[0] if row else None
 
 # Функции для сообщений
 def send_private_message(sender_id, receiver_nickname, message):
@@ -814,158 +2681,262 @@ def send_private_message(sender_id, receiver_nickname, message):
         return False
     
     try:
-        message = validate_text_length(message, 1000, "Сообщение")
-        cursor.execute('''
-        INSERT INTO messages (sender_id, receiver_id, content, timestamp)
-        VALUES (?, ?, ?, datetime("now"))
-        ''', (sender_id, receiver_id, message))
-        sender = get_user_by_id(sender_id)
-        send_notification(receiver_id, 'message', f'Новое сообщение от {sender["nickname"]}', sender_id)
-        conn.commit()
-        return True
+        with db.write() as cursor:
+            message = validate_text_length(message, 1000, "Сообщение")
+            cursor.execute('''
+            INSERT INTO messages (sender_id, receiver_id, content, timestamp)
+            VALUES (?, ?, ?, datetime("now"))
+            ''', (sender_id, receiver_id, message))
+            sender = get_user_by_id(sender_id)
+            send_notification(receiver_id, 'message', f'Новое сообщение от {sender["nickname"]}', sender_id, actor=sender)
+            return True
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Ошибка сообщения: {e}")
         return False
 
+def get_inbox(user_id, limit=5, page_key=None, backward=False):
+    with db.read() as cursor:
+        seek, order, key = seek_clause(['m.timestamp', 'm.message_id'], page_key, backward)
+        cursor.execute(f'''
+        SELECT m.message_id, u.nickname, m.content, m.timestamp
+        FROM messages m
+        JOIN users u ON m.sender_id = u.user_id
+        WHERE m.receiver_id = ? AND {seek}
+        ORDER BY {order}
+        LIMIT ?
+        ''', (user_id, *key, limit))
+        messages = cursor.fetchall()
+        return messages[::-1] if backward else messages
+
+def get_sent_messages(user_id, limit=5, page_key=None, backward=False):
+    with db.read() as cursor:
+        seek, order, key = seek_clause(['m.timestamp', 'm.message_id'], page_key, backward)
+        cursor.execute(f'''
+        SELECT m.message_id, u.nickname, m.content, m.timestamp
+        FROM messages m
+        JOIN users u ON m.receiver_id = u.user_id
+        WHERE m.sender_id = ? AND {seek}
+        ORDER BY {order}
+        LIMIT ?
+        ''', (user_id, *key, limit))
+        messages = cursor.fetchall()
+        return messages[::-1] if backward else messages
+
 # Функции для групп
 def create_group(user_id, name, description, is_public=True):
     try:
-        name = validate_text_length(name, 50, "Название группы")
-        description = validate_text_length(description, 200, "Описание группы")
-        cursor.execute('''
-        INSERT INTO groups (name, creator_id, description, is_public)
-        VALUES (?, ?, ?, ?)
-        ''', (name, user_id, description, int(is_public)))
-        group_id = cursor.lastrowid
-        cursor.execute('INSERT INTO group_members (group_id, user_id, role) VALUES (?, ?, "admin")', (group_id, user_id))
-        conn.commit()
-        return group_id
+        with db.write() as cursor:
+            name = validate_text_length(name, 50, "Название группы")
+            description = validate_text_length(description, 200, "Описание группы")
+            cursor.execute('''
+            INSERT INTO groups (name, creator_id, description, is_public)
+            VALUES (?, ?, ?, ?)
+            ''', (name, user_id, description, int(is_public)))
+            group_id = cursor.lastrowid
+            cursor.execute('INSERT INTO group_members (group_id, user_id, role) VALUES (?, ?, "admin")', (group_id, user_id))
+            record_event(user_id, 'group_created')
+            return group_id
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Ошибка создания группы: {e}")
         return None
 
 def join_group(user_id, group_id):
-    cursor.execute('SELECT is_public FROM groups WHERE group_id = ?', (group_id,))
-    group = cursor.fetchone()
-    if not group:
-        return False
+    with db.write() as cursor:
+        cursor.execute('SELECT is_public FROM groups WHERE group_id = ?', (group_id,))
+        group = cursor.fetchone()
+        if not group:
+            return False
     
-    is_public = bool(group[0])
-    if not is_public:
-        return False
+        is_public = bool(group[0])
+        if not is_public:
+            return False
     
-    cursor.execute('INSERT OR IGNORE INTO group_members (group_id, user_id) VALUES (?, ?)', (group_id, user_id))
-    conn.commit()
-    return cursor.rowcount > 0
+        cursor.execute('INSERT OR IGNORE INTO group_members (group_id, user_id) VALUES (?, ?)', (group_id, user_id))
+        joined = cursor.rowcount > 0
+        if joined:
+            backfill_timeline_group(user_id, group_id)
+        return joined
+
+def get_user_groups(user_id):
+    with db.read() as cursor:
+        cursor.execute('''
+        SELECT g.group_id, g.name, g.description 
+        FROM groups g
+        JOIN group_members gm ON g.group_id = gm.group_id
+        WHERE gm.user_id = ?
+        ''', (user_id,))
+        return cursor.fetchall()
 
 # Функции для экономики
 def get_currency(user_id):
-    cursor.execute('SELECT balance FROM currencies WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    return result[0] if result else 0
+    with db.read() as cursor:
+        cursor.execute('SELECT balance FROM currencies WHERE user_id = ?', (user_id,))
+        result = cursor.fetchone()
+        return result[0] if result else 0
 
 def add_currency(user_id, amount):
-    cursor.execute('UPDATE currencies SET balance = balance + ? WHERE user_id = ?', (amount, user_id))
-    conn.commit()
+    with db.write() as cursor:
+        cursor.execute('UPDATE currencies SET balance = balance + ? WHERE user_id = ?', (amount, user_id))
 
 def daily_bonus(user_id):
     try:
-        today = datetime.date.today().isoformat()
-        cursor.execute('SELECT last_claim FROM currencies WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        last_claim = result[0] if result else None
+        with db.write() as cursor:
+            today = datetime.date.today().isoformat()
+            cursor.execute('SELECT last_claim FROM currencies WHERE user_id = ?', (user_id,))
+            result = cursor.fetchone()
+            last_claim = result[0] if result else None
         
-        if last_claim is None or last_claim != today:
-            add_currency(user_id, 10)
-            cursor.execute('UPDATE currencies SET last_claim = ? WHERE user_id = ?', (today, user_id))
-            conn.commit()
-            return True
-        return False
+            if last_claim is None or last_claim != today:
+                add_currency(user_id, 10)
+                cursor.execute('UPDATE currencies SET last_claim = ? WHERE user_id = ?', (today, user_id))
+                return True
+            return False
     except sqlite3.Error as e:
         logger.error(f"Ошибка бонуса: {e}")
         return False
 
 def transfer_currency(sender_id, receiver_nickname, amount):
     try:
-        amount = int(amount)
-        if amount <= 0:
-            return "❌ Сумма должна быть положительной"
+        with db.write() as cursor:
+            amount = int(amount)
+            if amount <= 0:
+                return "❌ Сумма должна быть положительной"
         
-        sender_balance = get_currency(sender_id)
-        if sender_balance < amount:
-            return "❌ Недостаточно средств"
+            sender_balance = get_currency(sender_id)
+            if sender_balance < amount:
+                return "❌ Недостаточно средств"
         
-        receiver = get_user_by_nickname(receiver_nickname)
-        if not receiver:
-            return "❌ Пользователь не найден"
+            receiver = get_user_by_nickname(receiver_nickname)
+            if not receiver:
+                return "❌ Пользователь не найден"
         
-        receiver_id = receiver['user_id']
-        if sender_id == receiver_id:
-            return "❌ Нельзя переводить самому себе"
+            receiver_id = receiver['user_id']
+            if sender_id == receiver_id:
+                return "❌ Нельзя переводить самому себе"
         
-        if is_blocked(receiver_id, sender_id) or is_blocked(sender_id, receiver_id):
-            return "❌ Пользователь заблокирован"
+            if is_blocked(receiver_id, sender_id) or is_blocked(sender_id, receiver_id):
+                return "❌ Пользователь заблокирован"
         
-        cursor.execute('UPDATE currencies SET balance = balance - ? WHERE user_id = ?', (amount, sender_id))
-        cursor.execute('UPDATE currencies SET balance = balance + ? WHERE user_id = ?', (amount, receiver_id))
-        conn.commit()
+            cursor.execute('UPDATE currencies SET balance = balance - ? WHERE user_id = ?', (amount, sender_id))
+            cursor.execute('UPDATE currencies SET balance = balance + ? WHERE user_id = ?', (amount, receiver_id))
         
-        sender = get_user_by_id(sender_id)
-        send_notification(receiver_id, 'transfer', f'Вы получили {amount} монет от {sender["nickname"]}', sender_id)
-        return f"✅ Успешно переведено {amount} монет пользователю @{receiver_nickname}"
+            sender = get_user_by_id(sender_id)
+            send_notification(receiver_id, 'transfer', f'Вы получили {amount} монет от {sender["nickname"]}', sender_id)
+            return f"✅ Успешно переведено {amount} монет пользователю @{receiver_nickname}"
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Ошибка перевода: {e}")
         return "❌ Ошибка перевода"
 
 # Функции для поиска
+# Окончания русских слов: отбрасываем у запроса, чтобы префиксный поиск находил другие формы
+RUSSIAN_ENDINGS = sorted((
+    'ами', 'ями', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ых', 'их', 'ой', 'ей', 'ий', 'ый',
+    'ая', 'яя', 'ое', 'ее', 'ую', 'юю', 'ам', 'ям', 'ах', 'ях', 'ов', 'ев', 'ом', 'ем',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь',
+), key=len, reverse=True)
+
+def fts_query(keyword):
+    terms = []
+    for word in re.findall(r'\w+', keyword.lower().replace('ё', 'е')):
+        if re.fullmatch(r'[а-я]+', word) and len(word) > 3:
+            for ending in RUSSIAN_ENDINGS:
+                if word.endswith(ending) and len(word) - len(ending) >= 3:
+                    word = word[:-len(ending)]
+                    break
+        terms.append(f'"{word}"*')
+    return ' '.join(terms)
+
 def search_users(keyword):
-    cursor.execute('SELECT user_id, nickname FROM users WHERE nickname LIKE ? ORDER BY nickname LIMIT 20', (f'%{keyword}%',))
-    return cursor.fetchall()
+    query = fts_query(keyword)
+    if not query:
+        return []
+    with db.read() as cursor:
+        cursor.execute('''
+        SELECT u.user_id, u.nickname
+        FROM users_fts f
+        JOIN users u ON u.user_id = f.rowid
+        WHERE users_fts MATCH ?
+        ORDER BY bm25(users_fts, 10.0, 1.0)
+        LIMIT 20
+        ''', (query,))
+        return cursor.fetchall()
 
 def search_groups(keyword):
-    cursor.execute('SELECT group_id, name, description FROM groups WHERE name LIKE ? AND is_public = 1 ORDER BY name LIMIT 10', (f'%{keyword}%',))
-    return cursor.fetchall()
+    query = fts_query(keyword)
+    if not query:
+        return []
+    with db.read() as cursor:
+        cursor.execute('''
+        SELECT g.group_id, g.name, g.description
+        FROM groups_fts f
+        JOIN groups g ON g.group_id = f.rowid
+        WHERE groups_fts MATCH ? AND g.is_public = 1
+        ORDER BY bm25(groups_fts, 5.0, 1.0)
+        LIMIT 10
+        ''', (query,))
+        return cursor.fetchall()
+
+def search_market(keyword, limit=10):
+    query = fts_query(keyword)
+    if not query:
+        return []
+    with db.read() as cursor:
+        cursor.execute('''
+        SELECT m.item_id, m.title, m.price, u.nickname
+        FROM market_fts f
+        JOIN marketplace m ON m.item_id = f.rowid
+        JOIN users u ON m.seller_id = u.user_id
+        WHERE market_fts MATCH ? AND m.status = 'active'
+        ORDER BY bm25(market_fts, 5.0, 1.0)
+        LIMIT ?
+        ''', (query, limit))
+        return cursor.fetchall()
 
 def search_posts_by_hashtag(hashtag):
-    cursor.execute('''
-    SELECT p.post_id, p.content, u.nickname
-    FROM posts p
-    JOIN users u ON p.user_id = u.user_id
-    JOIN post_hashtags ph ON p.post_id = ph.post_id
-    JOIN hashtags h ON ph.hashtag_id = h.hashtag_id
-    WHERE h.name = ?
-    ORDER BY p.post_date DESC
-    LIMIT 20
-    ''', (hashtag.lower(),))
-    return cursor.fetchall()
+    with db.read() as cursor:
+        cursor.execute('''
+        SELECT p.post_id, p.content, u.nickname
+        FROM posts p
+        JOIN users u ON p.user_id = u.user_id
+        JOIN post_hashtags ph ON p.post_id = ph.post_id
+        JOIN hashtags h ON ph.hashtag_id = h.hashtag_id
+        WHERE h.name = ?
+        ORDER BY p.post_date DESC
+        LIMIT 20
+        ''', (hashtag.lower(),))
+        return cursor.fetchall()
 
 def search_content(keyword, user_id, limit=20):
-    cursor.execute('''
-    SELECT p.post_id, p.content, p.post_date, u.nickname, p.media_id, p.media_type
-    FROM posts p
-    JOIN users u ON p.user_id = u.user_id
-    WHERE p.content LIKE ?
-    AND (p.user_id IN (SELECT friend_id FROM friends WHERE user_id = ? AND status = 'accepted')
-         OR p.group_id IN (SELECT group_id FROM group_members WHERE user_id = ?)
-         OR p.user_id = ?)
-    AND NOT EXISTS (SELECT 1 FROM blocks 
-                   WHERE (blocker_id = ? AND blocked_id = p.user_id)
-                   OR (blocker_id = p.user_id AND blocked_id = ?))
-    ORDER BY p.post_date DESC
-    LIMIT ?
-    ''', (f'%{keyword}%', user_id, user_id, user_id, user_id, user_id, limit))
-    return cursor.fetchall()
+    query = fts_query(keyword)
+    if not query:
+        return []
+    with db.read() as cursor:
+        hidden, hidden_params = block_filter('p.user_id', user_id)
+        cursor.execute(f'''
+        SELECT p.post_id, p.content, p.post_date, u.nickname, p.media_id, p.media_type
+        FROM posts_fts f
+        JOIN posts p ON p.post_id = f.rowid
+        JOIN users u ON p.user_id = u.user_id
+        WHERE posts_fts MATCH ?
+        AND (p.user_id IN (SELECT friend_id FROM friends WHERE user_id = ? AND status = 'accepted')
+             OR p.group_id IN (SELECT group_id FROM group_members WHERE user_id = ?)
+             OR p.user_id = ?)
+        AND {hidden}
+        ORDER BY f.rank
+        LIMIT ?
+        ''', (query, user_id, user_id, user_id, *hidden_params, limit))
+        return cursor.fetchall()
 
 # Функции для жалоб
 def create_report(reporter_id, target_id, target_type, reason):
     try:
-        reason = validate_text_length(reason, 200, "Причина жалобы")
-        cursor.execute('''
-        INSERT INTO reports (reporter_id, target_id, target_type, reason)
-        VALUES (?, ?, ?, ?)
-        ''', (reporter_id, target_id, target_type, reason))
-        conn.commit()
-        return True
+        with db.write() as cursor:
+            reason = validate_text_length(reason, 200, "Причина жалобы")
+            cursor.execute('''
+            INSERT INTO reports (reporter_id, target_id, target_type, reason)
+            VALUES (?, ?, ?, ?)
+            ''', (reporter_id, target_id, target_type, reason))
+            return True
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Ошибка жалобы: {e}")
         return False
@@ -973,91 +2944,533 @@ def create_report(reporter_id, target_id, target_type, reason):
 # Новые функции для историй
 def create_story(user_id, content=None, media_id=None, media_type=None):
     try:
-        if content:
-            content = validate_text_length(content, 200, "Текст истории")
-        cursor.execute('''
-        INSERT INTO stories (user_id, content, media_id, media_type)
-        VALUES (?, ?, ?, ?)
-        ''', (user_id, content, media_id, media_type))
-        conn.commit()
-        return cursor.lastrowid
+        with db.write() as cursor:
+            if content:
+                content = validate_text_length(content, 200, "Текст истории")
+            cursor.execute('''
+            INSERT INTO stories (user_id, content, media_id, media_type)
+            VALUES (?, ?, ?, ?)
+            ''', (user_id, content, media_id, media_type))
+            return cursor.lastrowid
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Ошибка создания истории: {e}")
         return None
 
 def get_stories(user_id, limit=10):
+    with db.read() as cursor:
+        hidden, hidden_params = block_filter('s.user_id', user_id)
+        cursor.execute(f'''
+        SELECT s.story_id, s.content, s.created_at, u.nickname, s.media_id, s.media_type
+        FROM stories s
+        JOIN users u ON s.user_id = u.user_id
+        WHERE (s.user_id IN (SELECT friend_id FROM friends WHERE user_id = ? AND status = 'accepted')
+               OR s.user_id = ?)
+        AND s.expires_at > datetime('now')
+        AND {hidden}
+        ORDER BY s.created_at DESC
+        LIMIT ?
+        ''', (user_id, user_id, *hidden_params, limit))
+        return cursor.fetchall()
+
+# Рассылка уведомлений всем участникам группы: задание пишется вместе с событием,
+# а фоновый поток вставляет уведомления порциями и помнит, до какого участника дошел
+BROADCAST_CHUNK = int(os.environ.get('SOCIAL_BROADCAST_CHUNK', 1000))
+BROADCAST_PAUSE = 0.01  # секунд между порциями: писатель освобождается для обработчиков
+broadcast_wakeup = threading.Event()
+
+def enqueue_broadcast(cursor, group_id, type, content, related_id=None):
     cursor.execute('''
-    SELECT s.story_id, s.content, s.created_at, u.nickname, s.media_id, s.media_type
-    FROM stories s
-    JOIN users u ON s.user_id = u.user_id
-    WHERE (s.user_id IN (SELECT friend_id FROM friends WHERE user_id = ? AND status = 'accepted')
-           OR s.user_id = ?)
-    AND s.expires_at > datetime('now')
-    AND NOT EXISTS (SELECT 1 FROM blocks 
-                   WHERE (blocker_id = ? AND blocked_id = s.user_id)
-                   OR (blocker_id = s.user_id AND blocked_id = ?))
-    ORDER BY s.created_at DESC
-    LIMIT ?
-    ''', (user_id, user_id, user_id, user_id, limit))
-    return cursor.fetchall()
+    INSERT INTO broadcast_jobs (group_id, type, content, related_id, total)
+    VALUES (?, ?, ?, ?, (SELECT COUNT(*) FROM group_members WHERE group_id = ?))
+    ''', (group_id, type, content, related_id, group_id))
+    db.after_write(lambda: publish('broadcast'))
+    return cursor.lastrowid
+
+def broadcast_chunk(chunk=BROADCAST_CHUNK):
+    # Одна порция в одной транзакции вместе с позицией задания: после сбоя рассылка продолжится без дублей
+    with db.write() as cursor:
+        row = cursor.execute('''
+        SELECT job_id, group_id, type, content, related_id, last_user_id
+        FROM broadcast_jobs WHERE status = 'pending'
+        ORDER BY job_id
+        LIMIT 1
+        ''').fetchone()
+        if row is None:
+            return False
+        job_id, group_id, type, content, related_id, last_user_id = row
+        cursor.execute('''
+        INSERT INTO notifications (user_id, type, content, related_id, notification_date)
+        SELECT user_id, ?, ?, ?, datetime('now')
+        FROM group_members
+        WHERE group_id = ? AND user_id > ?
+        ORDER BY user_id
+        LIMIT ?
+        RETURNING user_id
+        ''', (type, content, related_id, group_id, last_user_id, chunk))
+        recipients = [recipient for recipient, in cursor.fetchall()]
+        if recipients:
+            cursor.execute('''
+            UPDATE broadcast_jobs SET last_user_id = ?, sent = sent + ? WHERE job_id = ?
+            ''', (max(recipients), len(recipients), job_id))
+        if len(recipients) < chunk:
+            cursor.execute("UPDATE broadcast_jobs SET status = 'done' WHERE job_id = ?", (job_id,))
+            logger.info(f"Рассылка {job_id} завершена")
+        return True
+
+def run_broadcasts():
+    # Незавершенные задания (в том числе оставшиеся после перезапуска) подхватываются сразу
+    while True:
+        try:
+            while broadcast_chunk():
+                time.sleep(BROADCAST_PAUSE)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка рассылки: {e}")
+        broadcast_wakeup.wait(60)
+        broadcast_wakeup.clear()
+
+def get_broadcast_progress(limit=5):
+    with db.read() as cursor:
+        cursor.execute('''
+        SELECT job_id, type, related_id, sent, total
+        FROM broadcast_jobs WHERE status = 'pending'
+        ORDER BY job_id
+        LIMIT ?
+        ''', (limit,))
+        return cursor.fetchall()
 
 # Новые функции для трансляций
 def start_live_stream(user_id, group_id, title):
     if not is_member(user_id, group_id):
         return None
     try:
-        title = validate_text_length(title, 100, "Название трансляции")
-        cursor.execute('''
-        INSERT INTO live_streams (user_id, group_id, title)
-        VALUES (?, ?, ?)
-        ''', (user_id, group_id, title))
-        stream_id = cursor.lastrowid
-        cursor.execute('''
-        INSERT INTO notifications (user_id, type, content, related_id, notification_date)
-        SELECT gm.user_id, 'live_stream', ?, ?, datetime('now')
-        FROM group_members gm WHERE gm.group_id = ?
-        ''', (f'@{get_user_by_id(user_id)["nickname"]} начал трансляцию: {title}', stream_id, group_id))
-        conn.commit()
-        return stream_id
+        with db.write() as cursor:
+            title = validate_text_length(title, 100, "Название трансляции")
+            cursor.execute('''
+            INSERT INTO live_streams (user_id, group_id, title)
+            VALUES (?, ?, ?)
+            ''', (user_id, group_id, title))
+            stream_id = cursor.lastrowid
+            enqueue_broadcast(cursor, group_id, 'live_stream',
+                              f'@{get_user_by_id(user_id)["nickname"]} начал трансляцию: {title}', stream_id)
+            return stream_id
     except (ValueError, sqlite3.Error) as e:
         logger.error(f"Ошибка создания трансляции: {e}")
         return None
 
 def end_live_stream(stream_id):
-    cursor.execute('UPDATE live_streams SET status = "ended" WHERE stream_id = ?', (stream_id,))
-    conn.commit()
-    return cursor.rowcount > 0
+    with db.write() as cursor:
+        cursor.execute('UPDATE live_streams SET status = "ended" WHERE stream_id = ?', (stream_id,))
+        return cursor.rowcount > 0
 
 # Новые функции для достижений
 def award_achievement(user_id, type, description):
+    # Уникальный индекс (user_id, type) не дает выдать значок дважды
     try:
-        cursor.execute('INSERT INTO achievements (user_id, type, description) VALUES (?, ?, ?)', 
-                      (user_id, type, description))
-        conn.commit()
-        send_notification(user_id, 'achievement', f'🏆 Новое достижение: {description}', None)
-        return True
+        with db.write() as cursor:
+            cursor.execute('INSERT OR IGNORE INTO achievements (user_id, type, description) VALUES (?, ?, ?)', 
+                          (user_id, type, description))
+            if cursor.rowcount == 0:
+                return False
+            send_notification(user_id, 'achievement', f'🏆 Новое достижение: {description}', None)
+            return True
     except sqlite3.Error:
         return False
 
+def record_event(user_id, event):
+    # Доменное событие: один счетчик и проверка его порогов, без пересчета по таблицам
+    column, thresholds = ACHIEVEMENT_RULES[event]
+    count = bump_user_stat(user_id, column)
+    for threshold, type, description in thresholds:
+        if count == threshold:
+            award_achievement(user_id, type, description)
+    return count
+
 def check_achievements(user_id):
-    # Проверка достижений при различных действиях
-    cursor.execute('SELECT COUNT(*) FROM posts WHERE user_id = ?', (user_id,))
-    post_count = cursor.fetchone()[0]
-    if post_count >= 10:
-        award_achievement(user_id, 'active_poster', 'Опубликовал 10 постов')
-    
-    cursor.execute('SELECT COUNT(*) FROM friends WHERE user_id = ? AND status = "accepted"', (user_id,))
-    friend_count = cursor.fetchone()[0]
-    if friend_count >= 5:
-        award_achievement(user_id, 'social_butterfly', 'Завел 5 друзей')
-    
-    cursor.execute('SELECT COUNT(*) FROM groups WHERE creator_id = ?', (user_id,))
-    group_count = cursor.fetchone()[0]
-    if group_count >= 3:
-        award_achievement(user_id, 'group_leader', 'Создал 3 группы')
-
-# Клавиатуры
+    # Выдает значки, пороги которых уже пройдены по счетчикам user_stats (события могли пройти мимо)
+    columns = sorted({column for column, _ in ACHIEVEMENT_RULES.values()})
+    with db.write() as cursor:
+        cursor.execute(f'SELECT {", ".join(columns)} FROM user_stats WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
+        if not row:
+            return
+        counts = dict(zip(columns, row))
+        for column, thresholds in ACHIEVEMENT_RULES.values():
+            for threshold, type, description in thresholds:
+                if counts[column] >= threshold:
+                    award_achievement(user_id, type, description)
+
+def get_achievements(user_id):
+    with db.read() as cursor:
+        cursor.execute('SELECT type, description, earned_at FROM achievements WHERE user_id = ?', (user_id,))
+        return cursor.fetchall()
+
+def count_achievements(user_id):
+    with db.read() as cursor:
+        cursor.execute('SELECT COUNT(*) FROM achievements WHERE user_id = ?', (user_id,))
+        return cursor.fetchone()[0]
+
+# Статистика пользователя
+def get_user_stats(user_id):
+    with db.read() as cursor:
+        cursor.execute('''
+        SELECT post_count, likes_received, comments_received, reposts_received, bookmarks_received,
+               friend_count, groups_created
+        FROM user_stats WHERE user_id = ?
+        ''', (user_id,))
+        stats = dict(zip(
+            ('post_count', 'likes_received', 'comments_received', 'reposts_received', 'bookmarks_received',
+             'friend_count', 'group_count'),
+            cursor.fetchone() or (0, 0, 0, 0, 0, 0, 0)
+        ))
+    
+        stats['ach_count'] = count_achievements(user_id)
+        stats['balance'] = get_currency(user_id)
+    
+        # Анализ активности за неделю
+        cursor.execute('''
+        SELECT strftime('%Y-%m-%d', post_date) AS day, COUNT(*) 
+        FROM posts 
+        WHERE user_id = ? AND post_date > datetime('now', '-7 days')
+        GROUP BY day
+        ORDER BY day DESC
+        ''', (user_id,))
+        stats['weekly_activity'] = cursor.fetchall()
+        return stats
+
+# Исходящие сообщения: все запросы бота к Telegram проходят через очередь с ограничением частоты
+SEND_GLOBAL_RATE = 30        # сообщений в секунду на весь бот
+SEND_CHAT_RATE = 1           # в личный чат (короткие всплески до SEND_CHAT_BURST)
+SEND_CHAT_BURST = 5
+SEND_GROUP_RATE = 20 / 60    # в групповой чат
+SEND_GROUP_BURST = 3
+SEND_WORKERS = 8
+SEND_MAX_RETRIES = 3
+PRIORITY_INTERACTIVE = 0     # ответы на действия пользователя
+PRIORITY_BULK = 1            # рассылки и уведомления, передаются через rate_limit_args={'priority': PRIORITY_BULK}
+
+class RateBudget:
+    # Токен-бакет с резервированием: reserve() сразу списывает токен и возвращает, сколько ждать
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        self._refill()
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def penalize(self, delay):
+        # Telegram прислал RetryAfter: через delay в бакете будет не больше одного токена
+        self._refill()
+        self.tokens = min(self.tokens, 1) - delay * self.rate
+
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+class SendScheduler(BaseRateLimiter):
+    # Очередь с приоритетами: интерактивные ответы раньше массовых рассылок.
+    # Запрос, которому еще рано в свой чат, откладывается таймером и не занимает обработчик очереди.
+    def __init__(self, workers=SEND_WORKERS):
+        self.workers = workers
+        self.global_budget = RateBudget(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+        self.chat_budgets = {}
+        self.stats = {'sent': 0, 'retries': 0, 'failed': 0, 'delayed': 0}
+        self._latencies = deque(maxlen=1000)
+        self._sequence = itertools.count()
+        self._queue = None
+        self._tasks = []
+
+    async def initialize(self):
+        # PTB вызывает initialize и из Application, и из Updater: второй вызов не должен плодить обработчики
+        if self._queue is not None:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if chat_id is None or self._queue is None:
+            # getUpdates, answerCallbackQuery и прочие запросы без чата не ограничиваем
+            return await callback(*args, **kwargs)
+        priority = (rate_limit_args or {}).get('priority', PRIORITY_INTERACTIVE)
+        request = {
+            'callback': callback, 'args': args, 'kwargs': kwargs, 'chat_id': chat_id,
+            'future': asyncio.get_running_loop().create_future(),
+            'queued_at': time.monotonic(), 'attempt': 0, 'reserved': False,
+        }
+        self._put(priority, request)
+        return await request['future']
+
+    def _put(self, priority, request):
+        self._queue.put_nowait((priority, next(self._sequence), request))
+
+    def _chat_budget(self, chat_id):
+        budget = self.chat_budgets.get(chat_id)
+        if budget is None:
+            if len(self.chat_budgets) > 10000:
+                self.chat_budgets = {key: value for key, value in self.chat_budgets.items() if not value.idle()}
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            budget = RateBudget(SEND_GROUP_RATE, SEND_GROUP_BURST) if is_group else RateBudget(SEND_CHAT_RATE, SEND_CHAT_BURST)
+            self.chat_budgets[chat_id] = budget
+        return budget
+
+    def _defer(self, priority, request, delay):
+        self.stats['delayed'] += 1
+        asyncio.get_running_loop().call_later(delay, self._put, priority, request)
+
+    async def _worker(self):
+        while True:
+            priority, _, request = await self._queue.get()
+            if request['future'].done():
+                continue
+            if not request['reserved']:
+                request['reserved'] = True
+                delay = self._chat_budget(request['chat_id']).reserve()
+                if delay > 0:
+                    self._defer(priority, request, delay)
+                    continue
+            await asyncio.sleep(self.global_budget.reserve())
+            try:
+                result = await request['callback'](*request['args'], **request['kwargs'])
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if hasattr(retry_after, 'total_seconds'):
+                    retry_after = retry_after.total_seconds()
+                self._retry(priority, request, retry_after, e, penalize=True)
+            except TimedOut as e:
+                # Запрос мог дойти до Telegram: повтор продублировал бы сообщение
+                self._fail(request, e)
+            except NetworkError as e:
+                self._retry(priority, request, 0.5 * 2 ** request['attempt'], e)
+            except Exception as e:
+                self._fail(request, e)
+            else:
+                self.stats['sent'] += 1
+                self._latencies.append(time.monotonic() - request['queued_at'])
+                if not request['future'].done():
+                    request['future'].set_result(result)
+
+    def _fail(self, request, error):
+        self.stats['failed'] += 1
+        if not request['future'].done():
+            request['future'].set_exception(error)
+
+    def _retry(self, priority, request, delay, error, penalize=False):
+        if request['attempt'] >= SEND_MAX_RETRIES:
+            self._fail(request, error)
+            return
+        request['attempt'] += 1
+        self.stats['retries'] += 1
+        if penalize:
+            self._chat_budget(request['chat_id']).penalize(delay)
+        request['reserved'] = False
+        self._defer(priority, request, delay)
+
+    def metrics(self):
+        latencies = sorted(self._latencies)
+        def percentile(share):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * share))] * 1000 if latencies else 0
+        return dict(
+            self.stats,
+            queue_depth=self._queue.qsize() if self._queue else 0,
+            latency_p50_ms=percentile(0.5),
+            latency_p95_ms=percentile(0.95),
+            latency_max_ms=latencies[-1] * 1000 if latencies else 0,
+        )
+
+send_scheduler = SendScheduler()
+
+# Состояние диалогов (context.user_data): хранится в базе одной JSON-строкой на пользователя,
+# загружается при первом обращении и выгружается из памяти после простоя
+STATE_TTL = float(os.environ.get('SOCIAL_STATE_TTL', 86400))    # секунд: брошенные сценарии забываются
+STATE_IDLE = float(os.environ.get('SOCIAL_STATE_IDLE', 900))    # секунд без обновлений до выгрузки из памяти
+STATE_FLUSH_INTERVAL = 10
+STATE_SWEEP_INTERVAL = 60
+
+def load_user_state(user_id):
+    with db.read() as cursor:
+        cursor.execute('SELECT data FROM user_state WHERE user_id = ? AND updated_at >= ?',
+                       (user_id, time.time() - STATE_TTL))
+        row = cursor.fetchone()
+    return json.loads(row[0]) if row else {}
+
+def save_user_states(states):
+    # Сериализуем до транзакции и по одному пользователю: несериализуемые данные одного
+    # пользователя не должны срывать сохранение остальных
+    rows, empty = [], []
+    for user_id, data in states.items():
+        if not data:
+            empty.append((user_id,))
+            continue
+        try:
+            rows.append((user_id, json.dumps(data, ensure_ascii=False, separators=(',', ':'))))
+        except (TypeError, ValueError) as e:
+            logger.error(f"Состояние пользователя {user_id} не сохранено: {e}")
+    now = time.time()
+    with db.write() as cursor:
+        cursor.executemany('''
+        INSERT OR REPLACE INTO user_state (user_id, data, updated_at) VALUES (?, ?, ?)
+        ''', [(user_id, data, now) for user_id, data in rows])
+        cursor.executemany('DELETE FROM user_state WHERE user_id = ?', empty)
+
+def purge_user_state():
+    with db.write() as cursor:
+        cursor.execute('DELETE FROM user_state WHERE updated_at < ?', (time.time() - STATE_TTL,))
+        return cursor.rowcount
+
+class StateStore(BasePersistence):
+    # Хранит только user_data; данные чатов, бота и ConversationHandler боту не нужны
+    def __init__(self):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=STATE_FLUSH_INTERVAL
+        )
+        self.loaded = {}
+        self.seen = {}
+        self.evicting = set()
+        self.dirty = set()  # обработанные обновления, чьи данные еще не записаны в базу
+        self.stats = {'loads': 0, 'saves': 0, 'evictions': 0, 'expired': 0}
+        self._sweeper = None
+        self._application = None
+
+    async def get_user_data(self):
+        # Ничего не читаем при старте: состояние подгружается в refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        self.seen[user_id] = time.monotonic()
+        self.dirty.add(user_id)
+        loading = self.loaded.get(user_id)
+        if loading is None:
+            loading = self.loaded[user_id] = asyncio.ensure_future(run_db(load_user_state, user_id))
+            self.stats['loads'] += 1
+            try:
+                stored = await loading
+            except Exception:
+                self.loaded.pop(user_id, None)
+                raise
+            for key, value in stored.items():
+                user_data.setdefault(key, value)
+        else:
+            # Параллельное обновление того же пользователя ждет первую загрузку
+            await loading
+
+    async def update_user_data(self, user_id, data):
+        self.stats['saves'] += 1
+        self.dirty.discard(user_id)
+        await run_db(save_user_states, {user_id: data})
+
+    async def drop_user_data(self, user_id):
+        if user_id in self.evicting:
+            # Выгрузка из памяти, а не удаление: запись в базе остается
+            self.evicting.discard(user_id)
+            return
+        self.loaded.pop(user_id, None)
+        self.seen.pop(user_id, None)
+        self.dirty.discard(user_id)
+        await run_db(save_user_states, {user_id: {}})
+
+    async def evict_idle(self, application):
+        started = time.monotonic()
+        idle = [user_id for user_id, seen in self.seen.items() if started - seen > STATE_IDLE]
+        if not idle:
+            return 0
+        self.dirty.difference_update(idle)
+        await run_db(save_user_states, {user_id: dict(application.user_data.get(user_id, {})) for user_id in idle})
+        evicted = 0
+        for user_id in idle:
+            if self.seen.get(user_id, started) > started:
+                continue  # пользователь вернулся, пока сохраняли
+            self.seen.pop(user_id, None)
+            self.loaded.pop(user_id, None)
+            self.evicting.add(user_id)
+            application.drop_user_data(user_id)
+            evicted += 1
+        self.stats['evictions'] += evicted
+        return evicted
+
+    def start(self, application):
+        self._application = application
+        self._sweeper = asyncio.create_task(self._sweep(application))
+
+    async def _sweep(self, application):
+        while True:
+            await asyncio.sleep(STATE_SWEEP_INTERVAL)
+            try:
+                await self.evict_idle(application)
+                self.stats['expired'] += await run_db(purge_user_state)
+            except Exception as e:
+                logger.error(f"Ошибка выгрузки состояний: {e}")
+
+    async def flush(self):
+        # При остановке дописываем все, что не успела записать периодическая выгрузка
+        if self._sweeper:
+            self._sweeper.cancel()
+        if self._application is None or not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, set()
+        await run_db(save_user_states,
+                     {user_id: dict(self._application.user_data.get(user_id, {})) for user_id in dirty})
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    def metrics(self):
+        return dict(self.stats, in_memory=len(self.seen))
+
+state_store = StateStore()
+
+# Клавиатуры: разметка неизменяема, поэтому постоянные клавиатуры строятся при первом показе и переиспользуются
 def main_menu_keyboard(user_id):
+    return main_menu_markup(is_admin(user_id))
+
+@functools.cache
+def main_menu_markup(admin):
     keyboard = [
         ['👤 Профиль', '📰 Лента', '📑 Закладки'],
         ['📝 Создать пост', '💬 Сообщения', '👥 Группы'],
@@ -1065,10 +3478,11 @@ def main_menu_keyboard(user_id):
         ['🔔 Уведомления', '⚙️ Настройки', 'ℹ️ Помощь'],
         ['❌ Отмена']
     ]
-    if is_admin(user_id):
+    if admin:
         keyboard.insert(0, ['🛠️ Админ-панель'])
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
 
+@functools.cache
 def profile_menu_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("✏️ Изменить никнейм", callback_data='change_nickname'),
@@ -1082,7 +3496,16 @@ def profile_menu_keyboard():
         [InlineKeyboardButton("🔙 Назад в меню", callback_data='main_menu')]
     ])
 
-def feed_menu_keyboard(offset):
+def feed_menu_keyboard(page, prev_key=None, next_key=None, post_ids=()):
+    # Посты из альбома и общего текстового сообщения не имеют своих кнопок: короткий ряд для каждого здесь
+    actions = [
+        [
+            InlineKeyboardButton(f"👍 {post_id}", callback_data=f'reaction_{post_id}_like'),
+            InlineKeyboardButton("💬", callback_data=f'comment_{post_id}'),
+            InlineKeyboardButton("⋯ Ещё", callback_data=f'post_menu_{post_id}')
+        ]
+        for post_id in post_ids
+    ]
     keyboard = [
         [InlineKeyboardButton("📝 Создать пост", callback_data='create_post')],  # Новая кнопка
         [
@@ -1095,15 +3518,13 @@ def feed_menu_keyboard(offset):
         []
     ]
     
-    if offset > 0:
-        keyboard[5].append(InlineKeyboardButton("⬅️ Назад", callback_data=f'feed_prev_{offset-5}'))
-    else:
-        keyboard[5].append(InlineKeyboardButton(" ", callback_data='noop'))
-    
-    keyboard[5].append(InlineKeyboardButton("➡️ Далее", callback_data=f'feed_next_{offset+5}'))
+    keyboard[5] = page_navigation('feed', page, prev_key, next_key)
+    if not keyboard[5] or page == 0:
+        keyboard[5].insert(0, InlineKeyboardButton(" ", callback_data='noop'))
     
-    return InlineKeyboardMarkup(keyboard)
+    return InlineKeyboardMarkup(actions + keyboard)
 
+@functools.cache
 def filter_feed_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📜 Все", callback_data='feed_all')],
@@ -1112,6 +3533,16 @@ def filter_feed_keyboard():
         [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')]
     ])
 
+@functools.cache
+def trends_keyboard(window):
+    labels = {'1h': "1 час", '24h': "24 часа", '7d': "7 дней"}
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(("• " if name == window else "") + label, callback_data=f'trends_{name}')
+         for name, label in labels.items()],
+        [InlineKeyboardButton("🏠 Главное меню", callback_data='main_menu')]
+    ])
+
+@functools.cache
 def messages_menu_keyboard():
     return ReplyKeyboardMarkup([
         ['📥 Входящие сообщения', '📤 Отправленные сообщения'],
@@ -1119,6 +3550,7 @@ def messages_menu_keyboard():
         ['🏠 Главное меню']
     ], resize_keyboard=True, one_time_keyboard=True)
 
+@functools.cache
 def groups_menu_keyboard():
     return ReplyKeyboardMarkup([
         ['👥 Мои группы', '📝 Создать группу'],
@@ -1126,31 +3558,36 @@ def groups_menu_keyboard():
         ['🏠 Главное меню']
     ], resize_keyboard=True, one_time_keyboard=True)
 
+@functools.cache
 def economy_menu_keyboard():
     return ReplyKeyboardMarkup([
         ['💰 Мой баланс', '🎁 Получить бонус'],
         ['➡️ Перевод монет', '🏠 Главное меню']
     ], resize_keyboard=True, one_time_keyboard=True)
 
+@functools.cache
 def search_menu_keyboard():
     return ReplyKeyboardMarkup([
         ["👤 Поиск пользователей", "#️⃣ Поиск по хештегам"],
         ["👥 Поиск групп", "📜 Поиск по контенту"],
-        ["🏠 Главное меню"]
+        ["🛒 Поиск товаров", "🏠 Главное меню"]
     ], resize_keyboard=True, one_time_keyboard=True)
 
+@functools.cache
 def market_menu_keyboard():
     return ReplyKeyboardMarkup([
         ['🛒 Просмотреть маркет', '📦 Мои товары'],
         ['💰 Продать товар', '🏠 Главное меню']
     ], resize_keyboard=True, one_time_keyboard=True)
 
+@functools.cache
 def ad_menu_keyboard():
     return ReplyKeyboardMarkup([
         ['📢 Создать рекламу', '📊 Мои рекламы'],
         ['🏠 Главное меню']
     ], resize_keyboard=True, one_time_keyboard=True)
 
+@functools.cache
 def admin_menu_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📊 Статистика", callback_data='admin_stats')],
@@ -1188,17 +3625,10 @@ def post_keyboard(post_id):
 
 async def show_my_posts(message, context: CallbackContext):
     user_id = message.from_user.id
-    offset = context.user_data.get('my_posts_offset', 0)
+    page_key, backward, page = get_page(context, 'my_posts')
     
     # Получаем посты с информацией о медиа
-    cursor.execute('''
-    SELECT p.post_id, p.content, p.post_date, p.media_id, p.media_type
-    FROM posts p
-    WHERE p.user_id = ?
-    ORDER BY p.post_date DESC
-    LIMIT 5 OFFSET ?
-    ''', (user_id, offset))
-    posts = cursor.fetchall()
+    posts = await run_db(get_user_posts, user_id, limit=5, page_key=page_key, backward=backward)
     
     if not posts:
         await message.reply_text("📭 У вас пока нет постов.")
@@ -1236,22 +3666,17 @@ async def show_my_posts(message, context: CallbackContext):
                                    reply_markup=keyboard, parse_mode='HTML')
     
     # Навигация
-    keyboard = []
-    if offset > 0:
-        keyboard.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'my_posts_prev_{offset-5}'))
-    if len(posts) == 5:
-        keyboard.append(InlineKeyboardButton("➡️ Далее", callback_data=f'my_posts_next_{offset+5}'))
+    prev_key, next_key = page_keys(posts, lambda p: (p[2], p[0]))
+    keyboard = page_navigation('my_posts', page, prev_key, next_key, has_next=len(posts) == 5)
     
     if keyboard:
         reply_markup = InlineKeyboardMarkup([keyboard])
         await message.reply_text("📝 Ваши посты:", reply_markup=reply_markup)
-    
-    context.user_data['my_posts_offset'] = offset
 
 # Обработчики команд
 async def start(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    if not is_registered(user_id):
+    if not await run_db(is_registered, user_id):
         await update.message.reply_text(
             '👋 Добро пожаловать в SocialBot!\n\n'
             'Выберите уникальный никнейм для регистрации:',
@@ -1268,12 +3693,12 @@ async def start(update: Update, context: CallbackContext):
             "• 👥 Группы - сообщества по интересам\n\n"
             "Выберите раздел для начала работы:"
         )
-        await update.message.reply_text(response, reply_markup=main_menu_keyboard(user_id))
+        await update.message.reply_text(response, reply_markup=await run_db(main_menu_keyboard, user_id))
 
 async def register(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    if is_registered(user_id):
-        await update.message.reply_text('ℹ️ Вы уже зарегистрированы.', reply_markup=main_menu_keyboard(user_id))
+    if await run_db(is_registered, user_id):
+        await update.message.reply_text('ℹ️ Вы уже зарегистрированы.', reply_markup=await run_db(main_menu_keyboard, user_id))
         return
     
     nickname = update.message.text.strip()
@@ -1281,14 +3706,13 @@ async def register(update: Update, context: CallbackContext):
         await update.message.reply_text('⚠️ Никнейм не может быть пустым.')
         return
     
-    if get_user_by_nickname(nickname):
+    if await run_db(get_user_by_nickname, nickname):
         await update.message.reply_text('⚠️ Этот никнейм уже занят.')
     else:
-        if register_user(user_id, nickname):
-            add_currency(user_id, 50)
+        if await run_db(complete_registration, user_id, nickname):
             await update.message.reply_text(
                 f'✅ Вы зарегистрированы как @{nickname}! Получите стартовый бонус: 50 монет.',
-                reply_markup=main_menu_keyboard(user_id)
+                reply_markup=await run_db(main_menu_keyboard, user_id)
             )
         else:
             await update.message.reply_text('❌ Ошибка регистрации. Попробуйте другой никнейм.')
@@ -1296,7 +3720,7 @@ async def register(update: Update, context: CallbackContext):
 # Функции отображения
 async def show_profile(message, context: CallbackContext):
     user_id = message.from_user.id
-    user = get_user_by_id(user_id)
+    user = await run_db(get_user_by_id, user_id)
     if not user:
         await message.reply_text("Профиль не найден")
         return
@@ -1306,10 +3730,9 @@ async def show_profile(message, context: CallbackContext):
     last_seen = user.get('last_seen', '').split()[0] if user.get('last_seen') else "N/A"
     is_private = "🔒 Приватный" if user.get('is_private') else "🔓 Публичный"
     bio = user.get('bio', '') or "Описание отсутствует"
-    balance = get_currency(user_id)
+    balance = await run_db(get_currency, user_id)
     
-    cursor.execute('SELECT COUNT(*) FROM achievements WHERE user_id = ?', (user_id,))
-    ach_count = cursor.fetchone()[0]
+    ach_count = await run_db(count_achievements, user_id)
     
     response = (
         f"👤 Профиль @{nickname}\n\n"
@@ -1321,62 +3744,151 @@ async def show_profile(message, context: CallbackContext):
         f"🏆 Достижений: {ach_count}\n"
     )
     
-    await message.reply_text(response, reply_markup=profile_menu_keyboard())
+    await message.reply_text(response, reply_markup=profile_menu_keyboard())
+
+# Отрисовка страницы ленты: фото и видео собираются в альбомы, текстовые посты - в одно сообщение
+CAPTION_LIMIT = 1024
+MESSAGE_LIMIT = 4096
+MEDIA_GROUP_LIMIT = 10
+ALBUM_MEDIA = {'photo': InputMediaPhoto, 'video': InputMediaVideo}
+
+def tg_len(text):
+    # Telegram считает длину в UTF-16
+    return len(text.encode('utf-16-le')) // 2
+
+def tg_truncate(text, limit):
+    if tg_len(text) <= limit:
+        return text
+    return text.encode('utf-16-le')[:max(limit - 1, 0) * 2].decode('utf-16-le', 'ignore') + '…'
+
+def feed_entry_html(title, content, footer, limit):
+    # title и footer уже в HTML; обрезаем только текст поста, чтобы не разорвать теги
+    visible = tg_len(html.unescape(re.sub(r'<[^>]+>', '', title + footer)))
+    return f"{title}\n{html.escape(tg_truncate(content or '', limit - visible - 1))}{footer}"
+
+def feed_entries(posts, ads):
+    entries = []
+    for i, post in enumerate(posts):
+        post_id, content, post_date, nickname, media_id, media_type = post[:6]
+        date_str = post_date.split()[0] if post_date else "N/A"
+        entries.append({
+            'post_id': post_id, 'media_id': media_id, 'media_type': media_type,
+            'title': f"👤 <b>@{html.escape(nickname)}</b> ({date_str})",
+            'content': content, 'footer': f"\nID: {post_id}\n",
+            'plain': f"👤 @{nickname} ({date_str})\n{content}",
+        })
+        # Вставка рекламы после 3-го поста
+        if ads and i == 2:
+            ad_id, ad_content, ad_date, ad_nickname, ad_media_id, ad_media_type = ads[0]
+            entries.append({
+                'post_id': None, 'media_id': ad_media_id, 'media_type': ad_media_type,
+                'title': f"📢 <b>Реклама от @{html.escape(ad_nickname)}</b>",
+                'content': ad_content, 'footer': f"\nID: {ad_id}\n",
+                'plain': f"📢 Реклама от @{ad_nickname}\n{ad_content}",
+            })
+    return entries
+
+async def send_feed_entry(message, entry):
+    # Отдельное сообщение с собственными кнопками; при ошибке - простой текст
+    keyboard = post_keyboard(entry['post_id']) if entry['post_id'] else None
+    caption = feed_entry_html(entry['title'], entry['content'], entry['footer'], CAPTION_LIMIT)
+    media_type, media_id = entry['media_type'], entry['media_id']
+    try:
+        if media_type and media_id:
+            if media_type == 'photo':
+                await message.reply_photo(photo=media_id, caption=caption, reply_markup=keyboard, parse_mode='HTML')
+            elif media_type == 'video':
+                await message.reply_video(video=media_id, caption=caption, reply_markup=keyboard, parse_mode='HTML')
+            elif media_type == 'document':
+                await message.reply_document(document=media_id, caption=caption, reply_markup=keyboard, parse_mode='HTML')
+            elif media_type == 'sticker':
+                await message.reply_sticker(sticker=media_id)
+                await message.reply_text(
+                    feed_entry_html(entry['title'], entry['content'], entry['footer'], MESSAGE_LIMIT),
+                    reply_markup=keyboard, parse_mode='HTML'
+                )
+        else:
+            await message.reply_text(
+                feed_entry_html(entry['title'], entry['content'], entry['footer'], MESSAGE_LIMIT),
+                reply_markup=keyboard, parse_mode='HTML'
+            )
+    except Exception as e:
+        logger.error(f"Ошибка отображения поста: {e}")
+        await message.reply_text(tg_truncate(entry['plain'], MESSAGE_LIMIT), reply_markup=keyboard)
+
+async def send_feed_page(message, posts, ads):
+    # Возвращает ID постов, отправленных без собственных кнопок
+    entries = feed_entries(posts, ads)
+    album = [e for e in entries if e['media_type'] in ALBUM_MEDIA and e['media_id']]
+    texts = [e for e in entries if not (e['media_type'] and e['media_id'])]
+    singles = [e for e in entries if e not in album and e not in texts]
+    bare = []
+    
+    for start in range(0, len(album), MEDIA_GROUP_LIMIT):
+        chunk = album[start:start + MEDIA_GROUP_LIMIT]
+        if len(chunk) < 2:
+            singles.extend(chunk)
+            continue
+        try:
+            await message.reply_media_group(media=[
+                ALBUM_MEDIA[e['media_type']](
+                    media=e['media_id'],
+                    caption=feed_entry_html(e['title'], e['content'], e['footer'], CAPTION_LIMIT),
+                    parse_mode='HTML'
+                )
+                for e in chunk
+            ])
+            bare.extend(e['post_id'] for e in chunk if e['post_id'])
+        except Exception as e:
+            logger.error(f"Ошибка отправки альбома: {e}")
+            singles.extend(chunk)
+    
+    for entry in singles:
+        await send_feed_entry(message, entry)
+    
+    if len(texts) == 1:
+        await send_feed_entry(message, texts[0])
+    elif texts:
+        # Длинные посты обрезаются так, чтобы страница уложилась в одно сообщение
+        separator = "\n"
+        share = (MESSAGE_LIMIT - tg_len(separator) * (len(texts) - 1)) // len(texts)
+        response = separator.join(
+            feed_entry_html(e['title'], e['content'], e['footer'], share) for e in texts
+        )
+        try:
+            await message.reply_text(response, parse_mode='HTML')
+            bare.extend(e['post_id'] for e in texts if e['post_id'])
+        except Exception as e:
+            logger.error(f"Ошибка отображения текстовых постов: {e}")
+            for entry in texts:
+                await send_feed_entry(message, entry)
+    
+    return bare
 
 async def show_feed(message, context: CallbackContext):
     user_id = message.from_user.id
-    offset = context.user_data.get('feed_offset', 0)
+    page_key, backward, page = get_page(context, 'feed')
     filter_type = context.user_data.get('feed_filter', 'all')
     media_filter = context.user_data.get('feed_media_filter', None)
     
     try:
         # Получение постов с учетом фильтра
         if filter_type == 'popular':
-            posts = get_popular_posts(user_id, limit=5, offset=offset)
+            posts = await run_db(get_popular_posts, user_id, limit=5, page_key=page_key, backward=backward)
         elif filter_type == 'friends':
-            cursor.execute('''
-            SELECT p.post_id, p.content, p.post_date, u.nickname, p.media_id, p.media_type
-            FROM posts p
-            JOIN users u ON p.user_id = u.user_id
-            WHERE p.user_id IN (
-                SELECT friend_id 
-                FROM friends 
-                WHERE user_id = ? AND status = 'accepted'
-            )
-            AND NOT EXISTS (
-                SELECT 1 
-                FROM blocks 
-                WHERE (blocker_id = ? AND blocked_id = p.user_id)
-                OR (blocker_id = p.user_id AND blocked_id = ?)
-            )
-            ORDER BY p.post_date DESC
-            LIMIT 5 OFFSET ?
-            ''', (user_id, user_id, user_id, offset))
-            posts = cursor.fetchall()
+            posts = await run_db(get_friend_posts, user_id, limit=5, page_key=page_key, backward=backward)
         elif filter_type == 'groups':
-            cursor.execute('''
-            SELECT p.post_id, p.content, p.post_date, u.nickname, p.media_id, p.media_type
-            FROM posts p
-            JOIN users u ON p.user_id = u.user_id
-            WHERE p.group_id IN (
-                SELECT group_id 
-                FROM group_members 
-                WHERE user_id = ?
-            )
-            AND NOT EXISTS (
-                SELECT 1 
-                FROM blocks 
-                WHERE (blocker_id = ? AND blocked_id = p.user_id)
-                OR (blocker_id = p.user_id AND blocked_id = ?)
-            )
-            ORDER BY p.post_date DESC
-            LIMIT 5 OFFSET ?
-            ''', (user_id, user_id, user_id, offset))
-            posts = cursor.fetchall()
+            posts = await run_db(get_group_posts, user_id, limit=5, page_key=page_key, backward=backward)
         elif filter_type == 'smart':
-            posts = get_smart_feed(user_id, limit=5, offset=offset)
+            posts = await run_db(get_smart_feed, user_id, limit=5, page_key=page_key, backward=backward)
+        else:
+            posts = await run_db(get_feed_posts, user_id, limit=5, page_key=page_key, backward=backward)
+        
+        # Ключи страниц считаются до медиа-фильтра, чтобы не терять позицию
+        if filter_type in ('popular', 'smart'):
+            prev_key, next_key = page_keys(posts, lambda p: (p[8], p[2], p[0]))
         else:
-            posts = get_feed_posts(user_id, limit=5, offset=offset)
+            prev_key, next_key = page_keys(posts, lambda p: (p[2], p[0]))
         
         # Применение медиа-фильтра
         if media_filter:
@@ -1387,8 +3899,8 @@ async def show_feed(message, context: CallbackContext):
         
         # Получение рекламы (каждые 5 постов)
         ads = []
-        if offset % 5 == 0 and filter_type != 'smart':
-            ads = get_ads(limit=1, offset=offset//5)
+        if filter_type != 'smart':
+            ads = await run_db(get_ads, limit=1, offset=page)
         
         # Обработка пустой ленты
         if not posts and not ads:
@@ -1406,121 +3918,44 @@ async def show_feed(message, context: CallbackContext):
             return
         
         # Отображение постов и рекламы
-        for i, post in enumerate(posts):
-            post_id, content, post_date, nickname, media_id, media_type = post
-            date_str = post_date.split()[0] if post_date else "N/A"
-            response = f"👤 <b>@{nickname}</b> ({date_str})\n{content}\nID: {post_id}\n"
-            
-            try:
-                # Отправка медиаконтента
-                if media_type and media_id:
-                    if media_type == 'photo':
-                        await message.reply_photo(
-                            photo=media_id, 
-                            caption=response, 
-                            reply_markup=post_keyboard(post_id),
-                            parse_mode='HTML'
-                        )
-                    elif media_type == 'video':
-                        await message.reply_video(
-                            video=media_id, 
-                            caption=response, 
-                            reply_markup=post_keyboard(post_id),
-                            parse_mode='HTML'
-                        )
-                    elif media_type == 'document':
-                        await message.reply_document(
-                            document=media_id, 
-                            caption=response, 
-                            reply_markup=post_keyboard(post_id),
-                            parse_mode='HTML'
-                        )
-                    elif media_type == 'sticker':
-                        await message.reply_sticker(sticker=media_id)
-                        await message.reply_text(
-                            response, 
-                            reply_markup=post_keyboard(post_id),
-                            parse_mode='HTML'
-                        )
-                else:
-                    await message.reply_text(
-                        response, 
-                        reply_markup=post_keyboard(post_id),
-                        parse_mode='HTML'
-                    )
-            except Exception as e:
-                logger.error(f"Ошибка отображения поста: {e}")
-                await message.reply_text(
-                    f"👤 @{nickname} ({date_str})\n{content}", 
-                    reply_markup=post_keyboard(post_id)
-                )
-            
-            # Вставка рекламы после 2-го поста
-            if ads and i == 2:
-                ad = ads[0]
-                ad_id, ad_content, ad_date, ad_nickname, ad_media_id, ad_media_type = ad
-                ad_response = f"📢 <b>Реклама от @{ad_nickname}</b>\n{ad_content}\nID: {ad_id}\n"
-                
-                try:
-                    if ad_media_type and ad_media_id:
-                        if ad_media_type == 'photo':
-                            await message.reply_photo(
-                                photo=ad_media_id, 
-                                caption=ad_response, 
-                                parse_mode='HTML'
-                            )
-                        elif ad_media_type == 'video':
-                            await message.reply_video(
-                                video=ad_media_id, 
-                                caption=ad_response, 
-                                parse_mode='HTML'
-                            )
-                        elif ad_media_type == 'document':
-                            await message.reply_document(
-                                document=ad_media_id, 
-                                caption=ad_response, 
-                                parse_mode='HTML'
-                            )
-                    else:
-                        await message.reply_text(ad_response, parse_mode='HTML')
-                except Exception as e:
-                    logger.error(f"Ошибка отображения рекламы: {e}")
+        bare = await send_feed_page(message, posts, ads)
         
-        # Фиксация смещения и вывод меню
-        context.user_data['feed_offset'] = offset
+        # Вывод меню с ключами соседних страниц
         await message.reply_text(
             f"📰 Лента ({filter_type}):", 
-            reply_markup=feed_menu_keyboard(offset)
+            reply_markup=feed_menu_keyboard(page, prev_key, next_key, bare)
         )
         
     except Exception as e:
         logger.error(f"Ошибка показа ленты: {e}")
         await message.reply_text("❌ Ошибка загрузки ленты. Попробуйте позже.")
 
-async def show_trends(message, context: CallbackContext):
-    trends = get_trending_hashtags(10)
-    if not trends:
-        await message.reply_text("Популярные хештеги не найдены.")
-        return
-    
-    response = "🔥 Топ популярных хештегов за последние 24 часа:\n\n"
-    for i, trend in enumerate(trends):
+TREND_PERIODS = {'1h': "последний час", '24h': "последние 24 часа", '7d': "последние 7 дней"}
+
+def format_trends(top, title):
+    response = f"{title}:\n\n"
+    for i, trend in enumerate(top):
         hashtag, count = trend
         response += f"{i+1}. #{hashtag} - {count} постов\n"
+    return response
+
+async def show_trends(message, context: CallbackContext):
+    # Тренды считаются в памяти (trends), запросов к базе нет
+    window = context.user_data.get('trends_window', '24h')
+    top = get_trending_hashtags(10, window)
+    if not top:
+        await message.reply_text("Популярные хештеги не найдены.", reply_markup=trends_keyboard(window))
+        return
     
-    await message.reply_text(response)
+    await message.reply_text(
+        format_trends(top, f"🔥 Топ популярных хештегов за {TREND_PERIODS[window]}"),
+        reply_markup=trends_keyboard(window)
+    )
 
 async def show_messages(message, context: CallbackContext):
     user_id = message.from_user.id
-    cursor.execute('''
-    SELECT m.message_id, u.nickname, m.content, m.timestamp
-    FROM messages m
-    JOIN users u ON m.sender_id = u.user_id
-    WHERE m.receiver_id = ?
-    ORDER BY m.timestamp DESC
-    LIMIT 5
-    ''', (user_id,))
-    messages = cursor.fetchall()
+    page_key, backward, page = get_page(context, 'inbox')
+    messages = await run_db(get_inbox, user_id, limit=5, page_key=page_key, backward=backward)
     
     if not messages:
         await message.reply_text("У вас нет сообщений.", reply_markup=messages_menu_keyboard())
@@ -1533,18 +3968,16 @@ async def show_messages(message, context: CallbackContext):
         response += f"👤 От @{nickname} ({timestamp.split()[0]}):\n{preview}\n[ID: {msg_id}]\n\n"
     
     await message.reply_text(response, reply_markup=messages_menu_keyboard())
+    
+    prev_key, next_key = page_keys(messages, lambda m: (m[3], m[0]))
+    keyboard = page_navigation('inbox', page, prev_key, next_key, has_next=len(messages) == 5)
+    if keyboard:
+        await message.reply_text("📥 Входящие:", reply_markup=InlineKeyboardMarkup([keyboard]))
 
 async def show_sent_messages(message, context: CallbackContext):
     user_id = message.from_user.id
-    cursor.execute('''
-    SELECT m.message_id, u.nickname, m.content, m.timestamp
-    FROM messages m
-    JOIN users u ON m.receiver_id = u.user_id
-    WHERE m.sender_id = ?
-    ORDER BY m.timestamp DESC
-    LIMIT 5
-    ''', (user_id,))
-    messages = cursor.fetchall()
+    page_key, backward, page = get_page(context, 'sent')
+    messages = await run_db(get_sent_messages, user_id, limit=5, page_key=page_key, backward=backward)
     
     if not messages:
         await message.reply_text("У вас нет отправленных сообщений.", reply_markup=messages_menu_keyboard())
@@ -1557,16 +3990,15 @@ async def show_sent_messages(message, context: CallbackContext):
         response += f"👤 К @{nickname} ({timestamp.split()[0]}):\n{preview}\n[ID: {msg_id}]\n\n"
     
     await message.reply_text(response, reply_markup=messages_menu_keyboard())
+    
+    prev_key, next_key = page_keys(messages, lambda m: (m[3], m[0]))
+    keyboard = page_navigation('sent', page, prev_key, next_key, has_next=len(messages) == 5)
+    if keyboard:
+        await message.reply_text("📤 Отправленные:", reply_markup=InlineKeyboardMarkup([keyboard]))
 
 async def show_contacts(message, context: CallbackContext):
     user_id = message.from_user.id
-    cursor.execute('''
-    SELECT u.nickname 
-    FROM friends f
-    JOIN users u ON f.friend_id = u.user_id
-    WHERE f.user_id = ? AND f.status = 'accepted'
-    ''', (user_id,))
-    friends = cursor.fetchall()
+    friends = await run_db(get_friends, user_id)
     
     if not friends:
         await message.reply_text("У вас нет друзей для отправки сообщений.", reply_markup=messages_menu_keyboard())
@@ -1574,19 +4006,13 @@ async def show_contacts(message, context: CallbackContext):
     
     response = "👥 Ваши контакты:\n\n"
     for friend in friends:
-        response += f"• @{friend[0]}\n"
+        response += f"• @{friend[1]}\n"
     
     await message.reply_text(response, reply_markup=messages_menu_keyboard())
 
 async def show_groups(message, context: CallbackContext):
     user_id = message.from_user.id
-    cursor.execute('''
-    SELECT g.group_id, g.name, g.description 
-    FROM groups g
-    JOIN group_members gm ON g.group_id = gm.group_id
-    WHERE gm.user_id = ?
-    ''', (user_id,))
-    groups = cursor.fetchall()
+    groups = await run_db(get_user_groups, user_id)
     
     if not groups:
         await message.reply_text("Вы не состоите ни в одной группе.", reply_markup=groups_menu_keyboard())
@@ -1607,22 +4033,15 @@ async def show_search(message, context: CallbackContext):
 
 async def show_economy(message, context: CallbackContext):
     user_id = message.from_user.id
-    balance = get_currency(user_id)
+    balance = await run_db(get_currency, user_id)
     await message.reply_text(f"💰 Ваш баланс: {balance} монет", reply_markup=economy_menu_keyboard())
 
 async def show_notifications(message, context: CallbackContext):
     user_id = message.from_user.id
-    cursor.execute('''
-    SELECT notification_id, content, notification_date 
-    FROM notifications 
-    WHERE user_id = ? AND is_read = 0
-    ORDER BY notification_date DESC
-    LIMIT 10
-    ''', (user_id,))
-    notifs = cursor.fetchall()
+    notifs = await run_db(get_unread_notifications, user_id)
     
     if not notifs:
-        await message.reply_text("У вас нет непрочитанных уведомлений.", reply_markup=main_menu_keyboard(user_id))
+        await message.reply_text("У вас нет непрочитанных уведомлений.", reply_markup=await run_db(main_menu_keyboard, user_id))
         return
     
     for notif in notifs:
@@ -1648,13 +4067,7 @@ async def show_settings(message, context: CallbackContext):
 
 async def show_notification_settings(message, context: CallbackContext):
     user_id = message.from_user.id
-    cursor.execute('SELECT * FROM notification_settings WHERE user_id = ?', (user_id,))
-    settings = cursor.fetchone()
-    if not settings:
-        # Создаем настройки по умолчанию
-        cursor.execute('INSERT INTO notification_settings (user_id) VALUES (?)', (user_id,))
-        conn.commit()
-        settings = (user_id, 1, 1, 1, 1)
+    settings = await run_db(get_notification_settings, user_id)
     
     response = (
         f"🔔 Настройки уведомлений:\n"
@@ -1674,21 +4087,8 @@ async def show_notification_settings(message, context: CallbackContext):
 
 async def show_friends(message, context: CallbackContext):
     user_id = message.from_user.id
-    cursor.execute('''
-    SELECT u.user_id, u.nickname 
-    FROM friends f
-    JOIN users u ON f.friend_id = u.user_id
-    WHERE f.user_id = ? AND f.status = 'accepted'
-    ''', (user_id,))
-    friends = cursor.fetchall()
-    
-    cursor.execute('''
-    SELECT u.user_id, u.nickname 
-    FROM friends f
-    JOIN users u ON f.user_id = u.user_id
-    WHERE f.friend_id = ? AND f.status = 'pending'
-    ''', (user_id,))
-    requests = cursor.fetchall()
+    friends = await run_db(get_friends, user_id)
+    requests = await run_db(get_friend_requests, user_id)
     
     response = "👥 Ваши друзья:\n"
     for friend in friends:
@@ -1710,57 +4110,30 @@ async def show_friends(message, context: CallbackContext):
 
 async def show_stats(message, context: CallbackContext):
     user_id = message.from_user.id
-    cursor.execute('SELECT COUNT(*) FROM posts WHERE user_id = ?', (user_id,))
-    post_count = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM likes WHERE post_id IN (SELECT post_id FROM posts WHERE user_id = ?)', (user_id,))
-    likes_received = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM comments WHERE post_id IN (SELECT post_id FROM posts WHERE user_id = ?)', (user_id,))
-    comments_received = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM friends WHERE user_id = ? AND status="accepted"', (user_id,))
-    friend_count = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM groups WHERE creator_id = ?', (user_id,))
-    group_count = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(*) FROM achievements WHERE user_id = ?', (user_id,))
-    ach_count = cursor.fetchone()[0]
-    
-    balance = get_currency(user_id)
-    
-    # Анализ активности за неделю
-    cursor.execute('''
-    SELECT strftime('%Y-%m-%d', post_date) AS day, COUNT(*) 
-    FROM posts 
-    WHERE user_id = ? AND post_date > datetime('now', '-7 days')
-    GROUP BY day
-    ORDER BY day DESC
-    ''', (user_id,))
-    weekly_activity = cursor.fetchall()
+    stats = await run_db(get_user_stats, user_id)
     
     response = (
         f"📊 Ваша статистика:\n\n"
-        f"📝 Постов: {post_count}\n"
-        f"❤️ Лайков получено: {likes_received}\n"
-        f"💬 Комментариев получено: {comments_received}\n"
-        f"👥 Друзей: {friend_count}\n"
-        f"👥 Групп создано: {group_count}\n"
-        f"🏆 Достижений: {ach_count}\n"
-        f"💰 Монет: {balance}\n\n"
+        f"📝 Постов: {stats['post_count']}\n"
+        f"❤️ Лайков получено: {stats['likes_received']}\n"
+        f"💬 Комментариев получено: {stats['comments_received']}\n"
+        f"🔄 Репостов получено: {stats['reposts_received']}\n"
+        f"📑 В закладках: {stats['bookmarks_received']}\n"
+        f"👥 Друзей: {stats['friend_count']}\n"
+        f"👥 Групп создано: {stats['group_count']}\n"
+        f"🏆 Достижений: {stats['ach_count']}\n"
+        f"💰 Монет: {stats['balance']}\n\n"
         f"📈 Активность за неделю:\n"
     )
     
-    for day, count in weekly_activity:
+    for day, count in stats['weekly_activity']:
         response += f"{day}: {count} постов\n"
     
     await message.reply_text(response)
 
 async def show_achievements(message, context: CallbackContext):
     user_id = message.from_user.id
-    cursor.execute('SELECT type, description, earned_at FROM achievements WHERE user_id = ?', (user_id,))
-    achievements = cursor.fetchall()
+    achievements = await run_db(get_achievements, user_id)
     
     if not achievements:
         await message.reply_text("🏆 У вас пока нет достижений.")
@@ -1774,13 +4147,7 @@ async def show_achievements(message, context: CallbackContext):
 
 async def show_blocked(message, context: CallbackContext):
     user_id = message.from_user.id
-    cursor.execute('''
-    SELECT u.nickname 
-    FROM blocks b
-    JOIN users u ON b.blocked_id = u.user_id
-    WHERE blocker_id = ?
-    ''', (user_id,))
-    blocked_users = cursor.fetchall()
+    blocked_users = await run_db(get_blocked_users, user_id)
     
     if not blocked_users:
         await message.reply_text("🚫 У вас нет заблокированных пользователей")
@@ -1797,13 +4164,13 @@ async def show_blocked(message, context: CallbackContext):
 
 async def show_bookmarks(message, context: CallbackContext):
     user_id = message.from_user.id
-    offset = context.user_data.get('bookmark_offset', 0)
-    bookmarks = get_bookmarks(user_id, limit=5, offset=offset)
+    page_key, backward, page = get_page(context, 'bookmark')
+    bookmarks = await run_db(get_bookmarks, user_id, limit=5, page_key=page_key, backward=backward)
     if not bookmarks:
-        await message.reply_text("📑 У вас нет сохраненных постов.", reply_markup=main_menu_keyboard(user_id))
+        await message.reply_text("📑 У вас нет сохраненных постов.", reply_markup=await run_db(main_menu_keyboard, user_id))
         return
     for post in bookmarks:
-        post_id, content, post_date, nickname, media_id, media_type = post
+        post_id, content, post_date, nickname, media_id, media_type = post[:6]
         response = f"👤 @{nickname} ({post_date.split()[0]})\n{content}\nID поста: {post_id}\n"
         post_keyboard = InlineKeyboardMarkup([
             [
@@ -1826,21 +4193,18 @@ async def show_bookmarks(message, context: CallbackContext):
                 await message.reply_text(response, reply_markup=post_keyboard)
         else:
             await message.reply_text(response, reply_markup=post_keyboard)
-    context.user_data['bookmark_offset'] = offset
     
     # Навигация для закладок
-    keyboard = []
-    if offset > 0:
-        keyboard.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'bookmark_prev_{offset-5}'))
-    keyboard.append(InlineKeyboardButton("➡️ Далее", callback_data=f'bookmark_next_{offset+5}'))
+    prev_key, next_key = page_keys(bookmarks, lambda b: (b[6], b[7]))
+    keyboard = page_navigation('bookmark', page, prev_key, next_key)
     
     reply_markup = InlineKeyboardMarkup([keyboard])
     await message.reply_text("📑 Ваши закладки:", reply_markup=reply_markup)
 
 async def show_marketplace(message, context: CallbackContext):
     user_id = message.from_user.id
-    offset = context.user_data.get('market_offset', 0)
-    items = get_market_items(limit=5, offset=offset)
+    page_key, backward, page = get_page(context, 'market')
+    items = await run_db(get_market_items, limit=5, page_key=page_key, backward=backward)
     if not items:
         response = (
             "🛒 Маркет пуст.\n\n"
@@ -1868,20 +4232,17 @@ async def show_marketplace(message, context: CallbackContext):
                 await message.reply_document(document=media_id, caption=response, reply_markup=keyboard)
         else:
             await message.reply_text(response, reply_markup=keyboard)
-    context.user_data['market_offset'] = offset
     
     # Навигация для маркета
-    keyboard = []
-    if offset > 0:
-        keyboard.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'market_prev_{offset-5}'))
-    keyboard.append(InlineKeyboardButton("➡️ Далее", callback_data=f'market_next_{offset+5}'))
+    prev_key, next_key = page_keys(items, lambda i: (i[4], i[0]))
+    keyboard = page_navigation('market', page, prev_key, next_key)
     
     reply_markup = InlineKeyboardMarkup([keyboard])
     await message.reply_text("🛒 Маркет:", reply_markup=reply_markup)
 
 async def show_admin_panel(message, context: CallbackContext):
     user_id = message.from_user.id
-    if not is_admin(user_id):
+    if not await run_db(is_admin, user_id):
         await message.reply_text("❌ Доступ запрещен")
         return
     await message.reply_text(
@@ -1889,11 +4250,63 @@ async def show_admin_panel(message, context: CallbackContext):
         reply_markup=admin_menu_keyboard()
     )
 
+async def show_admin_stats(message, context: CallbackContext):
+    user_id = message.from_user.id
+    if not await run_db(is_admin, user_id):
+        await message.reply_text("❌ Доступ запрещен")
+        return
+    response = "📊 Статистика кэша:\n"
+    for name, stats in cache_stats().items():
+        total = stats['hits'] + stats['misses']
+        hit_rate = stats['hits'] / total * 100 if total else 0
+        response += (f"• {name}: {stats['size']} записей, попаданий {stats['hits']}, "
+                     f"промахов {stats['misses']} ({hit_rate:.0f}%), вытеснено {stats['evictions']}\n")
+    response += (
+        f"\n🗄️ База данных:\n"
+        f"Чтений: {db.stats['reads']}, записей: {db.stats['writes']}, "
+        f"фиксаций: {db.stats['commits']}, откатов: {db.stats['rollbacks']}\n"
+        f"Ожидание соединений: чтение {db.stats['read_wait']:.2f} с, запись {db.stats['write_wait']:.2f} с\n"
+    )
+    notify = notifier.stats
+    response += (
+        f"\n🔔 Уведомления: событий {notify['queued']}, склеено {notify['coalesced']}, "
+        f"записано {notify['written']} за {notify['batches']} пачек, дайджестов {notify['pushed']}\n"
+    )
+    state = state_store.metrics()
+    response += (
+        f"💾 Состояния диалогов: в памяти {state['in_memory']}, загрузок {state['loads']}, "
+        f"сохранений {state['saves']}, выгружено {state['evictions']}, истекло {state['expired']}\n"
+    )
+    broadcasts = await run_db(get_broadcast_progress)
+    if broadcasts:
+        response += "📣 Рассылки в процессе:\n"
+        for job_id, type, related_id, sent, total in broadcasts:
+            response += f"• #{job_id} {type} ({related_id}): {sent}/{total}\n"
+    backfills = await run_db(get_backfill_progress)
+    if backfills:
+        response += "🛠 Фоновые шаги миграций:\n"
+        for name, last_id, max_id in backfills:
+            response += f"• {name}: {last_id}/{max_id}\n" if max_id is not None else f"• {name}: индекс строится\n"
+    inbox = context.application.update_queue.stats
+    response += (
+        f"\n📥 Входящие обновления: принято {inbox['accepted']}, в обработке {inbox['in_progress']}, "
+        f"ожиданий свободного места {inbox['waited']}\n"
+    )
+    outbox = send_scheduler.metrics()
+    response += (
+        f"\n📤 Очередь отправки:\n"
+        f"В очереди: {outbox['queue_depth']}, отправлено: {outbox['sent']}, "
+        f"повторов: {outbox['retries']}, ошибок: {outbox['failed']}, отложено: {outbox['delayed']}\n"
+        f"Задержка: p50 {outbox['latency_p50_ms']:.0f} мс, p95 {outbox['latency_p95_ms']:.0f} мс, "
+        f"макс {outbox['latency_max_ms']:.0f} мс"
+    )
+    await message.reply_text(response)
+
 async def show_stories(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    stories = get_stories(user_id)
+    stories = await run_db(get_stories, user_id)
     if not stories:
-        await update.message.reply_text("📸 Нет доступных историй.", reply_markup=main_menu_keyboard(user_id))
+        await update.message.reply_text("📸 Нет доступных историй.", reply_markup=await run_db(main_menu_keyboard, user_id))
         return
     for story in stories:
         story_id, content, created_at, nickname, media_id, media_type = story
@@ -1906,77 +4319,205 @@ async def show_stories(update: Update, context: CallbackContext):
         else:
             await update.message.reply_text(response)
 
-# Обработчики сообщений
+# Маршрутизация: точные совпадения ищутся в словаре, параметризованные колбэки - в префиксном дереве.
+# Из нескольких подходящих префиксов выигрывает самый длинный ('bookmark_prev_' раньше 'bookmark_')
+class Router:
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = {}  # символ -> узел; обработчик узла лежит под ключом None
+
+    def add(self, key, handler, prefix=False):
+        if not prefix:
+            if key in self.exact:
+                raise ValueError(f"Маршрут {key!r} уже зарегистрирован")
+            self.exact[key] = handler
+            return
+        node = self.prefixes
+        for char in key:
+            node = node.setdefault(char, {})
+        if None in node:
+            raise ValueError(f"Префикс {key!r} уже зарегистрирован")
+        node[None] = handler
+
+    def match(self, key):
+        # -> (обработчик, остаток ключа после префикса) или (None, key)
+        handler = self.exact.get(key)
+        if handler is not None:
+            return handler, ''
+        found = (None, key)
+        node = self.prefixes
+        for i, char in enumerate(key):
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                found = (node[None], key[i + 1:])
+        return found
+
+callback_routes = Router()
+menu_routes = Router()
+flow_routes = []     # (ключ user_data, обработчик) до обработки медиа и меню, в порядке приоритета
+search_routes = []   # (ключ user_data, обработчик) после кнопок меню
+
+# Обработчики сообщений: сценарии, ожидающие ввода
+async def finish_editing(message, context, field):
+    user_id = message.from_user.id
+    text = message.text or ""
+    if field == 'nickname':
+        if not text.strip():
+            await message.reply_text("❌ Никнейм не может быть пустым.")
+            return
+        if await run_db(get_user_by_nickname, text.strip()):
+            await message.reply_text("❌ Этот никнейм уже занят.")
+            return
+        if await run_db(update_user_profile, user_id, nickname=text.strip()):
+            await message.reply_text("✅ Никнейм успешно изменен!")
+        else:
+            await message.reply_text("❌ Ошибка при изменении никнейма.")
+    
+    elif field == 'bio':
+        if await run_db(update_user_profile, user_id, bio=text):
+            await message.reply_text("✅ Описание профиля успешно обновлено!")
+        else:
+            await message.reply_text("❌ Ошибка при обновлении описания.")
+
+async def finish_comment(message, context, post_id):
+    if await run_db(comment_post, message.from_user.id, post_id, message.text or ""):
+        await message.reply_text("💬 Комментарий добавлен!")
+    else:
+        await message.reply_text("❌ Не удалось добавить комментарий")
+
+REPORT_TARGETS = {
+    'post': "⚠️ Жалоба на пост отправлена.",
+    'item': "⚠️ Жалоба на товар отправлена.",
+    'ad': "⚠️ Жалоба на рекламу отправлена.",
+}
+
+async def finish_report(target_type, message, context, target_id):
+    user_id = message.from_user.id
+    if await run_db(create_report, user_id, target_id, target_type, message.text or ""):
+        await message.reply_text(REPORT_TARGETS[target_type], reply_markup=await run_db(main_menu_keyboard, user_id))
+    else:
+        await message.reply_text("❌ Не удалось отправить жалобу.")
+
+async def finish_search_users(message, context, _):
+    results = await run_db(search_users, message.text or "")
+    if not results:
+        await message.reply_text("Пользователи не найдены.")
+        return
+    response = "🔍 Результаты поиска пользователей:\n\n"
+    for user_id, nickname in results:
+        response += f"• @{nickname} (ID: {user_id})\n"
+    await message.reply_text(response)
+
+async def finish_search_hashtag(message, context, _):
+    text = message.text or ""
+    results = await run_db(search_posts_by_hashtag, text)
+    if not results:
+        await message.reply_text("Посты с таким хештегом не найдены.")
+        return
+    response = f"🔍 Посты с хештегом #{text}:\n\n"
+    for post_id, content, nickname in results:
+        preview = content[:100] + "..." if len(content) > 100 else content
+        response += f"👤 @{nickname}\n{preview}\nID поста: {post_id}\n\n"
+    await message.reply_text(response)
+
+async def finish_search_groups(message, context, _):
+    results = await run_db(search_groups, message.text or "")
+    if not results:
+        await message.reply_text("Группы не найдены.")
+        return
+    response = "🔍 Результаты поиска групп:\n\n"
+    for group_id, name, description in results:
+        response += f"🔷 {name} (ID: {group_id})\nОписание: {description}\n\n"
+    await message.reply_text(response)
+
+async def finish_search_content(message, context, _):
+    results = await run_db(search_content, message.text or "", message.from_user.id)
+    if not results:
+        await message.reply_text("🔍 Ничего не найдено.")
+        return
+    response = "🔍 Результаты поиска:\n\n"
+    for post in results:
+        post_id, content, post_date, nickname, media_id, media_type = post
+        preview = content[:100] + "..." if len(content) > 100 else content
+        response += f"👤 @{nickname} ({post_date.split()[0]})\n{preview}\nID поста: {post_id}\n\n"
+    await message.reply_text(response)
+
+async def finish_search_market(message, context, _):
+    results = await run_db(search_market, message.text or "")
+    if not results:
+        await message.reply_text("🔍 Товары не найдены.")
+        return
+    response = "🔍 Результаты поиска товаров:\n\n"
+    for item_id, title, price, nickname in results:
+        response += f"📦 {title} — {price} монет (продавец @{nickname}, ID: {item_id})\n"
+    await message.reply_text(response)
+
+async def run_flow(routes, message, context):
+    # Первый ожидающий сценарий забирает сообщение; ключ снимается до вызова обработчика
+    for key, handler in routes:
+        if key in context.user_data:
+            value = context.user_data.pop(key)
+            await handler(message, context, value)
+            return True
+    return False
+
+# Обработчики сообщений: кнопки меню (получают update, как и show_stories)
+def open_view(show):
+    async def handler(update, context):
+        await show(update.message, context)
+    return handler
+
+def open_listing(listing, show):
+    async def handler(update, context):
+        set_page(context, listing)
+        await show(update.message, context)
+    return handler
+
+def reply_with(text, keyboard=None):
+    async def handler(update, context):
+        await update.message.reply_text(text, reply_markup=keyboard() if keyboard else None)
+    return handler
+
+def start_search(key, prompt):
+    async def handler(update, context):
+        await update.message.reply_text(prompt)
+        context.user_data[key] = True
+    return handler
+
+async def open_feed(update, context):
+    set_page(context, 'feed')
+    context.user_data['feed_filter'] = 'all'
+    await show_feed(update.message, context)
+
+async def open_main_menu(update, context):
+    await update.message.reply_text('🏠 Главное меню:', reply_markup=await run_db(main_menu_keyboard, update.effective_user.id))
+
+async def cancel_action(update, context):
+    for key in ('pending_media', 'pending_market_media', 'pending_ad_media'):
+        context.user_data.pop(key, None)
+    await update.message.reply_text('❌ Действие отменено', reply_markup=await run_db(main_menu_keyboard, update.effective_user.id))
+
+async def claim_daily_bonus(update, context):
+    if await run_db(daily_bonus, update.effective_user.id):
+        await update.message.reply_text('🎉 Вы получили 10 монет!', reply_markup=economy_menu_keyboard())
+    else:
+        await update.message.reply_text('⚠️ Вы уже получали бонус сегодня. Приходите завтра!', 
+                                        reply_markup=economy_menu_keyboard())
+
 async def handle_message(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
     message = update.message
     text = message.text if message.text else ""
     
     # Обработка регистрации
-    if not is_registered(user_id):
+    if not await run_db(is_registered, user_id):
         await register(update, context)
         return
     
-    # Обработка редактирования профиля
-    if 'editing' in context.user_data:
-        field = context.user_data['editing']
-        del context.user_data['editing']
-        
-        if field == 'nickname':
-            if not text.strip():
-                await message.reply_text("❌ Никнейм не может быть пустым.")
-                return
-            if get_user_by_nickname(text.strip()):
-                await message.reply_text("❌ Этот никнейм уже занят.")
-                return
-            if update_user_profile(user_id, nickname=text.strip()):
-                await message.reply_text("✅ Никнейм успешно изменен!")
-            else:
-                await message.reply_text("❌ Ошибка при изменении никнейма.")
-        
-        elif field == 'bio':
-            if update_user_profile(user_id, bio=text):
-                await message.reply_text("✅ Описание профиля успешно обновлено!")
-            else:
-                await message.reply_text("❌ Ошибка при обновлении описания.")
-        return
-    
-    # Обработка комментариев
-    if 'commenting_post' in context.user_data:
-        post_id = context.user_data['commenting_post']
-        del context.user_data['commenting_post']
-        if comment_post(user_id, post_id, text):
-            await message.reply_text("💬 Комментарий добавлен!")
-        else:
-            await message.reply_text("❌ Не удалось добавить комментарий")
-        return
-    
-    # Обработка жалоб
-    if 'reporting_post' in context.user_data:
-        post_id = context.user_data['reporting_post']
-        del context.user_data['reporting_post']
-        if create_report(user_id, post_id, 'post', text):
-            await message.reply_text("⚠️ Жалоба на пост отправлена.", reply_markup=main_menu_keyboard(user_id))
-        else:
-            await message.reply_text("❌ Не удалось отправить жалобу.")
-        return
-    
-    if 'reporting_item' in context.user_data:
-        item_id = context.user_data['reporting_item']
-        del context.user_data['reporting_item']
-        if create_report(user_id, item_id, 'item', text):
-            await message.reply_text("⚠️ Жалоба на товар отправлена.", reply_markup=main_menu_keyboard(user_id))
-        else:
-            await message.reply_text("❌ Не удалось отправить жалобу.")
-        return
-    
-    if 'reporting_ad' in context.user_data:
-        ad_id = context.user_data['reporting_ad']
-        del context.user_data['reporting_ad']
-        if create_report(user_id, ad_id, 'ad', text):
-            await message.reply_text("⚠️ Жалоба на рекламу отправлена.", reply_markup=main_menu_keyboard(user_id))
-        else:
-            await message.reply_text("❌ Не удалось отправить жалобу.")
+    # Редактирование профиля, комментарии и жалобы
+    if await run_flow(flow_routes, message, context):
         return
     
     # Обработка медиаконтента для постов
@@ -2007,7 +4548,7 @@ async def handle_message(update: Update, context: CallbackContext):
         media_type = 'photo' if message.photo else 'video'
         media_id = message.photo[-1].file_id if media_type == 'photo' else message.video.file_id
         
-        story_id = create_story(user_id, media_id=media_id, media_type=media_type)
+        story_id = await run_db(create_story, user_id, media_id=media_id, media_type=media_type)
         if story_id:
             await message.reply_text(f"📸 История опубликована! ID: {story_id}")
         else:
@@ -2044,194 +4585,20 @@ async def handle_message(update: Update, context: CallbackContext):
         await message.reply_text('📄 Документ для рекламы получен. Введите: /create_ad <цена> <текст>')
         return
     
-    # Обработка текстовых команд главного меню
-    if text == '👤 Профиль':
-        await show_profile(message, context)
-    elif text == '📰 Лента':
-        context.user_data['feed_offset'] = 0
-        context.user_data['feed_filter'] = 'all'
-        await show_feed(message, context)
-    elif text == 'ℹ️ Помощь':  # Обработка новой кнопки
-        await show_help(message, context)
-    elif text == '🔥 Тренды':
-        await show_trends(message, context)
-    elif text == '📑 Закладки':
-        await show_bookmarks(message, context)
-    elif text == '💬 Сообщения':
-        await show_messages(message, context)
-    elif text == '👥 Группы':
-        await show_groups(message, context)
-    elif text == '🛒 Маркет':
-        await show_marketplace(message, context)
-    elif text == '🔔 Уведомления':
-        await show_notifications(message, context)
-    elif text == '💰 Экономика':
-        await show_economy(message, context)
-    elif text == '📸 Истории':
-        await show_stories(update, context)
-    elif text == '🔍 Поиск':
-        await show_search(message, context)
-    elif text == '⚙️ Настройки':
-        await show_settings(message, context)
-    elif text == '🛠️ Админ-панель':
-        await show_admin_panel(message, context)
-    elif text == '🏠 Главное меню':
-        await message.reply_text('🏠 Главное меню:', reply_markup=main_menu_keyboard(user_id))
-    elif text == '❌ Отмена':
-        if 'pending_media' in context.user_data:
-            del context.user_data['pending_media']
-        if 'pending_market_media' in context.user_data:
-            del context.user_data['pending_market_media']
-        if 'pending_ad_media' in context.user_data:
-            del context.user_data['pending_ad_media']
-        await message.reply_text('❌ Действие отменено', reply_markup=main_menu_keyboard(user_id))
-    
-    # Обработка подменю сообщений
-    elif text == '📥 Входящие сообщения':
-        await show_messages(message, context)
-    elif text == '📤 Отправленные сообщения':
-        await show_sent_messages(message, context)
-    elif text == '✉️ Новое сообщение':
-        await message.reply_text("Введите никнейм получателя и сообщение: /msg <никнейм> <текст>", 
-                                reply_markup=messages_menu_keyboard())
-    elif text == '👥 Контакты':
-        await show_contacts(message, context)
-    
-    # Обработка подменю групп
-    elif text == '👥 Мои группы':
-        await show_groups(message, context)
-    elif text == '📝 Создать группу':
-        await message.reply_text("Введите: /create_group <название> <описание>", 
-                                reply_markup=groups_menu_keyboard())
-    elif text == '🎥 Начать трансляцию':
-        await message.reply_text("🎥 Запуск трансляции:\n\n"
-                               "Использование: /start_live <ID_группы> <Название>\n\n"
-                               "Как получить ID группы:\n"
-                               "1. Перейдите в раздел '👥 Группы'\n"
-                               "2. Выберите '👥 Мои группы'\n"
-                               "3. ID группы указан в скобках\n\n"
-                               "Пример: /start_live 123 Моя первая трансляция")
-    elif text == '🔍 Найти группу':
-        await message.reply_text("Введите: /search_groups <ключевое слово>", 
-                                reply_markup=groups_menu_keyboard())
-    
-    # Обработка подменю экономики
-    elif text == '💰 Мой баланс':
-        await show_economy(message, context)
-    elif text == '🎁 Получить бонус':
-        if daily_bonus(user_id):
-            await message.reply_text('🎉 Вы получили 10 монет!', reply_markup=economy_menu_keyboard())
-        else:
-            await message.reply_text('⚠️ Вы уже получали бонус сегодня. Приходите завтра!', 
-                                   reply_markup=economy_menu_keyboard())
-    elif text == '➡️ Перевод монет':
-        await message.reply_text("Введите: /transfer <никнейм> <сумма>", 
-                                reply_markup=economy_menu_keyboard())
-    
-    # Обработка подменю поиска
-    elif text == '👤 Поиск пользователей':
-        await message.reply_text("🔍 Введите имя пользователя для поиска:")
-        context.user_data['searching_users'] = True
-    elif text == '#️⃣ Поиск по хештегам' or text == '📝 Поиск постов':
-        await message.reply_text("🔍 Введите хештег для поиска (без #):")
-        context.user_data['searching_hashtag'] = True
-    elif text == '👥 Поиск групп':
-        await message.reply_text("🔍 Введите название группы для поиска:")
-        context.user_data['searching_groups'] = True
-    elif text == '📜 Поиск по контенту':
-        await message.reply_text("🔍 Введите ключевое слово для поиска:")
-        context.user_data['searching_content'] = True
-    
-    # Обработка подменю маркета
-    elif text == '🛒 Просмотреть маркет':
-        await show_marketplace(message, context)
-    elif text == '📦 Мои товары':
-        await show_my_marketplace(message, context)
-    elif text == '💰 Продать товар':
-        await message.reply_text("Отправьте фото/видео товара и введите: /sell <название> <цена> <описание>", 
-                               reply_markup=market_menu_keyboard())
-    
-    # Обработка создания поста
-    elif text == '📝 Создать пост':
-        await message.reply_text(
-            "📝 Создание нового поста:\n\n"
-            "• Просто напишите текст поста\n"
-            "• Или отправьте фото/видео с описанием\n"
-            "• Используйте #хештеги для лучшего охвата\n\n"
-            "Отправьте содержимое поста сейчас:"
-        )
-    
-    # Обработка историй
-    elif text == '📸 Истории':
-        await message.reply_text(
-            "📸 Создание историй:\n\n"
-            "• Отправьте фото или видео\n"
-            "• Истории исчезнут через 24 часа\n"
-            "• Ваши друзья увидят их в этом разделе\n\n"
-            "Отправьте фото или видео сейчас, чтобы создать историю:"
-        )
-        await show_stories(update, context)
-    
-    # Обработка рекламы
-    elif text == '📢 Создать рекламу':
-        await message.reply_text(
-            "📢 Создание рекламы:\n\n"
-            "1. Отправьте медиа (фото/видео) для рекламы (необязательно)\n"
-            "2. Используйте команду: /create_ad <бюджет> <текст>\n"
-            "3. Пример: /create_ad 50 Присоединяйтесь к нашей группе!\n"
-            "4. Реклама будет проверена модератором\n\n"
-            "Вы можете отправить медиа сейчас или сразу использовать команду"
-        )
+    # Кнопки меню
+    handler, _ = menu_routes.match(text)
+    if handler:
+        await handler(update, context)
+        return
     
     # Обработка поисковых запросов
-    elif context.user_data.get('searching_users'):
-        del context.user_data['searching_users']
-        results = search_users(text)
-        if not results:
-            await message.reply_text("Пользователи не найдены.")
-            return
-        response = "🔍 Результаты поиска пользователей:\n\n"
-        for user_id, nickname in results:
-            response += f"• @{nickname} (ID: {user_id})\n"
-        await message.reply_text(response)
-    elif context.user_data.get('searching_hashtag'):
-        del context.user_data['searching_hashtag']
-        results = search_posts_by_hashtag(text)
-        if not results:
-            await message.reply_text("Посты с таким хештегом не найдены.")
-            return
-        response = f"🔍 Посты с хештегом #{text}:\n\n"
-        for post_id, content, nickname in results:
-            preview = content[:100] + "..." if len(content) > 100 else content
-            response += f"👤 @{nickname}\n{preview}\nID поста: {post_id}\n\n"
-        await message.reply_text(response)
-    elif context.user_data.get('searching_groups'):
-        del context.user_data['searching_groups']
-        results = search_groups(text)
-        if not results:
-            await message.reply_text("Группы не найдены.")
-            return
-        response = "🔍 Результаты поиска групп:\n\n"
-        for group_id, name, description in results:
-            response += f"🔷 {name} (ID: {group_id})\nОписание: {description}\n\n"
-        await message.reply_text(response)
-    elif context.user_data.get('searching_content'):
-        del context.user_data['searching_content']
-        results = search_content(text, user_id)
-        if not results:
-            await message.reply_text("🔍 Ничего не найдено.")
-            return
-        response = "🔍 Результаты поиска:\n\n"
-        for post in results:
-            post_id, content, post_date, nickname, media_id, media_type = post
-            preview = content[:100] + "..." if len(content) > 100 else content
-            response += f"👤 @{nickname} ({post_date.split()[0]})\n{preview}\nID поста: {post_id}\n\n"
-        await message.reply_text(response)
+    if await run_flow(search_routes, message, context):
+        return
     
     # Обработка постов с медиа
-    elif 'pending_media' in context.user_data:
+    if 'pending_media' in context.user_data:
         media = context.user_data['pending_media']
-        post_id = create_post(user_id, text, media_type=media['type'], media_id=media['id'])
+        post_id = await run_db(create_post, user_id, text, media_type=media['type'], media_id=media['id'])
         del context.user_data['pending_media']
         if post_id:
             await message.reply_text('✅ Пост с медиа опубликован!')
@@ -2240,7 +4607,7 @@ async def handle_message(update: Update, context: CallbackContext):
     
     # Обработка обычных текстовых постов
     else:
-        post_id = create_post(user_id, text)
+        post_id = await run_db(create_post, user_id, text)
         if post_id:
             await message.reply_text('✅ Текстовый пост опубликован!')
         else:
@@ -2290,222 +4657,161 @@ async def show_help(message, context: CallbackContext):
     await message.reply_text(
         help_text, 
         parse_mode='HTML',
-        reply_markup=main_menu_keyboard(message.from_user.id)
+        reply_markup=await run_db(main_menu_keyboard, message.from_user.id)
     )
 
 async def help_command(update: Update, context: CallbackContext):
     await show_help(update.message, context)
 
-# Обработчики колбэков
-async def handle_callback(update: Update, context: CallbackContext):
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-    user_id = query.from_user.id
-    
-    if data == 'main_menu':
-        await query.message.reply_text('🏠 Главное меню:', reply_markup=main_menu_keyboard(user_id))
-    elif data == 'create_post':
-        await query.message.reply_text(
-            "📝 Создание нового поста:\n\n"
-            "1. Вы можете просто отправить текст\n"
-            "2. Или отправить медиа (фото/видео/документ) с подписью\n"
-            "3. Используйте хештеги #пример для категоризации\n\n"
-            "Отправьте содержимое поста сейчас:"
-        )
-    elif data == 'my_posts':
-        await show_my_posts(query.message, context)
-    elif data.startswith('my_posts_prev_'):
-        offset = int(data.split('_')[3])
-        context.user_data['my_posts_offset'] = offset
-        await show_my_posts(query.message, context)
-    elif data.startswith('my_posts_next_'):
-        offset = int(data.split('_')[3])
-        context.user_data['my_posts_offset'] = offset
-        await show_my_posts(query.message, context)
-    elif data.startswith('delete_my_post_'):
-        post_id = int(data.split('_')[3])
-        cursor.execute('DELETE FROM posts WHERE post_id = ? AND user_id = ?', (post_id, user_id))
-        conn.commit()  # Не забываем сохранять изменения!
-        if cursor.rowcount > 0:
-            await query.answer("🗑️ Пост удален")
-            await show_my_posts(query.message, context)
-        else:
-            await query.answer("❌ Не удалось удалить пост")
-    elif data == 'feed_friends':
-        context.user_data['feed_filter'] = 'friends'
-        context.user_data['feed_offset'] = 0
-        await show_feed(query.message, context)
-    elif data == 'feed_groups':
-        context.user_data['feed_filter'] = 'groups'
-        context.user_data['feed_offset'] = 0
-        await show_feed(query.message, context)
-    elif data == 'feed_popular':
-        context.user_data['feed_filter'] = 'popular'
-        context.user_data['feed_offset'] = 0
-        await show_feed(query.message, context)
-    elif data == 'feed_smart':
-        context.user_data['feed_filter'] = 'smart'
-        context.user_data['feed_offset'] = 0
-        await show_feed(query.message, context)
-    elif data == 'filter_feed':
-        await query.message.reply_text(
-            "📂 Выберите тип контента для ленты:",
-            reply_markup=filter_feed_keyboard()
-        )
-    elif data == 'feed_all':
-        context.user_data['feed_media_filter'] = None
-        await show_feed(query.message, context)
-    elif data == 'feed_photos':
-        context.user_data['feed_media_filter'] = 'photos'
-        await show_feed(query.message, context)
-    elif data == 'feed_videos':
-        context.user_data['feed_media_filter'] = 'videos'
+# Обработчики колбэков: получают query, context и часть callback_data после префикса
+def answer_with_view(show):
+    async def handler(query, context, arg):
+        await show(query.message, context)
+    return handler
+
+def answer_with_text(text, keyboard=None):
+    async def handler(query, context, arg):
+        await query.message.reply_text(text, reply_markup=keyboard() if keyboard else None)
+    return handler
+
+def turn_page(listing, show, backward):
+    async def handler(query, context, token):
+        set_page(context, listing, token, backward=backward)
+        await show(query.message, context)
+    return handler
+
+def first_page(listing, show):
+    async def handler(query, context, arg):
+        set_page(context, listing)
+        await show(query.message, context)
+    return handler
+
+def set_feed_filter(feed_filter):
+    async def handler(query, context, arg):
+        context.user_data['feed_filter'] = feed_filter
+        set_page(context, 'feed')
         await show_feed(query.message, context)
-    elif data.startswith('feed_prev_'):
-        offset = int(data.split('_')[2])
-        context.user_data['feed_offset'] = offset
-        await show_feed(query.message, context)
-    elif data.startswith('feed_next_'):
-        offset = int(data.split('_')[2])
-        context.user_data['feed_offset'] = offset
+    return handler
+
+def set_feed_media_filter(media_filter):
+    async def handler(query, context, arg):
+        context.user_data['feed_media_filter'] = media_filter
         await show_feed(query.message, context)
-    elif data.startswith('bookmark_prev_'):
-        offset = int(data.split('_')[2])
-        context.user_data['bookmark_offset'] = offset
-        await show_bookmarks(query.message, context)
-    elif data.startswith('bookmark_next_'):
-        offset = int(data.split('_')[2])
-        context.user_data['bookmark_offset'] = offset
-        await show_bookmarks(query.message, context)
-    elif data.startswith('market_prev_'):
-        offset = int(data.split('_')[2])
-        context.user_data['market_offset'] = offset
-        await show_marketplace(query.message, context)
-    elif data.startswith('market_next_'):
-        offset = int(data.split('_')[2])
-        context.user_data['market_offset'] = offset
-        await show_marketplace(query.message, context)
-    elif data.startswith('reaction_'):
-        parts = data.split('_')
-        post_id = int(parts[1])
-        reaction = parts[2]
-        if like_post(user_id, post_id, reaction):
-            await query.answer(f"Реакция {reaction} добавлена!")
-        else:
-            await query.answer("❌ Не удалось добавить реакцию")
-    elif data.startswith('comment_'):
-        post_id = int(data.split('_')[1])
-        context.user_data['commenting_post'] = post_id
-        await query.message.reply_text("💬 Введите текст комментария:")
-    elif data.startswith('repost_'):
-        post_id = int(data.split('_')[1])
-        new_post_id = repost(user_id, post_id)
-        if new_post_id:
-            await query.answer(f"✅ Пост репостнут! ID: {new_post_id}")
-        else:
-            await query.answer("❌ Ошибка репоста")
-    elif data.startswith('bookmark_'):
-        post_id = int(data.split('_')[1])
-        if add_bookmark(user_id, post_id):
-            await query.answer("📑 Пост добавлен в закладки!")
-        else:
-            await query.answer("❌ Не удалось добавить в закладки")
-    elif data.startswith('remove_bookmark_'):
-        post_id = int(data.split('_')[2])
-        if remove_bookmark(user_id, post_id):
-            await query.answer("🗑️ Пост удален из закладок")
-        else:
-            await query.answer("❌ Ошибка удаления из закладок")
-    elif data.startswith('report_post_'):
-        post_id = int(data.split('_')[2])
-        context.user_data['reporting_post'] = post_id
-        await query.message.reply_text("⚠️ Укажите причину жалобы на пост:")
-    elif data.startswith('read_'):
-        notification_id = data.split('_')[1]
-        mark_notification_read(notification_id)
-        await query.message.delete()
-    elif data.startswith('delete_'):
-        notification_id = data.split('_')[1]
-        cursor.execute('DELETE FROM notifications WHERE notification_id = ?', (notification_id,))
-        conn.commit()
-        await query.message.delete()
-    elif data == 'blocked_list':
-        await show_blocked(query.message, context)
-    elif data == 'stats':
-        await show_stats(query.message, context)
-    elif data == 'achievements':
-        await show_achievements(query.message, context)
-    elif data == 'friends_list':
-        await show_friends(query.message, context)
-    elif data.startswith('accept_friend_'):
-        friend_id = int(data.split('_')[2])
-        if respond_friend_request(user_id, friend_id, True):
-            await query.edit_message_text("✅ Запрос дружбы принят")
-        else:
-            await query.edit_message_text("❌ Ошибка принятия запроса")
-    elif data.startswith('reject_friend_'):
-        friend_id = int(data.split('_')[2])
-        if respond_friend_request(user_id, friend_id, False):
-            await query.edit_message_text("✅ Запрос дружбы отклонен")
+    return handler
+
+def await_input(key, prompt, value=None):
+    # Следующее сообщение пользователя уйдет в сценарий key (см. flow_routes)
+    async def handler(query, context, arg):
+        context.user_data[key] = value if value is not None else int(arg)
+        await query.message.reply_text(prompt)
+    return handler
+
+async def callback_main_menu(query, context, arg):
+    await query.message.reply_text('🏠 Главное меню:', reply_markup=await run_db(main_menu_keyboard, query.from_user.id))
+
+async def callback_delete_my_post(query, context, arg):
+    deleted = await run_db(remove_post, int(arg), query.from_user.id)
+    if deleted:
+        await query.answer("🗑️ Пост удален")
+        await show_my_posts(query.message, context)
+    else:
+        await query.answer("❌ Не удалось удалить пост")
+
+async def callback_reaction(query, context, arg):
+    post_id, reaction = arg.split('_', 1)
+    if await run_db(like_post, query.from_user.id, int(post_id), reaction):
+        await query.answer(f"Реакция {reaction} добавлена!")
+    else:
+        await query.answer("❌ Не удалось добавить реакцию")
+
+async def callback_like(query, context, arg):
+    # Кнопка "Лайк" в закладках - та же реакция like
+    await callback_reaction(query, context, f'{arg}_like')
+
+async def callback_post_menu(query, context, arg):
+    post_id = int(arg)
+    await query.message.reply_text(f"Действия с постом ID: {post_id}", reply_markup=post_keyboard(post_id))
+
+async def callback_repost(query, context, arg):
+    new_post_id = await run_db(repost, query.from_user.id, int(arg))
+    if new_post_id:
+        await query.answer(f"✅ Пост репостнут! ID: {new_post_id}")
+    else:
+        await query.answer("❌ Ошибка репоста")
+
+async def callback_bookmark(query, context, arg):
+    if await run_db(add_bookmark, query.from_user.id, int(arg)):
+        await query.answer("📑 Пост добавлен в закладки!")
+    else:
+        await query.answer("❌ Не удалось добавить в закладки")
+
+async def callback_remove_bookmark(query, context, arg):
+    if await run_db(remove_bookmark, query.from_user.id, int(arg)):
+        await query.answer("🗑️ Пост удален из закладок")
+    else:
+        await query.answer("❌ Ошибка удаления из закладок")
+
+async def callback_read_notification(query, context, arg):
+    await run_db(mark_notification_read, arg)
+    await query.message.delete()
+
+async def callback_delete_notification(query, context, arg):
+    await run_db(delete_notification, arg)
+    await query.message.delete()
+
+def respond_friend(accept):
+    async def handler(query, context, arg):
+        if await run_db(respond_friend_request, query.from_user.id, int(arg), accept):
+            await query.edit_message_text("✅ Запрос дружбы принят" if accept else "✅ Запрос дружбы отклонен")
         else:
-            await query.edit_message_text("❌ Ошибка отклонения запроса")
-    elif data == 'change_nickname':
-        context.user_data['editing'] = 'nickname'
-        await query.message.reply_text("✏️ Введите новый никнейм:")
-    elif data == 'change_bio':
-        context.user_data['editing'] = 'bio'
-        await query.message.reply_text("📝 Введите новое описание профиля:")
-    elif data == 'notification_settings':
-        await show_notification_settings(query.message, context)
-    elif data.startswith('toggle_notify_'):
-        setting = data.split('_')[2]
-        cursor.execute(f'SELECT {setting} FROM notification_settings WHERE user_id = ?', (user_id,))
-        current = cursor.fetchone()[0] or 1
-        new_value = 1 - current
-        cursor.execute(f'UPDATE notification_settings SET {setting} = ? WHERE user_id = ?', (new_value, user_id))
-        conn.commit()
-        await query.answer(f"{'✅ Включено' if new_value else '❌ Отключено'}")
-        await show_notification_settings(query.message, context)
-    elif data == 'toggle_privacy':
-        user = get_user_by_id(user_id)
-        if not user:
-            await query.message.reply_text("❌ Профиль не найден")
-            return
-        new_privacy = not user.get('is_private', False)
-        update_user_profile(user_id, is_private=new_privacy)
-        status = "🔒 приватный" if new_privacy else "🔓 публичный"
-        await query.message.reply_text(f"✅ Профиль теперь {status}")
-    elif data == 'profile_back':
-        await show_profile(query.message, context)
-    elif data.startswith('buy_item_'):
-        item_id = int(data.split('_')[2])
-        result = buy_item(user_id, item_id)
-        await query.answer(result)
-    elif data.startswith('report_item_'):
-        item_id = int(data.split('_')[2])
-        context.user_data['reporting_item'] = item_id
-        await query.message.reply_text("⚠️ Укажите причину жалобы на товар:")
-    elif data.startswith('report_ad_'):
-        ad_id = int(data.split('_')[2])
-        context.user_data['reporting_ad'] = ad_id
-        await query.message.reply_text("⚠️ Укажите причину жалобы на рекламу:")
-    elif data == 'admin_panel':
-        await show_admin_panel(query.message, context)
-    elif data == 'admin_stats':
-        await query.message.reply_text("📊 Статистика в разработке")
-    elif data == 'admin_ban':
-        await query.message.reply_text("Введите: /ban <никнейм> <причина>")
-    elif data == 'admin_ads':
-        await query.message.reply_text("Список рекламы для модерации в разработке")
-    elif data == 'admin_content':
-        await query.message.reply_text("Список контента для модерации в разработке")
+            await query.edit_message_text("❌ Ошибка принятия запроса" if accept else "❌ Ошибка отклонения запроса")
+    return handler
+
+async def callback_toggle_notify(query, context, setting):
+    new_value = await run_db(toggle_notification_setting, query.from_user.id, setting)
+    if new_value is None:
+        await query.answer("❌ Ошибка изменения настройки")
+        return
+    await query.answer(f"{'✅ Включено' if new_value else '❌ Отключено'}")
+    await show_notification_settings(query.message, context)
+
+async def callback_toggle_privacy(query, context, arg):
+    user_id = query.from_user.id
+    user = await run_db(get_user_by_id, user_id)
+    if not user:
+        await query.message.reply_text("❌ Профиль не найден")
+        return
+    new_privacy = not user.get('is_private', False)
+    await run_db(update_user_profile, user_id, is_private=new_privacy)
+    status = "🔒 приватный" if new_privacy else "🔓 публичный"
+    await query.message.reply_text(f"✅ Профиль теперь {status}")
+
+async def callback_noop(query, context, arg):
+    pass
+
+async def callback_trends_window(query, context, window):
+    if window in TREND_WINDOWS:
+        context.user_data['trends_window'] = window
+    await show_trends(query.message, context)
+
+async def callback_buy_item(query, context, arg):
+    result = await run_db(buy_item, query.from_user.id, int(arg))
+    await query.answer(result)
+
+async def handle_callback(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
+    handler, arg = callback_routes.match(query.data)
+    if handler is None:
+        logger.warning(f"Неизвестный колбэк: {query.data}")
+        return
+    await handler(query, context, arg)
 
 # Новые функции для "Мои товары"
 async def show_my_marketplace(message, context: CallbackContext):
     user_id = message.from_user.id
-    offset = context.user_data.get('my_market_offset', 0)
-    items = get_my_market_items(user_id, limit=5, offset=offset)
+    page_key, backward, page = get_page(context, 'my_market')
+    items = await run_db(get_my_market_items, user_id, limit=5, page_key=page_key, backward=backward)
     
     if not items:
         response = (
@@ -2536,25 +4842,25 @@ async def show_my_marketplace(message, context: CallbackContext):
             await message.reply_text(response, reply_markup=keyboard)
     
     # Навигация
-    keyboard = []
-    if offset > 0:
-        keyboard.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'my_market_prev_{offset-5}'))
-    keyboard.append(InlineKeyboardButton("➡️ Далее", callback_data=f'my_market_next_{offset+5}'))
+    prev_key, next_key = page_keys(items, lambda i: (i[4], i[0]))
+    keyboard = page_navigation('my_market', page, prev_key, next_key)
     
     reply_markup = InlineKeyboardMarkup([keyboard])
-    context.user_data['my_market_offset'] = offset
     await message.reply_text("📦 Ваши товары:", reply_markup=reply_markup)
 
-def get_my_market_items(user_id, limit=5, offset=0):
-    cursor.execute('''
-    SELECT m.item_id, m.title, m.description, m.price, m.created_at, u.nickname, m.media_id, m.media_type
-    FROM marketplace m
-    JOIN users u ON m.seller_id = u.user_id
-    WHERE m.seller_id = ? AND m.status = 'active'
-    ORDER BY m.created_at DESC
-    LIMIT ? OFFSET ?
-    ''', (user_id, limit, offset))
-    return cursor.fetchall()
+def get_my_market_items(user_id, limit=5, page_key=None, backward=False):
+    with db.read() as cursor:
+        seek, order, key = seek_clause(['m.created_at', 'm.item_id'], page_key, backward)
+        cursor.execute(f'''
+        SELECT m.item_id, m.title, m.description, m.price, m.created_at, u.nickname, m.media_id, m.media_type
+        FROM marketplace m
+        JOIN users u ON m.seller_id = u.user_id
+        WHERE m.seller_id = ? AND m.status = 'active' AND {seek}
+        ORDER BY {order}
+        LIMIT ?
+        ''', (user_id, *key, limit))
+        items = cursor.fetchall()
+        return items[::-1] if backward else items
 
 # Командные обработчики
 async def block_user_cmd(update: Update, context: CallbackContext):
@@ -2563,7 +4869,7 @@ async def block_user_cmd(update: Update, context: CallbackContext):
         return
     nickname = context.args[0]
     reason = ' '.join(context.args[1:])
-    result = ban_user(update.effective_user.id, nickname, reason)
+    result = await run_db(ban_user, update.effective_user.id, nickname, reason)
     await update.message.reply_text(result)
 
 async def unblock_user_cmd(update: Update, context: CallbackContext):
@@ -2571,7 +4877,7 @@ async def unblock_user_cmd(update: Update, context: CallbackContext):
         await update.message.reply_text("Использование: /unblock <никнейм>")
         return
     nickname = ' '.join(context.args)
-    if unblock_user(update.effective_user.id, nickname):
+    if await run_db(unblock_user, update.effective_user.id, nickname):
         await update.message.reply_text(f"✅ Пользователь @{nickname} разблокирован")
     else:
         await update.message.reply_text("❌ Не удалось разблокировать пользователя. Возможно, он не был заблокирован.")
@@ -2582,14 +4888,14 @@ async def send_message_cmd(update: Update, context: CallbackContext):
         return
     receiver_nick = context.args[0]
     message = ' '.join(context.args[1:])
-    if send_private_message(update.effective_user.id, receiver_nick, message):
+    if await run_db(send_private_message, update.effective_user.id, receiver_nick, message):
         await update.message.reply_text(f'✉️ Сообщение отправлено @{receiver_nick}')
     else:
         await update.message.reply_text('⚠️ Не удалось отправить сообщение. Проверьте никнейм или настройки приватности.')
 
 async def daily_bonus_cmd(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    if daily_bonus(user_id):
+    if await run_db(daily_bonus, user_id):
         await update.message.reply_text('🎉 Вы получили 10 монет!')
     else:
         await update.message.reply_text('⚠️ Вы уже получали бонус сегодня. Приходите завтра!')
@@ -2599,7 +4905,7 @@ async def search_users_cmd(update: Update, context: CallbackContext):
         await update.message.reply_text("Использование: /search_users <ключевое слово>")
         return
     keyword = ' '.join(context.args)
-    results = search_users(keyword)
+    results = await run_db(search_users, keyword)
     if not results:
         await update.message.reply_text("Пользователи не найдены.")
         return
@@ -2613,7 +4919,7 @@ async def search_groups_cmd(update: Update, context: CallbackContext):
         await update.message.reply_text("Использование: /search_groups <ключевое слово>")
         return
     keyword = ' '.join(context.args)
-    results = search_groups(keyword)
+    results = await run_db(search_groups, keyword)
     if not results:
         await update.message.reply_text("Группы не найдены.")
         return
@@ -2627,7 +4933,7 @@ async def search_posts_cmd(update: Update, context: CallbackContext):
         await update.message.reply_text("Использование: /search_posts <хештег>")
         return
     hashtag = context.args[0].lstrip('#')
-    results = search_posts_by_hashtag(hashtag)
+    results = await run_db(search_posts_by_hashtag, hashtag)
     if not results:
         await update.message.reply_text("Посты с таким хештегом не найдены.")
         return
@@ -2643,12 +4949,34 @@ async def create_group_cmd(update: Update, context: CallbackContext):
         return
     group_name = context.args[0]
     description = ' '.join(context.args[1:])
-    group_id = create_group(update.effective_user.id, group_name, description)
+    group_id = await run_db(create_group, update.effective_user.id, group_name, description)
     if group_id:
         await update.message.reply_text(f"✅ Группа '{group_name}' создана! ID группы: {group_id}")
     else:
         await update.message.reply_text("⚠️ Не удалось создать группу.")
 
+async def group_trends_cmd(update: Update, context: CallbackContext):
+    if not context.args or len(context.args) > 2 or (len(context.args) == 2 and context.args[1] not in TREND_WINDOWS):
+        await update.message.reply_text(
+            "Использование: /group_trends <ID_группы> [1h|24h|7d]\n\n"
+            "Пример: /group_trends 123 7d"
+        )
+        return
+    try:
+        group_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("⚠️ ID группы должен быть числом")
+        return
+    window = context.args[1] if len(context.args) == 2 else '24h'
+    if not await run_db(can_view_group, update.effective_user.id, group_id):
+        await update.message.reply_text("❌ Группа не найдена или закрыта")
+        return
+    top = get_trending_hashtags(10, window, group_id)
+    if not top:
+        await update.message.reply_text("В группе пока нет популярных хештегов.")
+        return
+    await update.message.reply_text(format_trends(top, f"🔥 Тренды группы {group_id} за {TREND_PERIODS[window]}"))
+
 async def start_live_cmd(update: Update, context: CallbackContext):
     if len(context.args) < 2:
         await update.message.reply_text(
@@ -2665,7 +4993,7 @@ async def start_live_cmd(update: Update, context: CallbackContext):
         group_id = int(context.args[0])
         title = ' '.join(context.args[1:])
         user_id = update.effective_user.id
-        stream_id = start_live_stream(user_id, group_id, title)
+        stream_id = await run_db(start_live_stream, user_id, group_id, title)
         if stream_id:
             await update.message.reply_text(
                 f"🎥 Трансляция начата! ID: {stream_id}\n"
@@ -2682,7 +5010,7 @@ async def transfer_cmd(update: Update, context: CallbackContext):
         return
     receiver_nick = context.args[0]
     amount = context.args[1]
-    result = transfer_currency(update.effective_user.id, receiver_nick, amount)
+    result = await run_db(transfer_currency, update.effective_user.id, receiver_nick, amount)
     await update.message.reply_text(result)
 
 async def sell_cmd(update: Update, context: CallbackContext):
@@ -2698,7 +5026,7 @@ async def sell_cmd(update: Update, context: CallbackContext):
     description = ' '.join(context.args[2:])
     user_id = update.effective_user.id
     media = context.user_data.get('pending_market_media', None)
-    item_id = create_market_item(user_id, title, description, price, 
+    item_id = await run_db(create_market_item, user_id, title, description, price, 
                                 media['id'] if media else None, 
                                 media['type'] if media else None)
     if media:
@@ -2720,7 +5048,7 @@ async def create_ad_cmd(update: Update, context: CallbackContext):
     content = ' '.join(context.args[1:])
     user_id = update.effective_user.id
     media = context.user_data.get('pending_ad_media', None)
-    ad_id = create_ad(user_id, content, price, 
+    ad_id = await run_db(create_ad, user_id, content, price, 
                       media['id'] if media else None, 
                       media['type'] if media else None)
     if media:
@@ -2740,7 +5068,7 @@ async def review_ad_cmd(update: Update, context: CallbackContext):
         if action not in ('approve', 'reject'):
             await update.message.reply_text("⚠️ Укажите действие: approve или reject")
             return
-        result = review_ad(update.effective_user.id, ad_id, action == 'approve')
+        result = await run_db(review_ad, update.effective_user.id, ad_id, action == 'approve')
         await update.message.reply_text(result)
     except ValueError:
         await update.message.reply_text("⚠️ ID рекламы должен быть числом")
@@ -2751,7 +5079,7 @@ async def delete_post_cmd(update: Update, context: CallbackContext):
         return
     try:
         post_id = int(context.args[0])
-        result = delete_post(update.effective_user.id, post_id)
+        result = await run_db(delete_post, update.effective_user.id, post_id)
         await update.message.reply_text(result)
     except ValueError:
         await update.message.reply_text("⚠️ ID поста должен быть числом")
@@ -2762,7 +5090,7 @@ async def search_content_cmd(update: Update, context: CallbackContext):
         return
     keyword = ' '.join(context.args)
     user_id = update.effective_user.id
-    results = search_content(keyword, user_id)
+    results = await run_db(search_content, keyword, user_id)
     if not results:
         await update.message.reply_text("🔍 Ничего не найдено.")
         return
@@ -2773,9 +5101,217 @@ async def search_content_cmd(update: Update, context: CallbackContext):
         response += f"👤 @{nickname} ({post_date.split()[0]})\n{preview}\nID поста: {post_id}\n\n"
     await update.message.reply_text(response)
 
+async def search_market_cmd(update: Update, context: CallbackContext):
+    if not context.args:
+        await update.message.reply_text("Использование: /search_market <ключевое слово>")
+        return
+    keyword = ' '.join(context.args)
+    results = await run_db(search_market, keyword)
+    if not results:
+        await update.message.reply_text("🔍 Товары не найдены.")
+        return
+    response = "🔍 Результаты поиска товаров:\n\n"
+    for item_id, title, price, nickname in results:
+        response += f"📦 {title} — {price} монет (продавец @{nickname}, ID: {item_id})\n"
+    await update.message.reply_text(response)
+
+# Таблицы маршрутов по разделам
+# Главное меню и профиль
+menu_routes.add('👤 Профиль', open_view(show_profile))
+menu_routes.add('ℹ️ Помощь', open_view(show_help))
+menu_routes.add('🏠 Главное меню', open_main_menu)
+menu_routes.add('❌ Отмена', cancel_action)
+menu_routes.add('⚙️ Настройки', open_view(show_settings))
+menu_routes.add('🔔 Уведомления', open_view(show_notifications))
+menu_routes.add('🛠️ Админ-панель', open_view(show_admin_panel))
+flow_routes.append(('editing', finish_editing))
+callback_routes.add('main_menu', callback_main_menu)
+callback_routes.add('profile_back', answer_with_view(show_profile))
+callback_routes.add('stats', answer_with_view(show_stats))
+callback_routes.add('achievements', answer_with_view(show_achievements))
+callback_routes.add('change_nickname', await_input('editing', "✏️ Введите новый никнейм:", 'nickname'))
+callback_routes.add('change_bio', await_input('editing', "📝 Введите новое описание профиля:", 'bio'))
+callback_routes.add('toggle_privacy', callback_toggle_privacy)
+callback_routes.add('notification_settings', answer_with_view(show_notification_settings))
+callback_routes.add('toggle_notify_', callback_toggle_notify, prefix=True)
+callback_routes.add('read_', callback_read_notification, prefix=True)
+callback_routes.add('delete_', callback_delete_notification, prefix=True)
+callback_routes.add('noop', callback_noop)
+
+# Лента и посты
+menu_routes.add('📰 Лента', open_feed)
+menu_routes.add('🔥 Тренды', open_view(show_trends))
+callback_routes.add('trends_', callback_trends_window, prefix=True)
+menu_routes.add('📑 Закладки', open_listing('bookmark', show_bookmarks))
+menu_routes.add('📝 Создать пост', reply_with(
+    "📝 Создание нового поста:\n\n"
+    "• Просто напишите текст поста\n"
+    "• Или отправьте фото/видео с описанием\n"
+    "• Используйте #хештеги для лучшего охвата\n\n"
+    "Отправьте содержимое поста сейчас:"
+))
+menu_routes.add('📸 Истории', show_stories)
+flow_routes.append(('commenting_post', finish_comment))
+flow_routes.append(('reporting_post', functools.partial(finish_report, 'post')))
+callback_routes.add('create_post', answer_with_text(
+    "📝 Создание нового поста:\n\n"
+    "1. Вы можете просто отправить текст\n"
+    "2. Или отправить медиа (фото/видео/документ) с подписью\n"
+    "3. Используйте хештеги #пример для категоризации\n\n"
+    "Отправьте содержимое поста сейчас:"
+))
+for feed_filter in ('friends', 'groups', 'popular', 'smart'):
+    callback_routes.add(f'feed_{feed_filter}', set_feed_filter(feed_filter))
+callback_routes.add('filter_feed', answer_with_text("📂 Выберите тип контента для ленты:", filter_feed_keyboard))
+callback_routes.add('feed_all', set_feed_media_filter(None))
+callback_routes.add('feed_photos', set_feed_media_filter('photos'))
+callback_routes.add('feed_videos', set_feed_media_filter('videos'))
+callback_routes.add('my_posts', first_page('my_posts', show_my_posts))
+callback_routes.add('delete_my_post_', callback_delete_my_post, prefix=True)
+callback_routes.add('post_menu_', callback_post_menu, prefix=True)
+callback_routes.add('reaction_', callback_reaction, prefix=True)
+callback_routes.add('like_', callback_like, prefix=True)
+callback_routes.add('comment_', await_input('commenting_post', "💬 Введите текст комментария:"), prefix=True)
+callback_routes.add('repost_', callback_repost, prefix=True)
+callback_routes.add('bookmark_', callback_bookmark, prefix=True)
+callback_routes.add('remove_bookmark_', callback_remove_bookmark, prefix=True)
+callback_routes.add('report_post_', await_input('reporting_post', "⚠️ Укажите причину жалобы на пост:"), prefix=True)
+callback_routes.add('share_', answer_with_text("📤 Функция в разработке"), prefix=True)
+
+# Сообщения
+menu_routes.add('💬 Сообщения', open_listing('inbox', show_messages))
+menu_routes.add('📥 Входящие сообщения', open_listing('inbox', show_messages))
+menu_routes.add('📤 Отправленные сообщения', open_listing('sent', show_sent_messages))
+menu_routes.add('✉️ Новое сообщение', reply_with("Введите никнейм получателя и сообщение: /msg <никнейм> <текст>",
+                                                messages_menu_keyboard))
+menu_routes.add('👥 Контакты', open_view(show_contacts))
+
+# Друзья и группы
+menu_routes.add('👥 Группы', open_view(show_groups))
+menu_routes.add('👥 Мои группы', open_view(show_groups))
+menu_routes.add('📝 Создать группу', reply_with("Введите: /create_group <название> <описание>", groups_menu_keyboard))
+menu_routes.add('🎥 Начать трансляцию', reply_with(
+    "🎥 Запуск трансляции:\n\n"
+    "Использование: /start_live <ID_группы> <Название>\n\n"
+    "Как получить ID группы:\n"
+    "1. Перейдите в раздел '👥 Группы'\n"
+    "2. Выберите '👥 Мои группы'\n"
+    "3. ID группы указан в скобках\n\n"
+    "Пример: /start_live 123 Моя первая трансляция"
+))
+menu_routes.add('🔍 Найти группу', reply_with("Введите: /search_groups <ключевое слово>", groups_menu_keyboard))
+callback_routes.add('friends_list', answer_with_view(show_friends))
+callback_routes.add('blocked_list', answer_with_view(show_blocked))
+callback_routes.add('accept_friend_', respond_friend(True), prefix=True)
+callback_routes.add('reject_friend_', respond_friend(False), prefix=True)
+
+# Экономика, маркет и реклама
+menu_routes.add('💰 Экономика', open_view(show_economy))
+menu_routes.add('💰 Мой баланс', open_view(show_economy))
+menu_routes.add('🎁 Получить бонус', claim_daily_bonus)
+menu_routes.add('➡️ Перевод монет', reply_with("Введите: /transfer <никнейм> <сумма>", economy_menu_keyboard))
+menu_routes.add('🛒 Маркет', open_listing('market', show_marketplace))
+menu_routes.add('🛒 Просмотреть маркет', open_listing('market', show_marketplace))
+menu_routes.add('📦 Мои товары', open_listing('my_market', show_my_marketplace))
+menu_routes.add('💰 Продать товар', reply_with("Отправьте фото/видео товара и введите: /sell <название> <цена> <описание>",
+                                              market_menu_keyboard))
+menu_routes.add('📢 Создать рекламу', reply_with(
+    "📢 Создание рекламы:\n\n"
+    "1. Отправьте медиа (фото/видео) для рекламы (необязательно)\n"
+    "2. Используйте команду: /create_ad <бюджет> <текст>\n"
+    "3. Пример: /create_ad 50 Присоединяйтесь к нашей группе!\n"
+    "4. Реклама будет проверена модератором\n\n"
+    "Вы можете отправить медиа сейчас или сразу использовать команду"
+))
+flow_routes.append(('reporting_item', functools.partial(finish_report, 'item')))
+flow_routes.append(('reporting_ad', functools.partial(finish_report, 'ad')))
+callback_routes.add('buy_item_', callback_buy_item, prefix=True)
+callback_routes.add('report_item_', await_input('reporting_item', "⚠️ Укажите причину жалобы на товар:"), prefix=True)
+callback_routes.add('report_ad_', await_input('reporting_ad', "⚠️ Укажите причину жалобы на рекламу:"), prefix=True)
+callback_routes.add('edit_item_', answer_with_text("✏️ Редактирование товаров в разработке"), prefix=True)
+callback_routes.add('delete_item_', answer_with_text("❌ Удаление товаров в разработке"), prefix=True)
+
+# Поиск
+menu_routes.add('🔍 Поиск', open_view(show_search))
+menu_routes.add('👤 Поиск пользователей', start_search('searching_users', "🔍 Введите имя пользователя для поиска:"))
+menu_routes.add('#️⃣ Поиск по хештегам', start_search('searching_hashtag', "🔍 Введите хештег для поиска (без #):"))
+menu_routes.add('📝 Поиск постов', start_search('searching_hashtag', "🔍 Введите хештег для поиска (без #):"))
+menu_routes.add('👥 Поиск групп', start_search('searching_groups', "🔍 Введите название группы для поиска:"))
+menu_routes.add('📜 Поиск по контенту', start_search('searching_content', "🔍 Введите ключевое слово для поиска:"))
+menu_routes.add('🛒 Поиск товаров', start_search('searching_market', "🔍 Введите название или описание товара:"))
+search_routes.extend([
+    ('searching_users', finish_search_users),
+    ('searching_hashtag', finish_search_hashtag),
+    ('searching_groups', finish_search_groups),
+    ('searching_content', finish_search_content),
+    ('searching_market', finish_search_market),
+])
+
+# Постраничные списки: кнопки "Назад"/"Далее" несут ключ страницы после префикса
+for listing, show in (('feed', show_feed), ('my_posts', show_my_posts), ('bookmark', show_bookmarks),
+                      ('market', show_marketplace), ('my_market', show_my_marketplace),
+                      ('inbox', show_messages), ('sent', show_sent_messages)):
+    callback_routes.add(f'{listing}_prev_', turn_page(listing, show, True), prefix=True)
+    callback_routes.add(f'{listing}_next_', turn_page(listing, show, False), prefix=True)
+
+# Администрирование
+callback_routes.add('admin_panel', answer_with_view(show_admin_panel))
+callback_routes.add('admin_stats', answer_with_view(show_admin_stats))
+callback_routes.add('admin_ban', answer_with_text("Введите: /ban <никнейм> <причина>"))
+callback_routes.add('admin_ads', answer_with_text("Список рекламы для модерации в разработке"))
+callback_routes.add('admin_content', answer_with_text("Список контента для модерации в разработке"))
+
+# Прием обновлений: при заданном SOCIAL_WEBHOOK_URL Telegram присылает их на встроенный HTTP-сервер, иначе - long polling
+WEBHOOK_URL = os.environ.get('SOCIAL_WEBHOOK_URL', '')  # внешний адрес, например https://bot.example.com/telegram
+WEBHOOK_LISTEN = os.environ.get('SOCIAL_WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('SOCIAL_WEBHOOK_PORT', 8443))
+WEBHOOK_SECRET = os.environ.get('SOCIAL_WEBHOOK_SECRET', '')  # пусто - новый случайный при каждом запуске
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('SOCIAL_WEBHOOK_MAX_CONNECTIONS', 40))  # одновременных запросов от Telegram
+UPDATE_QUEUE_LIMIT = int(os.environ.get('SOCIAL_UPDATE_QUEUE_LIMIT', 1000))  # принятых, но еще не обработанных обновлений
+BOT_TOKEN = "СЮДА ТОКЕН БОТА"
+BOT_API_URL = os.environ.get('SOCIAL_BOT_API_URL', 'https://api.telegram.org/bot')  # свой Bot API сервер или заглушка для тестов
+
+class UpdateQueue(asyncio.Queue):
+    # Application сразу разбирает очередь в задачи, поэтому ограничиваем не длину очереди, а число обновлений в работе:
+    # put ждет, пока task_done (его Application вызывает по окончании обработки) не освободит место.
+    # Пока put ждет, webhook-сервер не отвечает Telegram, а polling не запрашивает новые обновления
+    def __init__(self, limit=UPDATE_QUEUE_LIMIT):
+        super().__init__()
+        self._slots = asyncio.Semaphore(limit)
+        self.stats = {'accepted': 0, 'in_progress': 0, 'waited': 0}
+
+    async def put(self, item):
+        if self._slots.locked():
+            self.stats['waited'] += 1
+        await self._slots.acquire()
+        self.stats['accepted'] += 1
+        self.stats['in_progress'] += 1
+        await super().put(item)
+
+    def task_done(self):
+        super().task_done()
+        self.stats['in_progress'] -= 1
+        self._slots.release()
+
 # Основная функция
-def main():
-    application = Application.builder().token("СЮДА ТОКЕН БОТА").build()
+async def start_background(application):
+    # Фоновая запись уведомлений; дайджесты в чат отправляются через бота в цикле приложения
+    notifier.start(application.bot, asyncio.get_running_loop())
+    state_store.start(application)
+    logger.info(f"Бот готов к работе через {(time.perf_counter() - STARTED_AT) * 1000:.0f} мс после загрузки модуля")
+
+def build_application(updater=True):
+    # Обновления разных пользователей обрабатываются параллельно, запросы к БД уходят в db_executor
+    # Все исходящие запросы проходят через send_scheduler (лимиты Telegram, повтор при RetryAfter)
+    # Без updater обновления в update_queue кладет serve_shard (воркер многопроцессного режима)
+    builder = (
+        Application.builder().token(BOT_TOKEN).base_url(BOT_API_URL)
+        .concurrent_updates(True).update_queue(UpdateQueue()).rate_limiter(send_scheduler).persistence(state_store)
+        .post_init(start_background)
+    )
+    if not updater:
+        builder = builder.updater(None)
+    application = builder.build()
     
     # Обработчики команд
     command_handlers = [
@@ -2789,6 +5325,7 @@ def main():
         CommandHandler("search_posts", search_posts_cmd),
         CommandHandler("create_group", create_group_cmd),
         CommandHandler("start_live", start_live_cmd),
+        CommandHandler("group_trends", group_trends_cmd),
         CommandHandler("transfer", transfer_cmd),
         CommandHandler("sell", sell_cmd),
         CommandHandler("create_ad", create_ad_cmd),
@@ -2796,6 +5333,7 @@ def main():
         CommandHandler("delete_post", delete_post_cmd),
         CommandHandler("stories", show_stories),
         CommandHandler("search_content", search_content_cmd),
+        CommandHandler("search_market", search_market_cmd),
         CommandHandler("help", help_command),
     ]
     
@@ -2809,8 +5347,180 @@ def main():
     application.add_handler(MessageHandler(filters.Document.ALL, handle_message))
     application.add_handler(MessageHandler(filters.Sticker.ALL, handle_message))
     application.add_handler(CallbackQueryHandler(handle_callback))
-    
-    application.run_polling()
+    return application
+
+def receive_updates(application):
+    # По SIGINT/SIGTERM прием останавливается, а уже принятые обновления дорабатываются до выхода
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=urlsplit(WEBHOOK_URL).path.lstrip('/'),
+            webhook_url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET or secrets.token_urlsafe(32),
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        application.run_polling()
+
+# Многопроцессный режим: маршрутизатор принимает обновления и раздает их воркерам по user_id, поэтому
+# обновления одного пользователя и его user_data всегда в одном процессе. Воркеры делят базу через WAL
+WORKERS = int(os.environ.get('SOCIAL_WORKERS', 1))
+
+SHARED_EVENTS = {
+    'invalidate': lambda name, key: CACHES[name].invalidate(key),
+    'clear': lambda name: CACHES[name].clear(),
+    'block': block_index.add,
+    'unblock': block_index.remove,
+    'trend': trends.add,
+    'broadcast': broadcast_wakeup.set,
+}
+# Маршрутизатор не отвечает на запросы трендов, поэтому и счетчики их не ведет
+ROUTER_EVENTS = SHARED_EVENTS.keys() - {'trend'}
+
+def shard_of(update, workers):
+    # Обновления без пользователя (посты каналов и т.п.) распределяются по чату
+    if update.effective_user:
+        key = update.effective_user.id
+    elif update.effective_chat:
+        key = update.effective_chat.id
+    else:
+        key = update.update_id
+    return key % workers
+
+def deliver(inbox, process, data):
+    # Ждет места в очереди воркера; если воркер упал, обновление не на ком обработать
+    while process.is_alive():
+        try:
+            inbox.put(data, timeout=1)
+            return
+        except queue.Full:
+            pass
+    logger.error(f"Воркер {process.name} не работает, обновление {data['update_id']} пропущено")
+
+def shard_router(inboxes, processes):
+    async def route(update: Update, context: CallbackContext):
+        # Маршрутизатор обрабатывает обновления по одному: порядок сохраняется,
+        # а пока очередь воркера полна, приостанавливается и прием новых обновлений
+        shard = shard_of(update, len(inboxes))
+        await asyncio.get_running_loop().run_in_executor(None, deliver, inboxes[shard], processes[shard], update.to_dict())
+    return route
+
+def shard_watcher(processes):
+    async def watch(application):
+        loop = asyncio.get_running_loop()
+
+        def wait():
+            while all(process.is_alive() for process in processes):
+                time.sleep(1)
+            if application.running:
+                logger.error("Один из воркеров завершился, бот останавливается")
+                loop.call_soon_threadsafe(application.stop_running)
+        threading.Thread(target=wait, name='shard-watch', daemon=True).start()
+    return watch
+
+def relay_shared_events(events, inboxes):
+    # Событие воркера применяется в маршрутизаторе и пересылается остальным воркерам
+    while True:
+        origin, event, args = events.get()
+        try:
+            if origin != -1 and event in ROUTER_EVENTS:
+                SHARED_EVENTS[event](*args)
+        except Exception as e:
+            logger.error(f"Ошибка применения события {event}: {e}")
+        for index, inbox in enumerate(inboxes):
+            if index != origin:
+                inbox.put((event, args))
+
+def apply_shared_events(inbox):
+    while True:
+        event, args = inbox.get()
+        try:
+            SHARED_EVENTS[event](*args)
+        except Exception as e:
+            logger.error(f"Ошибка применения события {event}: {e}")
+
+async def serve_shard(application, updates, ready):
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    await start_background(application)
+    await application.start()
+    ready.put(shard_index)
+    # None - сигнал остановки: все обновления перед ним уже в update_queue и будут доработаны в stop()
+    while (data := await loop.run_in_executor(None, updates.get)) is not None:
+        await application.update_queue.put(Update.de_json(data, application.bot))
+    await application.stop()
+    await application.shutdown()
+
+def run_worker(index, workers, updates, events, shared, ready):
+    global shared_events, shard_index
+    # Остановкой управляет маршрутизатор, иначе Ctrl+C прервал бы воркер посреди очереди
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    shared_events, shard_index = shared, index
+    init()
+    # Лимит Telegram на весь бот делится между воркерами
+    send_scheduler.global_budget = RateBudget(SEND_GLOBAL_RATE / workers, SEND_GLOBAL_RATE / workers)
+    threading.Thread(target=trends.load, args=(trends_loaded_upto,), name='trends', daemon=True).start()
+    threading.Thread(target=apply_shared_events, args=(events,), name='shared-events', daemon=True).start()
+    asyncio.run(serve_shard(build_application(updater=False), updates, ready))
+    notifier.close()
+    db_executor.shutdown()
+    db.close()
+
+def run_sharded(workers):
+    global shared_events, shard_index
+    # spawn: воркеры не наследуют соединения с базой и потоки маршрутизатора
+    mp = multiprocessing.get_context('spawn')
+    inboxes = [mp.Queue(UPDATE_QUEUE_LIMIT) for _ in range(workers)]
+    events = [mp.Queue() for _ in range(workers)]
+    shared, ready = mp.Queue(), mp.Queue()
+    processes = [
+        mp.Process(target=run_worker, args=(index, workers, inboxes[index], events[index], shared, ready), name=f'shard-{index}')
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    # Обновления пойдут только после того, как каждый воркер запомнит, с какого поста считает тренды сам
+    for _ in processes:
+        while True:
+            try:
+                ready.get(timeout=1)
+                break
+            except queue.Empty:
+                if not all(process.is_alive() for process in processes):
+                    raise RuntimeError("Воркер завершился при запуске")
+    shared_events, shard_index = shared, -1
+    threading.Thread(target=relay_shared_events, args=(shared, events), name='shared-events', daemon=True).start()
+
+    application = (
+        Application.builder().token(BOT_TOKEN).base_url(BOT_API_URL)
+        .update_queue(UpdateQueue()).post_init(shard_watcher(processes)).build()
+    )
+    application.add_handler(TypeHandler(Update, shard_router(inboxes, processes)))
+    receive_updates(application)
+    for index, process in enumerate(processes):
+        if process.is_alive():
+            inboxes[index].put(None)
+        else:
+            # Буферы очередей к упавшему воркеру уже некому читать - не ждем их при выходе
+            inboxes[index].cancel_join_thread()
+            events[index].cancel_join_thread()
+    for process in processes:
+        process.join()
+
+def main():
+    init()
+    # Отложенные шаги миграций (заполнение счетчиков, поиска, построение индексов), рассылки и обрезка ленты идут в фоне
+    threading.Thread(target=run_backfills, name='backfill', daemon=True).start()
+    threading.Thread(target=run_broadcasts, name='broadcasts', daemon=True).start()
+    threading.Thread(target=run_timeline_pruning, name='timeline-pruning', daemon=True).start()
+    if WORKERS > 1:
+        run_sharded(WORKERS)
+    else:
+        # Тренды по уже существующим постам досчитываются в фоне, новые посты учитываются сразу
+        threading.Thread(target=trends.load, args=(trends_loaded_upto,), name='trends', daemon=True).start()
+        receive_updates(build_application())
+        notifier.close()
+    db_executor.shutdown()
+    db.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,203 @@
+-- Схема базы до версионных миграций (PRAGMA user_version = 0): с нее обновляются старые установки
+CREATE TABLE users (
+    user_id INTEGER PRIMARY KEY,
+    nickname TEXT UNIQUE,
+    reg_date TEXT,
+    last_seen TEXT,
+    is_private BOOLEAN DEFAULT 0,
+    bio TEXT DEFAULT ''
+);
+CREATE TABLE friends (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    friend_id INTEGER,
+    status TEXT CHECK(status IN ('pending', 'accepted', 'rejected')) DEFAULT 'pending',
+    created_at TEXT DEFAULT (datetime('now')),
+    FOREIGN KEY (user_id) REFERENCES users(user_id),
+    FOREIGN KEY (friend_id) REFERENCES users(user_id),
+    UNIQUE(user_id, friend_id)
+);
+CREATE TABLE posts (
+    post_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    content TEXT,
+    post_date TEXT,
+    group_id INTEGER,
+    media_type TEXT,  -- 'photo', 'video', 'document', 'sticker'
+    media_id TEXT,
+    FOREIGN KEY (user_id) REFERENCES users(user_id),
+    FOREIGN KEY (group_id) REFERENCES groups(group_id)
+);
+CREATE TABLE hashtags (
+    hashtag_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT UNIQUE
+);
+CREATE TABLE post_hashtags (
+    post_id INTEGER,
+    hashtag_id INTEGER,
+    PRIMARY KEY (post_id, hashtag_id),
+    FOREIGN KEY (post_id) REFERENCES posts(post_id),
+    FOREIGN KEY (hashtag_id) REFERENCES hashtags(hashtag_id)
+);
+CREATE TABLE likes (
+    like_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    post_id INTEGER,
+    user_id INTEGER,
+    like_date TEXT,
+    reaction TEXT DEFAULT 'like',
+    FOREIGN KEY (post_id) REFERENCES posts(post_id),
+    FOREIGN KEY (user_id) REFERENCES users(user_id),
+    UNIQUE(post_id, user_id)
+);
+CREATE TABLE comments (
+    comment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    post_id INTEGER,
+    user_id INTEGER,
+    content TEXT,
+    comment_date TEXT,
+    FOREIGN KEY (post_id) REFERENCES posts(post_id),
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
+CREATE TABLE notifications (
+    notification_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    type TEXT,
+    content TEXT,
+    related_id INTEGER,
+    notification_date TEXT,
+    is_read INTEGER DEFAULT 0,
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
+CREATE TABLE messages (
+    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sender_id INTEGER,
+    receiver_id INTEGER,
+    content TEXT,
+    timestamp TEXT,
+    is_read BOOLEAN DEFAULT 0,
+    FOREIGN KEY (sender_id) REFERENCES users(user_id),
+    FOREIGN KEY (receiver_id) REFERENCES users(user_id)
+);
+CREATE TABLE groups (
+    group_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    creator_id INTEGER,
+    description TEXT,
+    is_public BOOLEAN DEFAULT 1,
+    FOREIGN KEY (creator_id) REFERENCES users(user_id)
+);
+CREATE TABLE group_members (
+    group_id INTEGER,
+    user_id INTEGER,
+    role TEXT CHECK(role IN ('admin', 'moderator', 'member')) DEFAULT 'member',
+    joined_at TEXT DEFAULT (datetime('now')),
+    PRIMARY KEY (group_id, user_id),
+    FOREIGN KEY (group_id) REFERENCES groups(group_id),
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
+CREATE TABLE blocks (
+    blocker_id INTEGER,
+    blocked_id INTEGER,
+    created_at TEXT DEFAULT (datetime('now')),
+    PRIMARY KEY (blocker_id, blocked_id),
+    FOREIGN KEY (blocker_id) REFERENCES users(user_id),
+    FOREIGN KEY (blocked_id) REFERENCES users(user_id)
+);
+CREATE TABLE currencies (
+    user_id INTEGER PRIMARY KEY,
+    balance INTEGER DEFAULT 0,
+    last_claim TEXT,
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
+CREATE TABLE reports (
+    report_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    reporter_id INTEGER,
+    target_id INTEGER,
+    target_type TEXT CHECK(target_type IN ('post', 'user', 'item', 'ad')),
+    reason TEXT,
+    report_date TEXT DEFAULT (datetime('now')),
+    FOREIGN KEY (reporter_id) REFERENCES users(user_id)
+);
+CREATE TABLE bookmarks (
+    bookmark_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    post_id INTEGER,
+    created_at TEXT DEFAULT (datetime('now')),
+    FOREIGN KEY (user_id) REFERENCES users(user_id),
+    FOREIGN KEY (post_id) REFERENCES posts(post_id),
+    UNIQUE(user_id, post_id)
+);
+CREATE TABLE marketplace (
+    item_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    seller_id INTEGER,
+    title TEXT,
+    description TEXT,
+    price INTEGER,
+    created_at TEXT DEFAULT (datetime('now')),
+    status TEXT CHECK(status IN ('active', 'sold', 'cancelled')) DEFAULT 'active',
+    media_id TEXT,
+    media_type TEXT,
+    FOREIGN KEY (seller_id) REFERENCES users(user_id)
+);
+CREATE TABLE ads (
+    ad_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    creator_id INTEGER,
+    content TEXT,
+    price INTEGER,
+    created_at TEXT DEFAULT (datetime('now')),
+    status TEXT CHECK(status IN ('pending', 'approved', 'rejected', 'active', 'expired')) DEFAULT 'pending',
+    media_id TEXT,
+    media_type TEXT,
+    FOREIGN KEY (creator_id) REFERENCES users(user_id)
+);
+CREATE TABLE admins (
+    user_id INTEGER PRIMARY KEY,
+    role TEXT CHECK(role IN ('admin', 'moderator', 'superadmin')) DEFAULT 'admin',
+    appointed_at TEXT DEFAULT (datetime('now')),
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
+CREATE TABLE stories (
+    story_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    media_id TEXT,
+    media_type TEXT CHECK(media_type IN ('photo', 'video', 'text')),
+    content TEXT,
+    created_at TEXT DEFAULT (datetime('now')),
+    expires_at TEXT DEFAULT (datetime('now', '+24 hours')),
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
+CREATE TABLE live_streams (
+    stream_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    group_id INTEGER,
+    title TEXT,
+    started_at TEXT DEFAULT (datetime('now')),
+    status TEXT CHECK(status IN ('active', 'ended')) DEFAULT 'active',
+    FOREIGN KEY (user_id) REFERENCES users(user_id),
+    FOREIGN KEY (group_id) REFERENCES groups(group_id)
+);
+CREATE TABLE achievements (
+    achievement_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    type TEXT,
+    description TEXT,
+    earned_at TEXT DEFAULT (datetime('now')),
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
+CREATE TABLE notification_settings (
+    user_id INTEGER PRIMARY KEY,
+    notify_likes BOOLEAN DEFAULT 1,
+    notify_comments BOOLEAN DEFAULT 1,
+    notify_mentions BOOLEAN DEFAULT 1,
+    notify_friend_requests BOOLEAN DEFAULT 1,
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
+CREATE INDEX idx_friends_user ON friends(user_id);
+CREATE INDEX idx_friends_friend ON friends(friend_id);
+CREATE INDEX idx_posts_user ON posts(user_id);
+CREATE INDEX idx_notifications_user ON notifications(user_id);
+CREATE INDEX idx_messages_receiver ON messages(receiver_id);
+CREATE INDEX idx_group_members_user ON group_members(user_id);
+CREATE INDEX idx_bookmarks_user ON bookmarks(user_id);
+CREATE INDEX idx_marketplace_seller ON marketplace(seller_id);
+CREATE INDEX idx_ads_creator ON ads(creator_id);
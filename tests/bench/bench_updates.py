@@ -0,0 +1,90 @@
+# Пропускная способность приема обновлений: бот (отдельный процесс, новая база) против заглушки fake_bot_api.py.
+# Пример: python tests/bench/bench_updates.py --updates 2000 --modes polling webhook
+# Масштабирование по процессам (SOCIAL_WORKERS): python tests/bench/bench_updates.py --modes polling --workers 1 2 4
+import argparse
+import os
+import select
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent.parent))
+sys.path.insert(0, str(HERE))
+
+import socialNetworkBot as bot
+from fake_bot_api import FIRST_CHAT, USERS
+
+API_PORT = 18081
+WEBHOOK_PORT = 18443
+
+# Меряем прием и обработку, а не лимиты Telegram на отправку.
+# На уровне модуля, чтобы действовало и в воркерах (они импортируют этот файл заново)
+bot.SEND_GLOBAL_RATE = bot.SEND_CHAT_RATE = bot.SEND_CHAT_BURST = 1e6
+bot.send_scheduler.global_budget = bot.RateBudget(1e6, 1e6)
+
+
+def serve_bot():
+    bot.init()
+    for i in range(USERS):
+        bot.register_user(FIRST_CHAT + i, f'bench{i}')
+    bot.main()
+
+
+def wait_line(process, prefix, deadline, watched=()):
+    while time.monotonic() < deadline:
+        for other in watched:
+            if other.poll() is not None:
+                raise RuntimeError(f'процесс {other.args} завершился с кодом {other.returncode}')
+        if select.select([process.stdout], [], [], 0.5)[0]:
+            line = process.stdout.readline()
+            if line.startswith(prefix):
+                return line.split()
+    raise TimeoutError(f'нет строки {prefix!r}')
+
+
+def run(mode, updates, workers=1, timeout=300):
+    # Возвращает обновлений в секунду: от первого выданного обновления до ответа бота на последнее
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, SOCIAL_DB_PATH=str(Path(tmp) / 'bench.db'), SOCIAL_WORKERS=str(workers),
+                   SOCIAL_BOT_API_URL=f'http://127.0.0.1:{API_PORT}/bot')
+        if mode == 'webhook':
+            env.update(SOCIAL_WEBHOOK_URL=f'http://127.0.0.1:{WEBHOOK_PORT}/hook',
+                       SOCIAL_WEBHOOK_LISTEN='127.0.0.1', SOCIAL_WEBHOOK_PORT=str(WEBHOOK_PORT))
+        api = subprocess.Popen([sys.executable, HERE / 'fake_bot_api.py', str(updates), str(API_PORT)],
+                               stdout=subprocess.PIPE, text=True)
+        server = None
+        try:
+            deadline = time.monotonic() + timeout
+            wait_line(api, 'ready', deadline)
+            server = subprocess.Popen([sys.executable, __file__, '--serve'], env=env,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            _, count, seconds = wait_line(api, 'RESULT', deadline, watched=(server,))
+            return int(count) / float(seconds)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+            api.terminate()
+            api.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--modes', nargs='+', choices=('polling', 'webhook'), default=['polling', 'webhook'])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1])
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve_bot()
+        return
+    for mode in args.modes:
+        for workers in args.workers:
+            print(f'{mode}, воркеров {workers}: {run(mode, args.updates, workers):.0f} обновлений/с', flush=True)
+
+
+if __name__ == '__main__':
+    main()
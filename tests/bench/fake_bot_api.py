@@ -0,0 +1,111 @@
+# Заглушка Bot API для нагрузочных тестов: отдает заданное число обновлений через getUpdates
+# или шлет их на webhook бота и засекает время до ответа бота на последнее.
+# Запуск: python fake_bot_api.py <обновлений> <порт>; печатает "ready", затем "RESULT <обновлений> <секунд>"
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+from urllib.parse import urlsplit
+
+import tornado.web
+
+FIRST_CHAT = 1000  # пользователи FIRST_CHAT .. FIRST_CHAT + USERS - 1 (их регистрирует бенчмарк)
+USERS = 50
+GET_UPDATES_LIMIT = 100
+
+
+def make_updates(count):
+    return [{
+        'update_id': i + 1,
+        'message': {
+            'message_id': i + 1, 'date': int(time.time()), 'text': 'ℹ️ Помощь',
+            'chat': {'id': FIRST_CHAT + i % USERS, 'type': 'private'},
+            'from': {'id': FIRST_CHAT + i % USERS, 'is_bot': False, 'first_name': 'u'},
+        },
+    } for i in range(count)]
+
+
+class FakeBotApi:
+    def __init__(self, count):
+        self.updates = make_updates(count)
+        self.sent = 0
+        self.started = None
+
+    def answered(self):
+        self.sent += 1
+        if self.sent == len(self.updates):
+            print(f'RESULT {self.sent} {time.perf_counter() - self.started:.3f}', flush=True)
+
+    def get_updates(self, offset):
+        if self.started is None:
+            self.started = time.perf_counter()
+        start = max(offset - 1, 0)
+        return self.updates[start:start + GET_UPDATES_LIMIT]
+
+    async def push(self, url, secret, connections):
+        # Как Telegram: не больше connections запросов одновременно, следующий - после ответа на предыдущий
+        await asyncio.sleep(0.5)
+        self.started = time.perf_counter()
+        todo = list(reversed(self.updates))
+        parts = urlsplit(url)
+
+        async def connection():
+            reader, writer = await asyncio.open_connection(parts.hostname, parts.port)
+            while todo:
+                body = json.dumps(todo.pop()).encode()
+                writer.write(
+                    f'POST {parts.path} HTTP/1.1\r\nHost: {parts.hostname}\r\nContent-Type: application/json\r\n'
+                    f'X-Telegram-Bot-Api-Secret-Token: {secret}\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+                status = await reader.readline()
+                if b' 200 ' not in status:
+                    raise RuntimeError(f'webhook ответил {status!r}')
+                length = 0
+                while (line := await reader.readline()) != b'\r\n':
+                    if line.lower().startswith(b'content-length'):
+                        length = int(line.split(b':')[1])
+                await reader.readexactly(length)
+            writer.close()
+
+        await asyncio.gather(*(connection() for _ in range(connections)))
+
+
+class ApiHandler(tornado.web.RequestHandler):
+    def initialize(self, api):
+        self.api = api
+
+    async def post(self, token, method):
+        if 'json' in self.request.headers.get('Content-Type', ''):
+            args = json.loads(self.request.body or b'{}')
+        else:
+            args = {name: values[0].decode() for name, values in self.request.body_arguments.items()}
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        elif method == 'setWebhook':
+            asyncio.get_running_loop().create_task(
+                self.api.push(args['url'], args.get('secret_token', ''), int(args.get('max_connections', 40))))
+            result = True
+        elif method == 'getUpdates':
+            result = self.api.get_updates(int(args.get('offset') or 0))
+            if not result:
+                await asyncio.sleep(min(float(args.get('timeout') or 0), 1))
+        elif method.startswith('send'):
+            self.api.answered()
+            result = {'message_id': 1, 'date': 0, 'text': 'x',
+                      'chat': {'id': int(args.get('chat_id', 0)), 'type': 'private'}}
+        else:
+            result = True
+        self.write({'ok': True, 'result': result})
+
+
+async def serve(count, port):
+    api = FakeBotApi(count)
+    tornado.web.Application([(r'/bot([^/]+)/(\w+)', ApiHandler, {'api': api})]).listen(port, '127.0.0.1')
+    print('ready', flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, lambda *args: os._exit(0))
+    asyncio.run(serve(int(sys.argv[1]), int(sys.argv[2])))
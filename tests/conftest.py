@@ -0,0 +1,211 @@
+import random
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import socialNetworkBot as bot
+
+BASELINE_SCHEMA = Path(__file__).with_name('baseline_schema.sql')
+LEGACY_USERS = range(1001, 1101)  # не пересекаются с пользователями, которых регистрирует run_workload
+
+
+def open_database(monkeypatch, path):
+    # Отдельный пул с проверкой планов вместо общего bot.db; кэши от прошлой базы сбрасываем
+    pool = bot.ConnectionPool(str(path), readers=2)
+    pool.plans = bot.QueryPlanChecker(str(path))
+    pool.on_open = bot.prepare_database
+    monkeypatch.setattr(bot, 'db', pool)
+    for cache in bot.CACHES.values():
+        cache.clear()
+    pool.open()
+    return pool
+
+
+def close_database(pool):
+    bot.notifier.flush()
+    pool.close()
+    if pool.plans._conn is not None:
+        pool.plans._conn.close()
+
+
+def fill_baseline(conn):
+    # Данные старой установки: на них миграции ставят в очередь фоновые шаги и индексы
+    rnd = random.Random(1)
+    users = list(LEGACY_USERS)
+    conn.executemany("INSERT INTO users (user_id, nickname, reg_date) VALUES (?, ?, datetime('now', '-30 days'))",
+                     [(user_id, f'old{user_id}') for user_id in users])
+    conn.executemany("INSERT INTO currencies (user_id, balance) VALUES (?, 100)", [(user_id,) for user_id in users])
+    conn.executemany("INSERT OR IGNORE INTO friends (user_id, friend_id, status) VALUES (?, ?, 'accepted')",
+                     [(rnd.choice(users), rnd.choice(users)) for _ in range(300)])
+    conn.execute("INSERT INTO groups (name, creator_id, description) VALUES ('old group', ?, 'legacy')", (users[0],))
+    conn.executemany("INSERT INTO group_members (group_id, user_id, role) VALUES (1, ?, 'member')",
+                     [(user_id,) for user_id in users[:40]])
+    conn.executemany("INSERT INTO hashtags (name) VALUES (?)", [(f'old{i}',) for i in range(5)])
+    conn.executemany(
+        "INSERT INTO posts (user_id, content, post_date, group_id) VALUES (?, ?, datetime('now', ?), ?)",
+        [(rnd.choice(users), f'old post {i} #old{i % 5}', f'-{i} minutes', 1 if i % 4 == 0 else None)
+         for i in range(2000)])
+    conn.executemany("INSERT INTO post_hashtags (post_id, hashtag_id) VALUES (?, ?)",
+                     [(post_id, (post_id - 1) % 5 + 1) for post_id in range(1, 2001)])
+    conn.executemany("INSERT OR IGNORE INTO likes (post_id, user_id, like_date) VALUES (?, ?, datetime('now'))",
+                     [(rnd.randint(1, 2000), rnd.choice(users)) for _ in range(3000)])
+    conn.executemany("INSERT INTO comments (post_id, user_id, content, comment_date) VALUES (?, ?, 'old', datetime('now'))",
+                     [(rnd.randint(1, 2000), rnd.choice(users)) for _ in range(1000)])
+    conn.executemany(
+        "INSERT INTO notifications (user_id, type, content, notification_date) VALUES (?, 'like', 'old', datetime('now'))",
+        [(rnd.choice(users),) for _ in range(1000)])
+    conn.executemany(
+        "INSERT INTO messages (sender_id, receiver_id, content, timestamp) VALUES (?, ?, 'old', datetime('now'))",
+        [(rnd.choice(users), rnd.choice(users)) for _ in range(1000)])
+    conn.executemany("INSERT INTO marketplace (seller_id, title, description, price) VALUES (?, ?, 'old', 10)",
+                     [(rnd.choice(users), f'old item {i}') for i in range(100)])
+    # Старые версии выдавали значки повторно
+    conn.executemany("INSERT INTO achievements (user_id, type, description) VALUES (?, ?, 'old')",
+                     [(rnd.choice(users), rnd.choice(('first_post', 'popular'))) for _ in range(1200)])
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    pool = open_database(monkeypatch, tmp_path / 'fresh.db')
+    yield pool
+    close_database(pool)
+
+
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    # База старой установки сразу после обновления: миграции применены, фоновые шаги еще в очереди
+    path = tmp_path / 'legacy.db'
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA.read_text())
+    fill_baseline(conn)
+    conn.commit()
+    conn.close()
+    pool = open_database(monkeypatch, path)
+    yield pool
+    close_database(pool)
+
+
+DATED_KEY = ('2099-01-01 00:00:00', 10 ** 9)  # ключ страницы (дата, ID) - дальше всех существующих строк
+OLD_KEY = ('2000-01-01 00:00:00', 1)  # ключ страницы раньше всех строк
+RANKED_KEY = (10 ** 9,) + DATED_KEY  # ключ страницы с рейтингом впереди
+DATED_LISTINGS = (bot.get_feed_posts, bot.get_user_posts, bot.get_friend_posts, bot.get_group_posts,
+                  bot.get_bookmarks, bot.get_inbox, bot.get_sent_messages, bot.get_my_market_items)
+RANKED_LISTINGS = (bot.get_smart_feed, bot.get_popular_posts)
+
+
+def populate():
+    # Наполнение базы через обычные действия пользователей; возвращает ID созданной группы
+    rnd = random.Random(2)
+    users = range(1, 60)
+    for user_id in users:
+        bot.complete_registration(user_id, f'u{user_id}')
+    for user_id in range(2, 30):
+        bot.send_friend_request(1, f'u{user_id}')
+        bot.respond_friend_request(user_id, 1)
+    group_id = bot.create_group(1, 'g', 'desc')
+    for user_id in range(2, 20):
+        bot.join_group(user_id, group_id)
+    post_ids = [bot.create_post(rnd.choice(users), f'post {i} #t{i % 9} @u{i % 5 + 1}',
+                                group_id=group_id if i % 3 == 0 else None)
+                for i in range(300)]
+    for _ in range(200):
+        bot.like_post(rnd.choice(users), rnd.choice(post_ids))
+        bot.comment_post(rnd.choice(users), rnd.choice(post_ids), 'c #t1')
+    bot.repost(2, post_ids[0])
+    bot.add_bookmark(1, post_ids[1])
+    bot.remove_bookmark(1, post_ids[1])
+    bot.add_bookmark(1, post_ids[2])
+    item_id = bot.create_market_item(2, 'thing', 'desc', 5)
+    bot.add_currency(3, 100)
+    bot.buy_item(3, item_id)
+    bot.create_market_item(2, 'thing2', 'desc', 5)
+    bot.appoint_admin(1, 1)
+    bot.review_ad(1, bot.create_ad(2, 'ad', 1), True)
+    for user_id in range(2, 10):
+        bot.send_private_message(user_id, 'u1', 'hi')
+        bot.send_private_message(1, f'u{user_id}', 'yo')
+    bot.create_story(2, 'story')
+    bot.create_report(1, post_ids[3], 'post', 'bad')
+    bot.block_user(1, 'u5')
+    bot.unblock_user(1, 'u5')
+    bot.block_user(1, 'u6')
+    bot.daily_bonus(1)
+    bot.transfer_currency(3, 'u1', 1)
+    stream_id = bot.start_live_stream(1, group_id, 'live')
+    while bot.broadcast_chunk():
+        pass
+    bot.end_live_stream(stream_id)
+    bot.get_broadcast_progress()
+    bot.notifier.flush()
+    after = 0
+    while (after := bot.prune_timelines(after, keep=20)) is not None:
+        pass
+    return group_id
+
+
+def read_all(readers, group_id):
+    for user_id in readers:
+        for listing in DATED_LISTINGS:
+            listing(user_id)
+            listing(user_id, page_key=DATED_KEY)
+            listing(user_id, page_key=DATED_KEY, backward=True)
+        bot.get_feed_posts(user_id, page_key=OLD_KEY)
+        bot.get_feed_posts(user_id, page_key=OLD_KEY, backward=True)
+        for listing in RANKED_LISTINGS:
+            listing(user_id)
+            listing(user_id, page_key=RANKED_KEY)
+            listing(user_id, page_key=RANKED_KEY, backward=True)
+        bot.get_friends(user_id)
+        bot.get_friend_requests(user_id)
+        bot.get_blocked_users(user_id)
+        bot.get_unread_notifications(user_id)
+        bot.get_notification_settings(user_id)
+        bot.toggle_notification_setting(user_id, 'notify_likes')
+        bot.get_user_groups(user_id)
+        bot.get_stories(user_id)
+        bot.get_achievements(user_id)
+        bot.count_achievements(user_id)
+        bot.get_user_stats(user_id)
+        bot.check_achievements(user_id)
+        bot.search_content('post', user_id)
+        bot.is_admin(user_id)
+        bot.user_affinity(user_id)
+        bot.get_user_by_id(user_id)
+        bot.get_currency(user_id)
+    bot.get_market_items()
+    bot.get_market_items(page_key=DATED_KEY)
+    bot.get_ads()
+    bot.get_user_by_nickname('u2')
+    bot.search_users('u1')
+    bot.search_groups('g')
+    bot.search_market('thing')
+    bot.search_posts_by_hashtag('t1')
+    bot.get_trending_hashtags()
+    bot.get_trending_hashtags(window='7d', group_id=group_id)
+
+
+def run_workload(readers=(1, 2, 7)):
+    # Все функции запросов бота: наполнение, чтение и изменения поверх прочитанного
+    group_id = populate()
+    read_all(readers, group_id)
+    bot.ban_user(1, 'u9', 'spam')
+    post_ids = [post[0] for post in bot.get_user_posts(2, limit=2)]
+    bot.delete_post(1, post_ids[0])
+    bot.remove_post(post_ids[1], None)
+    bot.mark_notification_read(1)
+    bot.delete_notification(2)
+    bot.save_user_states({1: {'step': 1}})
+    bot.load_user_state(1)
+    bot.purge_user_state()
+    bot.update_user_profile(1, bio='bio')
+    bot.set_ranking_weights(like=2.5)
+    bot.notifier.flush()
+
+
+@pytest.fixture
+def workload():
+    return run_workload
@@ -0,0 +1,38 @@
+import sqlite3
+
+import pytest
+
+import socialNetworkBot as bot
+
+
+def test_interrupted_broadcast_resumes_without_duplicates(fresh_db):
+    for user_id in range(1, 11):
+        bot.complete_registration(user_id, f'u{user_id}')
+    group_id = bot.create_group(1, 'g', 'desc')
+    for user_id in range(2, 11):
+        bot.join_group(user_id, group_id)
+    with bot.db.write() as cursor:
+        job_id = bot.enqueue_broadcast(cursor, group_id, 'group_event', 'event')
+
+    assert bot.broadcast_chunk(chunk=4)
+    assert bot.get_broadcast_progress() == [(job_id, 'group_event', None, 4, 10)]
+
+    # Сбой посреди порции: уведомления и позиция откатываются вместе
+    with bot.db.write() as cursor:
+        cursor.execute('''
+        CREATE TRIGGER crash BEFORE UPDATE ON broadcast_jobs BEGIN SELECT RAISE(ABORT, 'crash'); END
+        ''')
+    with pytest.raises(sqlite3.Error):
+        bot.broadcast_chunk(chunk=4)
+    with bot.db.write() as cursor:
+        cursor.execute('DROP TRIGGER crash')
+    assert bot.get_broadcast_progress() == [(job_id, 'group_event', None, 4, 10)]
+
+    while bot.broadcast_chunk(chunk=4):
+        pass
+    assert bot.get_broadcast_progress() == []
+    with bot.db.read() as cursor:
+        cursor.execute("SELECT user_id, COUNT(*) FROM notifications WHERE type = 'group_event' GROUP BY user_id")
+        assert cursor.fetchall() == [(user_id, 1) for user_id in range(1, 11)]
+        cursor.execute('SELECT status, last_user_id, sent FROM broadcast_jobs WHERE job_id = ?', (job_id,))
+        assert cursor.fetchone() == ('done', 10, 10)
@@ -0,0 +1,32 @@
+import socialNetworkBot as bot
+
+
+def test_value_read_before_invalidation_is_not_cached(fresh_db):
+    cache = bot.LRUCache('test')
+    loads = []
+
+    def stale_loader():
+        # Писатель успел изменить строку, пока читатель ее загружал
+        loads.append('stale')
+        cache.invalidate('key')
+        return 'stale'
+
+    assert cache.get('key', stale_loader) == 'stale'
+    assert cache.get('key', lambda: loads.append('fresh') or 'fresh') == 'fresh'
+    assert cache.get('key', lambda: loads.append('again') or 'again') == 'fresh'
+    assert loads == ['stale', 'fresh']
+    assert cache.stats == {'hits': 1, 'misses': 2, 'evictions': 0, 'invalidations': 1}
+
+
+def test_uncommitted_value_is_not_cached(fresh_db):
+    cache = bot.LRUCache('test')
+    with bot.db.write():
+        assert cache.get('key', lambda: 'uncommitted') == 'uncommitted'
+    assert cache.get('key', lambda: 'committed') == 'committed'
+
+
+def test_profile_update_invalidates_cached_user(fresh_db):
+    bot.complete_registration(1, 'u1')
+    assert bot.get_user_by_id(1)['bio'] != 'new bio'
+    assert bot.update_user_profile(1, bio='new bio')
+    assert bot.get_user_by_id(1)['bio'] == 'new bio'
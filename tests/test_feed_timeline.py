@@ -0,0 +1,90 @@
+import socialNetworkBot as bot
+
+
+def read_feed(user_id, limit=5, backward=False):
+    # Все страницы ленты подряд, как при нажатии "Далее" (или "Назад" от самого старого поста)
+    pages, page_key = [], None
+    if backward:
+        page_key = ('2000-01-01 00:00:00', 0)
+    while True:
+        posts = bot.get_feed_posts(user_id, limit=limit, page_key=page_key, backward=backward)
+        if not posts:
+            return pages
+        pages.append([post[0] for post in posts])
+        edge = posts[0] if backward else posts[-1]
+        page_key = (edge[2], edge[0])
+
+
+def make_feed(reader=1, authors=range(2, 8)):
+    for user_id in (reader, *authors):
+        bot.complete_registration(user_id, f'u{user_id}')
+    for user_id in authors:
+        bot.send_friend_request(reader, f'u{user_id}')
+        bot.respond_friend_request(user_id, reader)
+    group_id = bot.create_group(authors[0], 'g', 'desc')
+    bot.join_group(reader, group_id)
+    for i in range(60):
+        bot.create_post(authors[i % len(authors)], f'post {i}', group_id=group_id if i % 4 == 0 else None)
+
+
+def prune_all(keep):
+    after = 0
+    while (after := bot.prune_timelines(after, keep=keep)) is not None:
+        pass
+
+
+def timeline_size(user_id):
+    with bot.db.read() as cursor:
+        return cursor.execute('SELECT COUNT(*) FROM feed_timeline WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+
+def test_pruning_keeps_newest_entries(fresh_db):
+    make_feed()
+    prune_all(keep=12)
+    assert timeline_size(1) == 12
+    with bot.db.read() as cursor:
+        horizon = cursor.execute('SELECT post_date, post_id FROM feed_horizons WHERE user_id = 1').fetchone()
+        oldest = cursor.execute('''
+        SELECT post_date, post_id FROM feed_timeline WHERE user_id = 1 ORDER BY post_date, post_id LIMIT 1
+        ''').fetchone()
+    assert horizon == oldest
+    prune_all(keep=12)
+    assert timeline_size(1) == 12
+
+
+def test_pages_past_horizon_come_from_pull(fresh_db):
+    make_feed()
+    before = read_feed(1)
+    before_backward = read_feed(1, backward=True)
+    assert sum(len(page) for page in before) == 60
+    prune_all(keep=12)
+    assert read_feed(1) == before
+    assert read_feed(1, backward=True) == before_backward
+    assert fresh_db.plans.warnings == {}
+
+
+def test_unblock_restores_shared_group_posts(fresh_db):
+    make_feed()
+    with bot.db.read() as cursor:
+        personal = {row[0] for row in cursor.execute('SELECT post_id FROM posts WHERE user_id = 2 AND group_id IS NULL')}
+        grouped = {row[0] for row in cursor.execute('SELECT post_id FROM posts WHERE user_id = 2 AND group_id IS NOT NULL')}
+    before = {post_id for page in read_feed(1) for post_id in page}
+    assert personal | grouped <= before
+    bot.block_user(1, 'u2')
+    assert not {post_id for page in read_feed(1) for post_id in page} & (personal | grouped)
+    bot.unblock_user(1, 'u2')
+    # Дружба при блокировке разорвана, поэтому возвращаются только посты общей группы
+    assert {post_id for page in read_feed(1) for post_id in page} == before - personal
+    with bot.db.read() as cursor:
+        restored = {row[0] for row in cursor.execute('SELECT post_id FROM feed_timeline WHERE user_id = 1 AND author_id = 2')}
+    assert restored == grouped
+
+
+def test_large_audience_switches_to_pull(fresh_db, monkeypatch):
+    monkeypatch.setattr(bot, 'FEED_FANOUT_LIMIT', 1)
+    make_feed(reader=1, authors=range(2, 8))
+    with bot.db.read() as cursor:
+        sources = cursor.execute('SELECT source_type, source_id FROM feed_pull_sources').fetchall()
+    # У каждого автора один друг (читатель), в группе двое - больше предела
+    assert sources == [('group', 1)]
+    assert sum(len(page) for page in read_feed(1)) == 60
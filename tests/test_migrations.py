@@ -0,0 +1,62 @@
+import socialNetworkBot as bot
+
+from conftest import LEGACY_USERS, populate, read_all
+
+READERS = (1, LEGACY_USERS[0], LEGACY_USERS[1])
+
+
+def index_names():
+    with bot.db.read() as cursor:
+        return {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+
+def read_retired_paths(readers, group_id):
+    # Запросы, которые до построения замены обслуживают устаревшие индексы
+    for user_id in readers:
+        bot.get_user_posts(user_id)
+        bot.get_unread_notifications(user_id)
+        bot.get_inbox(user_id)
+        bot.get_my_market_items(user_id)
+
+
+def check_plans(pool, read, group_id, stage):
+    # Формы запросов проверяются один раз, поэтому на каждом этапе планы строятся заново
+    pool.plans._seen.clear()
+    pool.plans.warnings.clear()
+    read(READERS, group_id)
+    assert pool.plans.warnings == {}, stage
+
+
+def test_upgrade_keeps_indexes_and_plans_during_backfill(legacy_db):
+    queued = [name for name, _, _ in bot.get_backfill_progress()]
+    assert set(bot.RETIRED_INDEXES.values()) <= set(queued)
+    assert set(bot.RETIRED_INDEXES) <= index_names()
+    group_id = populate()
+
+    step, row_steps = 0, 0
+    while True:
+        names = index_names()
+        for retired, replacement in bot.RETIRED_INDEXES.items():
+            # Устаревший индекс пропадает только вместе с появлением замены
+            assert (retired in names) != (replacement in names), (step, retired)
+        progress = bot.get_backfill_progress()
+        stage = f'шаг {step}: {progress[:1]}'
+        if any(max_id is None for _, _, max_id in progress):
+            check_plans(legacy_db, read_retired_paths, group_id, stage)
+        else:
+            # Индексы строятся первыми: пока идут порционные шаги, все запросы уже работают по индексам
+            check_plans(legacy_db, read_all, group_id, stage)
+            row_steps += bool(progress)
+        if not bot.backfill_step(batch=500):
+            break
+        step += 1
+
+    assert row_steps > 1
+    names = index_names()
+    assert set(bot.SCHEMA_INDEXES) <= names
+    assert not set(bot.RETIRED_INDEXES) & names
+    assert 'idx_achievements_unique' in names and 'idx_achievements_user_type' not in names
+    with bot.db.read() as cursor:
+        pairs = cursor.execute('SELECT COUNT(*), COUNT(DISTINCT user_id || type) FROM achievements').fetchone()
+    assert pairs[0] == pairs[1]
+    check_plans(legacy_db, read_all, group_id, 'после заполнения')
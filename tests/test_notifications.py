@@ -0,0 +1,51 @@
+import sqlite3
+
+import socialNetworkBot as bot
+
+
+def register(*user_ids):
+    for user_id in user_ids:
+        bot.complete_registration(user_id, f'u{user_id}')
+
+
+def test_unread_list_flushes_only_own_events(fresh_db):
+    register(1, 2, 3)
+    post_id = bot.create_post(1, 'post')
+    other_post_id = bot.create_post(2, 'post')
+    bot.notifier.flush()
+    bot.like_post(3, post_id)
+    bot.like_post(3, other_post_id)
+    assert [row[1] for row in bot.get_unread_notifications(1)] == ['@u3 поставил реакцию like на ваш пост']
+    assert [key[0] for key in bot.notifier.pending] == [2]
+
+
+def test_likes_coalesce_into_one_unread_notification(fresh_db):
+    register(1, 2, 3, 4)
+    post_id = bot.create_post(1, 'post')
+    bot.like_post(2, post_id)
+    bot.like_post(3, post_id)
+    assert bot.notifier.flush() == 1
+    # Лайк после записи пачки дописывается в ту же непрочитанную запись
+    bot.like_post(4, post_id)
+    assert [row[1] for row in bot.get_unread_notifications(1)] == ['@u4 и еще 2 поставили реакцию на ваш пост']
+
+
+def test_failed_write_requeues_events(fresh_db, monkeypatch):
+    register(1, 2, 3)
+    post_id = bot.create_post(1, 'post')
+    bot.notifier.flush()
+    bot.like_post(2, post_id)
+    write = bot.notifier._write
+
+    def failing_write(cursor, event):
+        # Пока пачка пишется, приходит еще один лайк на тот же пост
+        bot.notifier.push(1, 'like', '@u3 поставил реакцию like на ваш пост', post_id,
+                          actor={'user_id': 3, 'nickname': 'u3'})
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(bot.notifier, '_write', failing_write)
+    assert bot.notifier.flush() == 0
+    assert list(bot.notifier.pending) == [(1, 'like', post_id)]
+    monkeypatch.setattr(bot.notifier, '_write', write)
+    assert bot.notifier.flush() == 1
+    assert [row[1] for row in bot.get_unread_notifications(1)] == ['@u3 и еще 1 поставили реакцию на ваш пост']
@@ -0,0 +1,22 @@
+import socialNetworkBot as bot
+
+from conftest import LEGACY_USERS
+
+
+def test_fresh_database_has_no_full_scans(fresh_db, workload):
+    workload()
+    assert fresh_db.plans.enabled and fresh_db.plans._seen
+    assert fresh_db.plans.warnings == {}
+
+
+def test_upgraded_database_has_no_full_scans(legacy_db, workload):
+    bot.run_backfills()
+    assert bot.get_backfill_progress() == []
+    workload(readers=(1, 2, LEGACY_USERS[0], LEGACY_USERS[1]))
+    assert legacy_db.plans.warnings == {}
+
+
+def test_checker_reports_full_scan(fresh_db):
+    with bot.db.read() as cursor:
+        cursor.execute('SELECT COUNT(*) FROM posts WHERE content = ?', ('x',)).fetchone()
+    assert list(fresh_db.plans.warnings.values()) == [['posts']]
@@ -0,0 +1,42 @@
+import pytest
+
+import socialNetworkBot as bot
+
+
+def handler(name):
+    async def handle(update, context):
+        return name
+    return handle
+
+
+def test_longest_prefix_wins():
+    router = bot.Router()
+    bookmark, bookmark_prev = handler('bookmark'), handler('bookmark_prev')
+    router.add('bookmark_', bookmark, prefix=True)
+    router.add('bookmark_prev_', bookmark_prev, prefix=True)
+    router.add('bookmark_list', handler('list'))
+    assert router.match('bookmark_prev_15') == (bookmark_prev, '15')
+    assert router.match('bookmark_15') == (bookmark, '15')
+    # Незаконченный длинный префикс откатывается к короткому
+    assert router.match('bookmark_pre') == (bookmark, 'pre')
+    assert router.match('bookmark_list')[1] == ''
+    assert router.match('bookmark') == (None, 'bookmark')
+
+
+def test_registered_callbacks_prefer_longer_prefix():
+    assert bot.callback_routes.match('delete_my_post_7') == (bot.callback_delete_my_post, '7')
+    assert bot.callback_routes.match('delete_7') == (bot.callback_delete_notification, '7')
+    assert bot.callback_routes.match('remove_bookmark_3') == (bot.callback_remove_bookmark, '3')
+    assert bot.callback_routes.match('bookmark_3') == (bot.callback_bookmark, '3')
+
+
+def test_duplicate_route_raises():
+    router = bot.Router()
+    router.add('main_menu', handler('menu'))
+    router.add('delete_', handler('delete'), prefix=True)
+    with pytest.raises(ValueError, match='уже зарегистрирован'):
+        router.add('main_menu', handler('other'))
+    with pytest.raises(ValueError, match='уже зарегистрирован'):
+        router.add('delete_', handler('other'), prefix=True)
+    # Точный маршрут и префикс с тем же текстом не конфликтуют
+    router.add('delete_', handler('exact'))
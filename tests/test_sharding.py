@@ -0,0 +1,141 @@
+import asyncio
+import json
+import queue
+import threading
+import time
+from types import SimpleNamespace
+
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+from telegram.request import BaseRequest
+
+import socialNetworkBot as bot
+from conftest import close_database, open_database
+
+
+class FakeRequest(BaseRequest):
+    # Bot API без сети: getMe отвечает ботом, остальные методы - успехом
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        result = True
+        if url.endswith('/getMe'):
+            result = {'id': 1, 'is_bot': True, 'first_name': 'test', 'username': 'test_bot'}
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class FakeProcess:
+    def __init__(self, alive):
+        self.alive = alive
+        self.name = 'shard-0'
+
+    def is_alive(self):
+        return self.alive
+
+
+def message(update_id, user_id=None, chat_id=None):
+    data = {'update_id': update_id}
+    if user_id is not None:
+        data['message'] = {'message_id': 1, 'date': 0, 'text': 'hi', 'chat': {'id': user_id, 'type': 'private'},
+                           'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'}}
+    elif chat_id is not None:
+        data['channel_post'] = {'message_id': 1, 'date': 0, 'text': 'hi', 'chat': {'id': chat_id, 'type': 'channel'}}
+    return data
+
+
+def test_shard_of_prefers_user_then_chat_then_update_id():
+    assert bot.shard_of(Update.de_json(message(10, user_id=7), None), 4) == 3
+    assert bot.shard_of(Update.de_json(message(10, chat_id=-1001), None), 4) == -1001 % 4
+    assert bot.shard_of(Update.de_json(message(10), None), 4) == 2
+
+
+def test_publish_relays_to_other_workers(monkeypatch):
+    applied = []
+    monkeypatch.setitem(bot.SHARED_EVENTS, 'block', lambda *args: applied.append(('block', args)))
+    monkeypatch.setitem(bot.SHARED_EVENTS, 'trend', lambda *args: applied.append(('trend', args)))
+    shared = queue.Queue()
+    monkeypatch.setattr(bot, 'shared_events', shared)
+    monkeypatch.setattr(bot, 'shard_index', 1)
+    bot.publish('block', 5, 6)
+    bot.publish('trend', ['tag'], None, '2026-01-01 00:00:00')
+    # Воркер применяет событие сразу и отправляет маршрутизатору
+    assert applied == [('block', (5, 6)), ('trend', (['tag'], None, '2026-01-01 00:00:00'))]
+    applied.clear()
+
+    inboxes = [queue.Queue() for _ in range(3)]
+    threading.Thread(target=bot.relay_shared_events, args=(shared, inboxes), daemon=True).start()
+    relayed = [[inbox.get(timeout=1) for _ in range(2)] for inbox in (inboxes[0], inboxes[2])]
+    assert relayed == [[('block', (5, 6)), ('trend', (['tag'], None, '2026-01-01 00:00:00'))]] * 2
+    assert inboxes[1].empty()
+    # Маршрутизатор применяет у себя блокировку, но не тренды
+    assert applied == [('block', (5, 6))]
+
+    # Воркер применяет пересланное маршрутизатором
+    threading.Thread(target=bot.apply_shared_events, args=(inboxes[0],), daemon=True).start()
+    inboxes[0].put(('block', (7, 8)))
+    deadline = time.monotonic() + 2
+    while applied[-1] != ('block', (7, 8)):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_stop_marker_drains_accepted_updates(fresh_db, monkeypatch):
+    async def no_background(application):
+        pass
+
+    monkeypatch.setattr(bot, 'start_background', no_background)
+    monkeypatch.setattr(bot, 'shard_index', 0)
+    handled = []
+
+    async def handle(update, context):
+        await asyncio.sleep(0.01)
+        handled.append(update.update_id)
+
+    application = (
+        Application.builder().token('1:test').request(FakeRequest()).get_updates_request(FakeRequest())
+        .concurrent_updates(True).update_queue(bot.UpdateQueue()).updater(None).build()
+    )
+    application.add_handler(TypeHandler(Update, handle))
+    updates, ready = queue.Queue(), queue.Queue()
+    for update_id in range(1, 21):
+        updates.put(message(update_id, user_id=update_id))
+    updates.put(None)
+    asyncio.run(bot.serve_shard(application, updates, ready))
+    assert ready.get_nowait() == 0
+    assert sorted(handled) == list(range(1, 21))
+    assert application.update_queue.stats['in_progress'] == 0
+
+
+def test_deliver_skips_dead_worker(caplog):
+    inbox = queue.Queue(1)
+    bot.deliver(inbox, FakeProcess(alive=False), message(3, user_id=1))
+    assert inbox.empty()
+    assert 'обновление 3 пропущено' in caplog.text
+
+
+def test_watcher_stops_bot_when_worker_dies():
+    async def scenario():
+        stopped = asyncio.Event()
+        application = SimpleNamespace(running=True, stop_running=stopped.set)
+        await bot.shard_watcher([FakeProcess(alive=True), FakeProcess(alive=False)])(application)
+        await asyncio.wait_for(stopped.wait(), 5)
+
+    asyncio.run(scenario())
+
+
+def test_worker_does_not_migrate(tmp_path, monkeypatch):
+    close_database(open_database(monkeypatch, tmp_path / 'shared.db'))
+
+    def migrate():
+        raise AssertionError('воркер не должен запускать миграции')
+
+    monkeypatch.setattr(bot, 'migrate', migrate)
+    monkeypatch.setattr(bot, 'shard_index', 0)
+    pool = open_database(monkeypatch, tmp_path / 'shared.db')
+    assert bot.get_user_by_id(1) is None
+    close_database(pool)
@@ -0,0 +1,56 @@
+import asyncio
+
+import socialNetworkBot as bot
+
+
+class FakeApplication:
+    def __init__(self):
+        self.user_data = {}
+
+    def drop_user_data(self, user_id):
+        self.user_data.pop(user_id, None)
+
+
+def test_save_skips_unserializable_user(fresh_db, caplog):
+    bot.save_user_states({1: {'step': 1}, 2: {'photo': object()}, 3: {'step': 3}})
+    assert bot.load_user_state(1) == {'step': 1}
+    assert bot.load_user_state(2) == {}
+    assert bot.load_user_state(3) == {'step': 3}
+    assert 'Состояние пользователя 2 не сохранено' in caplog.text
+
+
+def test_expired_state_is_forgotten(fresh_db):
+    bot.save_user_states({1: {'step': 1}, 2: {'step': 2}})
+    with bot.db.write() as cursor:
+        cursor.execute('UPDATE user_state SET updated_at = updated_at - ? WHERE user_id = 1', (bot.STATE_TTL + 1,))
+    assert bot.load_user_state(1) == {}
+    assert bot.purge_user_state() == 1
+    assert bot.load_user_state(2) == {'step': 2}
+
+
+def test_evicted_state_reloads(fresh_db, monkeypatch):
+    async def scenario():
+        store, application = bot.StateStore(), FakeApplication()
+        store._application = application
+        bot.save_user_states({1: {'step': 1}})
+        data = application.user_data[1] = {}
+        await store.refresh_user_data(1, data)
+        assert data == {'step': 1}
+        data['step'] = 2
+
+        monkeypatch.setattr(bot, 'STATE_IDLE', -1)
+        assert await store.evict_idle(application) == 1
+        assert 1 not in application.user_data and store.metrics()['in_memory'] == 0
+
+        data = application.user_data[1] = {}
+        await store.refresh_user_data(1, data)
+        assert data == {'step': 2}
+        assert store.stats['loads'] == 2
+
+        # Остановка дописывает данные, которые еще не попали в базу
+        data['step'] = 3
+        await store.flush()
+        assert bot.load_user_state(1) == {'step': 3}
+        assert not store.dirty
+
+    asyncio.run(scenario())
@@ -0,0 +1,41 @@
+import datetime
+from types import SimpleNamespace
+
+import socialNetworkBot as bot
+
+NOW = 1_800_000_000  # начало корзины
+
+
+def date(ts):
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def test_windows_expire_and_removals_subtract(monkeypatch):
+    clock = [NOW]
+    monkeypatch.setattr(bot, 'time', SimpleNamespace(time=lambda: clock[0]))
+    trends = bot.TrendCounter()
+    trends.add(['a', 'b'], None, date(NOW - 30 * 60))
+    trends.add(['a'], None, date(NOW - 2 * 3600))
+    trends.add(['c'], 5, date(NOW - 10 * 60))
+    assert trends.top('1h') == [('c', 1), ('b', 1), ('a', 1)]
+    assert trends.top('24h') == [('a', 2), ('c', 1), ('b', 1)]
+    assert trends.top('1h', group_id=5) == [('c', 1)]
+
+    # Через 40 минут пост получасовой давности выходит из часового окна, но остается в суточном
+    clock[0] = NOW + 40 * 60
+    assert trends.top('1h') == [('c', 1)]
+    assert trends.top('24h') == [('a', 2), ('c', 1), ('b', 1)]
+
+    # Удаление поста вычитает его хештеги из всех окон, где он учтен
+    trends.add(['a'], None, date(NOW - 2 * 3600), delta=-1)
+    trends.add(['c'], 5, date(NOW - 10 * 60), delta=-1)
+    assert trends.top('24h') == [('b', 1), ('a', 1)]
+    assert trends.top('1h') == []
+    assert trends.top('1h', group_id=5) == []
+    # Пост из корзины, которой нет в счетчиках, не уводит их в минус
+    trends.add(['b'], None, date(NOW - 8 * 86400), delta=-1)
+    assert trends.top('24h') == [('b', 1), ('a', 1)]
+
+    clock[0] = NOW + 8 * 86400
+    assert trends.top('7d') == []
+    assert trends.metrics() == {'scopes': 1, 'buckets': 0}
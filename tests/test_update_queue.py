@@ -0,0 +1,23 @@
+import asyncio
+
+import socialNetworkBot as bot
+
+
+def test_full_queue_blocks_put_until_task_done():
+    async def scenario():
+        queue = bot.UpdateQueue(limit=2)
+        await queue.put('a')
+        await queue.put('b')
+        blocked = asyncio.create_task(queue.put('c'))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+        # Взятое из очереди обновление еще в работе - место освобождает только task_done
+        assert await queue.get() == 'a'
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+        queue.task_done()
+        await asyncio.wait_for(blocked, 1)
+        assert queue.stats == {'accepted': 3, 'in_progress': 2, 'waited': 1}
+        assert [await queue.get(), await queue.get()] == ['b', 'c']
+
+    asyncio.run(scenario())